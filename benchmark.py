@@ -0,0 +1,301 @@
+#!/usr/bin/python3
+"""Benchmarks of gitar's hot paths on a synthetic repository.
+
+    benchmark.py [--scale S] [--repeat N] [--baseline FILE] [--save-baseline] [--tolerance T]
+
+The repository is generated reproducibly (fixed seeds and dates) with git fast-import and reused
+between runs. Results are written to stdout as JSON and compared with the baseline file, stages
+whose median time got slower than the tolerance allows are reported and make the exit code 1."""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+# a private diff cache, which is cleared for the cold stages
+os.environ["GITAR_DIFF_CACHE"] = os.path.join(tempfile.mkdtemp(prefix="gitar-benchmark-"), "diffs.sqlite")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import gitar
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# differences below this are treated as noise when comparing with the baseline
+NOISE_SECONDS = 0.005
+
+class FastImport:
+    """Writes a git fast-import stream with deterministic commit dates."""
+    def __init__(self, path):
+        self.process = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path, stdin=subprocess.PIPE)
+        self.mark = 0
+        self.time = 1500000000
+
+    def write(self, data):
+        self.process.stdin.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+
+    def commit(self, branch, message, files, parent=None, author="Bench Mark"):
+        """files: {path: content or None to delete}, returns the mark of the commit."""
+        self.mark += 1
+        self.time += 60
+        message = message.encode('utf-8')
+        self.write("commit refs/heads/%s\nmark :%i\n"%(branch, self.mark))
+        self.write("author %s <bench@example.com> %i +0000\n"%(author, self.time))
+        self.write("committer %s <bench@example.com> %i +0000\n"%(author, self.time))
+        self.write(b"data %i\n"%len(message)+message+b"\n")
+        if parent is not None:
+            self.write("from :%i\n"%parent)
+        for path, content in files.items():
+            if content is None:
+                self.write("D %s\n"%path)
+                continue
+            data = content.encode('utf-8')
+            self.write("M 100644 inline %s\ndata %i\n"%(path, len(data)))
+            self.write(data+b"\n")
+        return self.mark
+
+    def reset(self, branch, mark):
+        self.write("reset refs/heads/%s\nfrom :%i\n\n"%(branch, mark))
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("git fast-import failed")
+
+def sourceFile(rng, index, lines):
+    return "".join("int value%i_%i = %i; // %s\n"%(index, n, rng.randint(0, 1000), "x"*rng.randint(0, 40)) for n in range(lines))
+
+def minifiedFiles(rng, lines, width):
+    """Two versions of a file of long generated lines, every other line changed in one token."""
+    tokens = ["var", "function", "return", "a", "b", "=", "(", ")", "{", "}", ";", ",", "x1", "y2", "0", "1"]
+    lines1 = ["".join(rng.choice(tokens) for k in range(width//3))+"\n" for n in range(lines)]
+    lines2 = [line if n%2 else line[:len(line)//2]+"z"+line[len(line)//2+5:] for n, line in enumerate(lines1)]
+    return lines1, lines2
+
+def modify(rng, text, edits):
+    lines = text.splitlines(True)
+    for e in range(edits):
+        position = rng.randrange(len(lines))
+        operation = rng.random()
+        if operation < 0.4:
+            lines[position] = lines[position].rstrip("\n")+" // changed %i\n"%e
+        elif operation < 0.7:
+            lines.insert(position, "inserted line %i\n"%e)
+        else:
+            del lines[position]
+    return "".join(lines)
+
+def createRepository(path, scale):
+    """Generates the benchmark repository:
+    main:    a long history of a file edited by every commit, on top of many source files
+    feature: changes most source files, a huge file and a file with a pathological diff
+    other:   changes half of the same source files differently (for the diverged files)
+    branchNN: many branches pointing into the history of main"""
+    rng = random.Random(scale)
+    commits = int(2000*scale)
+    sourceFiles = int(3000*scale)
+    hugeLines = int(100000*scale)
+    os.makedirs(path)
+    subprocess.check_call(["git", "init", "-q", path])
+    stream = FastImport(path)
+
+    sources = {"src/d%02i/file%i.c"%(i%40, i): sourceFile(rng, i, rng.randint(20, 400)) for i in range(sourceFiles)}
+    history = ["history line %i\n"%n for n in range(300)]
+    huge = sourceFile(rng, -1, hugeLines)
+    vocabulary = ["{\n", "}\n", "\n", "return 0;\n", "break;\n"]
+    pathological = "".join(rng.choice(vocabulary) for n in range(int(20000*scale)))
+    base = dict(sources)
+    base.update({"history.txt": "".join(history), "huge.txt": huge, "pathological.txt": pathological})
+    mark = stream.commit("main", "initial import", base)
+    historyMarks = []
+    for c in range(commits):
+        for e in range(3):
+            n = rng.randrange(len(history))
+            history[n] = "history line %i changed in commit %i\n"%(n, c)
+        mark = stream.commit("main", "commit %i of the history"%c, {"history.txt": "".join(history)}, mark,
+                             author=["Ann Author", "Bob Builder", "Cid Coder", "Dee Devel"][c%4])
+        historyMarks.append(mark)
+    for b in range(50):
+        stream.reset("branch%02i"%b, historyMarks[rng.randrange(len(historyMarks))])
+    stream.reset("feature", mark)
+    stream.reset("other", mark)
+
+    changed = {path: modify(rng, content, rng.randint(1, 6)) for path, content in sources.items() if rng.random() < 0.9}
+    changed["huge.txt"] = modify(rng, huge, 300)
+    changed["pathological.txt"] = "".join(rng.choice(vocabulary) for n in range(int(20000*scale)))
+    stream.commit("feature", "change most files", changed, mark)
+    other = {path: modify(rng, content, 2) for path, content in sources.items() if rng.random() < 0.5}
+    stream.commit("other", "change half of the files", other, mark)
+    stream.close()
+    subprocess.check_call(["git", "checkout", "-q", "main"], cwd=path)
+    open(os.path.join(path, ".git", "gitar-benchmark-complete"), "w").close()
+
+def resetCaches():
+    gitar.blobCache.clear()
+    for reader in gitar.objectReaders.values():
+        reader.clearIndex()
+    with gitar.blameCacheLock:
+        gitar.blameCache.clear()
+    gitar.gitExecutor.invalidate()
+    gitar.diffCache.clear()
+    gitar.mergeCache.clear()
+
+def record(results, name, times):
+    results[name] = {"median": statistics.median(times), "min": min(times), "runs": len(times)}
+    print("%-40s median %8.4fs  min %8.4fs"%(name, results[name]["median"], results[name]["min"]), file=sys.stderr)
+
+def measure(results, name, func, repeat, reset=None):
+    times = []
+    for r in range(repeat):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+    record(results, name, times)
+
+def measureStartup(results, repeat):
+    """Starts gitar with --startup-time, which reports the time to the first paint and to the file list."""
+    paints, fileLists = [], []
+    for r in range(repeat):
+        process = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gitar.py"),
+                                  "--startup-time", "main", "feature"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        report = [l for l in process.stderr.decode().splitlines() if l.startswith("startup:")]
+        if not report:
+            raise RuntimeError("gitar --startup-time failed")
+        numbers = re.findall(r"([0-9.]+) ms", report[0])
+        paints.append(float(numbers[0])/1000)
+        fileLists.append(float(numbers[1])/1000)
+    record(results, "startup first paint", paints)
+    record(results, "startup file list", fileLists)
+
+def runBenchmarks(path, repeat):
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(["benchmark"])
+    os.chdir(path)
+    gitpath = gitar.getGitToplevelDir()
+    gitar.diffPool.submit(len, ((),)).wait() # start the workers before timing
+    results = {}
+
+    measureStartup(results, repeat)
+    files = [path2 for path1, path2 in gitar.getChangedFilesFromGit(gitpath, "main", "feature")]
+    sourceFiles = [f for f in files if f.startswith("src/")][:200]
+    measure(results, "getChangedFilesFromGit", lambda: gitar.getChangedFilesFromGit(gitpath, "main", "feature"), repeat, resetCaches)
+    measure(results, "getDivergedFiles", lambda: gitar.getDivergedFiles(gitpath, "feature", "other"), repeat, resetCaches)
+    divergedFiles = [path2 for path1, path2 in gitar.getDivergedFiles(gitpath, "feature", "other")][:20]
+    loadMerged = lambda: [gitar.loadMergedFiles(gitpath, "feature", "other", f, timeout=None) for f in divergedFiles]
+    measure(results, "loadMergedFiles 20 diverged files cold", loadMerged, repeat, resetCaches)
+    measure(results, "loadMergedFiles 20 diverged files cached", loadMerged, repeat)
+    measure(results, "getDiffNumstat", lambda: gitar.getDiffNumstat(gitpath, "main", "feature"), repeat, resetCaches)
+    readFiles = lambda: [gitar.getFromGit(gitpath, "feature", f) for f in sourceFiles]
+    measure(results, "getFromGit 200 files cold", readFiles, repeat, resetCaches)
+    measure(results, "getFromGit 200 files warm", readFiles, repeat)
+    measure(results, "getFromGit huge file cold", lambda: gitar.getFromGit(gitpath, "feature", "huge.txt"), repeat, resetCaches)
+
+    pairs = {name: (gitar.getFromGit(gitpath, "main", name), gitar.getFromGit(gitpath, "feature", name))
+             for name in ("huge.txt", "pathological.txt", sourceFiles[0])}
+    for name, (lines1, lines2) in pairs.items():
+        measure(results, "aligner %s"%name, lambda: gitar.aligner(lines1, lines2, timeout=None), repeat)
+    measure(results, "alignLargeFiles huge.txt", lambda: gitar.alignLargeFiles(*pairs["huge.txt"]), repeat)
+    minified = minifiedFiles(random.Random(1), 2000, 3000)
+    measure(results, "aligner minified lines", lambda: gitar.aligner(*minified, timeout=None), repeat)
+    alignedMinified = gitar.alignLines(*minified)
+    screen = [r for r, flag in enumerate(alignedMinified.flags) if flag == gitar.CHANGED][:60]
+    def markScreen():
+        gitar.markIntraline.cache_clear()
+        [alignedMinified.rowMarks(1, r) for r in screen]
+    measure(results, "markIntraline 60 minified rows", markScreen, repeat)
+    aligned = gitar.alignLines(*pairs["huge.txt"])
+
+    measure(results, "getGitBlame history.txt cold", lambda: gitar.getGitBlame("main", "history.txt"), repeat, resetCaches)
+    measure(results, "getGitBlame history.txt cached", lambda: gitar.getGitBlame("main", "history.txt"), repeat)
+    measure(results, "getGitLog main", lambda: gitar.getGitLog("main"), repeat, resetCaches)
+    measure(results, "getGitLog main history.txt", lambda: gitar.getGitLog("main", "history.txt"), repeat, resetCaches)
+    measure(results, "getFileHistory main history.txt", lambda: gitar.getFileHistory(gitpath, "main", "history.txt"), repeat, resetCaches)
+    steps = gitar.getFileHistory(gitpath, "main", "history.txt")[-20:]
+    measure(results, "loadAlignedFiles 20 history steps", lambda: [gitar.loadAlignedFiles(gitpath, s[0]+"^", s[0], "history.txt")
+                                                                   for s in steps], repeat, resetCaches)
+    measure(results, "loadAlignedBlobs 20 history steps", lambda: [gitar.loadAlignedBlobs(gitpath, s[5], s[6]) for s in steps],
+            repeat, resetCaches)
+
+    editor = gitar.EditorWidget()
+    def updateText():
+        editor.updateText(aligned, 0, "main", "huge.txt", fileSuffix="txt")
+        app.processEvents()
+    measure(results, "EditorWidget.updateText huge file", updateText, repeat)
+
+    model = gitar.FileListModel()
+    manyFiles = ["src/d%03i/file%06i.c"%(i%500, i) for i in range(100000)]
+    measure(results, "FileListModel 100000 files", lambda: model.setFiles(list(manyFiles), {}), repeat)
+    measure(results, "FileListModel filter 100000 files", lambda: [model.setFilter(text) for text in ("d0", "d01", "d012", "")], repeat)
+
+    thread = gitar.FileListUpdateThread(None)
+    def sizeFileList():
+        thread.startSizing(files, gitpath, "main", "feature")
+        thread.waitUntilIdle()
+    measure(results, "FileListUpdateThread %i files"%len(files), sizeFileList, max(1, repeat//2), resetCaches)
+    measure(results, "FileListUpdateThread from diff cache", sizeFileList, repeat)
+    thread.stop()
+    return results
+
+def gitVersion():
+    return subprocess.check_output(["git", "--version"]).decode().strip()
+
+def compareWithBaseline(results, baseline, tolerance):
+    """Returns the stages that are slower than in the baseline by more than the tolerance."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is None:
+            print("%-40s new stage"%name, file=sys.stderr)
+            continue
+        ratio = result["median"]/reference["median"] if reference["median"] > 0 else 1.0
+        slower = ratio > 1+tolerance and result["median"]-reference["median"] > NOISE_SECONDS
+        print("%-40s %6.2fx %s"%(name, ratio, "REGRESSION" if slower else ""), file=sys.stderr)
+        if slower:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of gitar on a synthetic repository")
+    parser.add_argument("--scale", type=float, default=1.0, help="size of the synthetic repository (1.0: 3000 files, 2000 commits, 100k line file)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the median is compared")
+    parser.add_argument("--workdir", default=tempfile.gettempdir(), help="where the synthetic repository is kept")
+    parser.add_argument("--regenerate", action="store_true", help="generate the repository again")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown relative to the baseline")
+    args = parser.parse_args()
+
+    path = os.path.join(os.path.abspath(args.workdir), "gitar-benchmark-%g"%args.scale)
+    if args.regenerate or not os.path.exists(os.path.join(path, ".git", "gitar-benchmark-complete")):
+        if os.path.exists(path):
+            subprocess.check_call(["rm", "-rf", path])
+        print("generating", path, file=sys.stderr)
+        createRepository(path, args.scale)
+    # gitar prints progress on stdout, which is reserved for the results
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    results = runBenchmarks(path, args.repeat)
+    sys.stdout = stdout
+    report = {"environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                              "git": gitVersion(), "scale": args.scale, "algorithm": gitar.DIFF_ALGORITHM},
+              "results": results}
+    json.dump(report, sys.stdout, indent=1)
+    print()
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        baseline = json.load(open(args.baseline))
+        if baseline.get("environment", {}).get("scale") != args.scale:
+            print("baseline was measured with a different scale, not comparing", file=sys.stderr)
+        else:
+            regressions = compareWithBaseline(results, baseline["results"], args.tolerance)
+    if args.save_baseline:
+        json.dump(report, open(args.baseline, "w"), indent=1)
+        print("saved baseline", args.baseline, file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -1,7 +1,8 @@
 #!/usr/bin/python3
 from __future__ import generator_stop
 import sys
-from PyQt5 import Qt
+import time
+STARTED = time.perf_counter() # for measuring the time until the window is first painted
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -10,47 +11,619 @@ from PyQt5.Qsci import *
 import difflib
 import os, sys, subprocess,  os.path
 import re
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
 
 import traceback
-import time 
+import datetime
+import threading
+import queue
+import atexit
+import shlex
+import concurrent.futures
+import mmap
+import struct
+import zlib
+import tempfile
+import select
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import html
 
 import multiprocessing
-from multiprocessing import Process, Queue
+import multiprocessing.connection
 import functools
+import heapq
+import bisect
+import itertools
+from array import array
 
-def result_as_param(func, queue, *args, **kwargs):
-    result = (func(*args, **kwargs))
-    queue.put(result)
-
-def timeout(max_timeout):
-    """Timeout decorator, parameter in seconds."""
-    def timeout_decorator(item):
-        """Wrap the original function."""
-        @functools.wraps(item)
-        def func_wrapper(*args, **kwargs):
-            """Closure for function."""
-            queue = Queue()
-            p = multiprocessing.Process(target=result_as_param, args=[item, queue]+list(args), kwargs=kwargs)
-            p.start()
-
-            # Wait for timeout or until process finishes
-            p.join(max_timeout)
-            result = None
-            try:
-                result =  queue.get(timeout = max_timeout)
-            except:
-                print("time out!")
-                p.terminate()
-            p.join()
-            return result
-            
-            
-        return func_wrapper
-    return timeout_decorator
-    
-@timeout(0.5)  
-def aligner(lines1, lines2):
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# timed spans kept for the trace export, older ones are dropped
+TRACE_MAX_EVENTS = 200000
+# span categories summed up in the status bar
+TRACE_SUMMARY_CATEGORIES = ("git", "align", "render")
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NO_SPAN = NoSpan()
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer, self.name, self.category, self.args = tracer, name, category, args
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        # spans inside a span of the same category or of background work are exported, but not summed up
+        self.nested = self.category in stack or "background" in stack
+        stack.append(self.category)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        self.tracer.stack().pop()
+        self.tracer.record(self.name, self.category, self.start, end, self.args, nested=self.nested)
+        return False
+
+class Tracer:
+    """Records timed spans of git calls, alignments, rendering and background jobs while enabled,
+    for the timing summary in the status bar and for export as a Chrome trace (chrome://tracing, Perfetto)."""
+    def __init__(self, maxEvents=TRACE_MAX_EVENTS):
+        self.enabled = False
+        self.events = deque(maxlen=maxEvents) # (name, category, start, end, pid, tid, args, nested)
+        self.lock = threading.Lock() # other threads record spans while the events are read
+        self.threadNames = {}
+        self.processNames = {os.getpid(): "gitar"}
+        self.local = threading.local()
+        self.origin = STARTED # trace times count from the start of gitar, like the first paint
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, category, **args):
+        """Context manager timing the enclosed code, does nothing while tracing is disabled."""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, category, args)
+
+    def record(self, name, category, start, end, args=None, pid=None, tid=None, nested=False):
+        if tid is None:
+            tid = threading.get_ident()
+            self.threadNames[tid] = threading.current_thread().name
+        with self.lock:
+            self.events.append((name, category, start, end, pid or os.getpid(), tid, args, nested))
+
+    def snapshot(self):
+        """Returns a copy of the recorded events."""
+        with self.lock:
+            return list(self.events)
+
+    def beginOperation(self, name):
+        """Starts a user-visible operation, which may continue in other threads until endOperation."""
+        return name, time.perf_counter()
+
+    def endOperation(self, operation):
+        """Records the operation and returns its summary text, None while tracing is disabled."""
+        if not self.enabled:
+            return None
+        name, start = operation
+        end = time.perf_counter()
+        self.record(name, "operation", start, end)
+        totals = self.summary(start, end)
+        parts = ["%s %i ms"%(category, totals[category]*1000) for category in TRACE_SUMMARY_CATEGORIES if category in totals]
+        return "%s: %i ms (%s)"%(name, (end-start)*1000, ", ".join(parts) or "no spans")
+
+    def summary(self, start, end):
+        """Returns {category: seconds} of the interval [start, end] covered by spans of each category,
+        parallel spans are counted once."""
+        intervals = defaultdict(list)
+        for name, category, s, e, pid, tid, args, nested in reversed(self.snapshot()):
+            if e < start:
+                break # events are appended when they end
+            if not nested and s < end:
+                intervals[category].append((max(s, start), min(e, end)))
+        totals = {}
+        for category, spans in intervals.items():
+            total = 0.0
+            covered = start
+            for s, e in sorted(spans):
+                if e > covered:
+                    total += e-max(s, covered)
+                    covered = e
+            totals[category] = total
+        return totals
+
+    def exportChromeTrace(self, path):
+        """Writes the recorded spans in the Chrome trace event format."""
+        trace = []
+        for name, category, start, end, pid, tid, args, nested in self.snapshot():
+            trace.append({"name": name, "cat": category, "ph": "X", "ts": (start-self.origin)*1e6,
+                          "dur": (end-start)*1e6, "pid": pid, "tid": tid, "args": args or {}})
+        for pid, name in list(self.processNames.items()):
+            trace.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}})
+        for tid, name in list(self.threadNames.items()):
+            trace.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        print("wrote trace", path)
+
+tracer = Tracer()
+
+def traced(category, name=None):
+    """Decorator recording a span for every call of the function while tracing is enabled."""
+    def decorate(func):
+        spanName = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with Span(tracer, spanName, category, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# GITAR_TRACE=file.json traces from the start and writes the trace on exit, the variable
+# is removed so that worker processes do not write the file as well
+if os.environ.get("GITAR_TRACE"):
+    tracer.enabled = True
+    atexit.register(functools.partial(tracer.exportChromeTrace, os.environ.pop("GITAR_TRACE")))
+
+# line diff algorithm used by the aligner: "histogram", "patience", "myers" or "difflib",
+# can be set with the environment variable GITAR_DIFF_ALGORITHM
+DIFF_ALGORITHM = os.environ.get("GITAR_DIFF_ALGORITHM", "histogram")
+HISTOGRAM_MAX_CHAIN = 64    # lines occurring more often are not used as histogram split points
+INTRALINE_MAX_LENGTH = 20000 # longer line pairs are marked as changed as a whole
+INTRALINE_CACHE_SIZE = 4096  # changed line pairs whose marks are kept
+INTRALINE_TOKEN = re.compile(r"\w+|\s+|[^\w\s]") # words, runs of white space and single other characters
+
+def internLines(lines1, lines2):
+    """Maps every distinct line to an integer ID, returns the ID lists of both files."""
+    ids = {}
+    ids1 = [ids.setdefault(l, len(ids)) for l in lines1]
+    ids2 = [ids.setdefault(l, len(ids)) for l in lines2]
+    return ids1, ids2
+
+@functools.lru_cache(maxsize=None)
+def numpyModule():
+    """Returns NumPy if it is installed. It is imported on first use, which keeps it out of the startup."""
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+def commonAffixes(ids1, ids2):
+    """Returns the lengths of the common prefix and suffix of two ID lists."""
+    n = min(len(ids1), len(ids2))
+    numpy = numpyModule() if n > 64 else None
+    if numpy is not None:
+        a = numpy.asarray(ids1, dtype=numpy.int64)
+        b = numpy.asarray(ids2, dtype=numpy.int64)
+        differs = a[:n] != b[:n]
+        prefix = int(numpy.argmax(differs)) if differs.any() else n
+        differs = a[len(a)-n+prefix:][::-1] != b[len(b)-n+prefix:][::-1]
+        suffix = int(numpy.argmax(differs)) if differs.any() else n-prefix
+        return prefix, suffix
+    prefix = 0
+    while prefix < n and ids1[prefix] == ids2[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n-prefix and ids1[-1-suffix] == ids2[-1-suffix]:
+        suffix += 1
+    return prefix, suffix
+
+def _trim(a, alo, ahi, b, blo, bhi, matches):
+    # strip common prefix and suffix of a region, recording them as matches
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        matches.append((alo, blo))
+        alo += 1
+        blo += 1
+    while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+        ahi -= 1
+        bhi -= 1
+        matches.append((ahi, bhi))
+    return alo, ahi, blo, bhi
+
+def _middleSnake(a, alo, ahi, b, blo, bhi):
+    # Myers' linear space middle snake, returns start and end of the snake in absolute coordinates
+    N = ahi-alo
+    M = bhi-blo
+    delta = N-M
+    odd = delta & 1
+    maxd = (N+M+1)//2
+    offset = maxd+1
+    vf = [0]*(2*offset+1)
+    vb = [0]*(2*offset+1)
+    # like git, give up on the optimal path beyond a cost limit and split at the furthest reaching point
+    maxCost = max(256, int((N+M)**0.5))
+    for d in range(maxd+1):
+        if d > maxCost:
+            # only points inside the region, and not its end, split it into smaller problems
+            inside = [k for k in range(-d+1, d, 2) if vf[offset+k] <= N and 0 <= vf[offset+k]-k <= M and 0 < 2*vf[offset+k]-k < N+M]
+            if not inside:
+                return alo+N//2, blo+M//2, alo+N//2, blo+M//2
+            k = max(inside, key=lambda k: 2*vf[offset+k]-k)
+            x = vf[offset+k]
+            return alo+x, blo+x-k, alo+x, blo+x-k
+        for k in range(-d, d+1, 2):
+            if k == -d or (k != d and vf[offset+k-1] < vf[offset+k+1]):
+                x = vf[offset+k+1]
+            else:
+                x = vf[offset+k-1]+1
+            y = x-k
+            x0, y0 = x, y
+            while x < N and y < M and a[alo+x] == b[blo+y]:
+                x += 1
+                y += 1
+            vf[offset+k] = x
+            if odd and -(d-1) <= delta-k <= d-1 and x+vb[offset+delta-k] >= N:
+                return alo+x0, blo+y0, alo+x, blo+y
+        for k in range(-d, d+1, 2):
+            if k == -d or (k != d and vb[offset+k-1] < vb[offset+k+1]):
+                x = vb[offset+k+1]
+            else:
+                x = vb[offset+k-1]+1
+            y = x-k
+            x0, y0 = x, y
+            while x < N and y < M and a[ahi-1-x] == b[bhi-1-y]:
+                x += 1
+                y += 1
+            vb[offset+k] = x
+            if not odd and -d <= delta-k <= d and x+vf[offset+delta-k] >= N:
+                return ahi-x, bhi-y, ahi-x0, bhi-y0
+    return alo, blo, alo, blo
+
+def _myersMatches(a, alo, ahi, b, blo, bhi, matches):
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        alo, ahi, blo, bhi = _trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi or set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+            continue
+        x0, y0, x1, y1 = _middleSnake(a, alo, ahi, b, blo, bhi)
+        for i in range(x1-x0):
+            matches.append((x0+i, y0+i))
+        stack.append((alo, x0, blo, y0))
+        stack.append((x1, ahi, y1, bhi))
+
+def _longestIncreasing(pairs):
+    # longest subsequence of (i, j) pairs (sorted by i) with increasing j, patience sorting
+    tails = []
+    tailIndex = []
+    previous = [None]*len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo+hi)//2
+            if tails[mid] < j:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo > 0:
+            previous[n] = tailIndex[lo-1]
+        if lo == len(tails):
+            tails.append(j)
+            tailIndex.append(n)
+        else:
+            tails[lo] = j
+            tailIndex[lo] = n
+    result = []
+    n = tailIndex[-1] if tailIndex else None
+    while n is not None:
+        result.append(pairs[n])
+        n = previous[n]
+    return result[::-1]
+
+def _patienceMatches(a, alo, ahi, b, blo, bhi, matches):
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        alo, ahi, blo, bhi = _trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi:
+            continue
+        positions = {}
+        for i in range(alo, ahi):
+            positions[a[i]] = -1 if a[i] in positions else i
+        unique = {}
+        for j in range(blo, bhi):
+            i = positions.get(b[j], -1)
+            if i >= 0:
+                unique[b[j]] = None if b[j] in unique else (i, j)
+        anchors = _longestIncreasing(sorted(p for p in unique.values() if p is not None))
+        if not anchors:
+            _myersMatches(a, alo, ahi, b, blo, bhi, matches)
+            continue
+        lastI, lastJ = alo, blo
+        for i, j in anchors:
+            matches.append((i, j))
+            stack.append((lastI, i, lastJ, j))
+            lastI, lastJ = i+1, j+1
+        stack.append((lastI, ahi, lastJ, bhi))
+
+def _histogramMatches(a, alo, ahi, b, blo, bhi, matches):
+    stack = [(alo, ahi, blo, bhi)]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        alo, ahi, blo, bhi = _trim(a, alo, ahi, b, blo, bhi, matches)
+        if alo == ahi or blo == bhi:
+            continue
+        occurrences = defaultdict(list)
+        for i in range(alo, ahi):
+            occurrences[a[i]].append(i)
+        # find the longest common region that contains a line with the fewest occurrences in a
+        best = None
+        bestCount = HISTOGRAM_MAX_CHAIN+1
+        j = blo
+        while j < bhi:
+            candidates = occurrences.get(b[j])
+            if candidates is None or len(candidates) > bestCount:
+                j += 1
+                continue
+            nextJ = j+1
+            for i in candidates:
+                start_i, start_j = i, j
+                while start_i > alo and start_j > blo and a[start_i-1] == b[start_j-1]:
+                    start_i -= 1
+                    start_j -= 1
+                end_i, end_j = i+1, j+1
+                count = len(candidates)
+                while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                    count = min(count, len(occurrences[a[end_i]]))
+                    end_i += 1
+                    end_j += 1
+                nextJ = max(nextJ, end_j)
+                if best is None or count < bestCount or (count == bestCount and end_i-start_i > best[1]-best[0]):
+                    best = (start_i, end_i, start_j, end_j)
+                    bestCount = count
+            j = nextJ
+        if best is None:
+            _myersMatches(a, alo, ahi, b, blo, bhi, matches)
+            continue
+        start_i, end_i, start_j, end_j = best
+        for k in range(end_i-start_i):
+            matches.append((start_i+k, start_j+k))
+        stack.append((alo, start_i, blo, start_j))
+        stack.append((end_i, ahi, end_j, bhi))
+
+diffAlgorithms = {"myers": _myersMatches, "patience": _patienceMatches, "histogram": _histogramMatches}
+
+def diffOpcodes(lines1, lines2, algorithm=DIFF_ALGORITHM):
+    """Line diff of two files as SequenceMatcher style opcodes (tag, i1, i2, j1, j2)."""
+    a, b = internLines(lines1, lines2)
+    prefix, suffix = commonAffixes(a, b)
+    matches = [(i, i) for i in range(prefix)]
+    matches.extend((len(a)-suffix+i, len(b)-suffix+i) for i in range(suffix))
+    diffAlgorithms[algorithm](a, b=b, alo=prefix, ahi=len(a)-suffix, blo=prefix, bhi=len(b)-suffix, matches=matches)
+    matches.sort()
+    opcodes = []
+    i = j = 0
+    for mi, mj in matches+[(len(a), len(b))]:
+        if mi > i or mj > j:
+            tag = "replace" if mi > i and mj > j else ("delete" if mi > i else "insert")
+            opcodes.append((tag, i, mi, j, mj))
+        if mi < len(a):
+            if opcodes and opcodes[-1][0] == "equal" and opcodes[-1][2] == mi:
+                opcodes[-1] = ("equal", opcodes[-1][1], mi+1, opcodes[-1][3], mj+1)
+            else:
+                opcodes.append(("equal", mi, mi+1, mj, mj+1))
+        i, j = mi+1, mj+1
+    return opcodes
+
+@functools.lru_cache(maxsize=INTRALINE_CACHE_SIZE)
+def markIntraline(line1, line2):
+    """Returns the changed characters of a changed line pair as flat (start, end, start, end, ...)
+    offsets into each line. The lines are compared token by token (see INTRALINE_TOKEN) with the
+    line diff; this only runs for the rows that are shown, not in the aligner."""
+    line1 = line1.rstrip('\n')
+    line2 = line2.rstrip('\n')
+    if len(line1)+len(line2) > INTRALINE_MAX_LENGTH:
+        return (0, len(line1)), (0, len(line2))
+    tokens1 = INTRALINE_TOKEN.findall(line1)
+    tokens2 = INTRALINE_TOKEN.findall(line2)
+    starts1 = [0]+list(itertools.accumulate(map(len, tokens1)))
+    starts2 = [0]+list(itertools.accumulate(map(len, tokens2)))
+    left, right = [], []
+    for tag, i1, i2, j1, j2 in diffOpcodes(tokens1, tokens2, "histogram"):
+        if tag == "equal":
+            continue
+        if i2 > i1:
+            left += (starts1[i1], starts1[i2])
+        if j2 > j1:
+            right += (starts2[j1], starts2[j2])
+    return tuple(left), tuple(right)
+
+# row flags of an AlignedDiff
+UNCHANGED, CHANGED, GAP = 0, 1, 2
+
+class AlignedDiff:
+    """Side-by-side alignment of two files. Row r shows line left[r] of lines1 and line right[r]
+    of lines2, -1 where a side has no line. flags[r] is UNCHANGED, CHANGED or GAP (lines of a huge
+    file left out of an excerpt, gaps[r] holds their ranges (i1, i2, j1, j2)). The changed characters
+    of changed rows are computed when they are needed, see rowMarks; marks[r] holds them where the
+    line diff already provided them (difflib). The lines are not pickled: results of the diff
+    workers get them back with withLines()."""
+    def __init__(self, lines1=(), lines2=()):
+        self.lines1 = lines1
+        self.lines2 = lines2
+        self.left = array('i')
+        self.right = array('i')
+        self.flags = array('b')
+        self.marks = {}
+        self.gaps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lines1"] = state["lines2"] = None
+        return state
+
+    def withLines(self, lines1, lines2):
+        self.lines1 = lines1
+        self.lines2 = lines2
+        return self
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __eq__(self, other):
+        return (isinstance(other, AlignedDiff) and self.left == other.left and self.right == other.right and
+                self.flags == other.flags and self.gaps == other.gaps)
+
+    @property
+    def excerpt(self):
+        return bool(self.gaps)
+
+    @property
+    def readOnly(self):
+        """Excerpts are only shown, their lines are not the lines of the files."""
+        return self.excerpt
+
+    def changes(self):
+        """Returns the number of changed rows."""
+        return self.flags.count(CHANGED)
+
+    def appendEqual(self, i1, i2, j1):
+        self.left.extend(range(i1, i2))
+        self.right.extend(range(j1, j1+i2-i1))
+        self.flags.frombytes(bytes(i2-i1))
+
+    def appendChanged(self, i1, i2, j1, j2):
+        """Appends the rows of a changed block, pairing its lines in order."""
+        rows = max(i2-i1, j2-j1)
+        self.left.extend(range(i1, i2))
+        self.left.extend([-1]*(rows-(i2-i1)))
+        self.right.extend(range(j1, j2))
+        self.right.extend([-1]*(rows-(j2-j1)))
+        self.flags.frombytes(bytes([CHANGED])*rows)
+
+    def appendRow(self, i, j, flag, marks=None):
+        if marks is not None and (marks[0] or marks[1]):
+            self.marks[len(self.flags)] = marks
+        self.left.append(i)
+        self.right.append(j)
+        self.flags.append(flag)
+
+    def appendGap(self, i1, i2, j1, j2):
+        self.gaps[len(self.flags)] = (i1, i2, j1, j2)
+        self.appendRow(-1, -1, GAP)
+
+    def column(self, side):
+        """Returns the line indices and the lines of side 0 (left) or 1 (right)."""
+        return (self.left, self.lines1) if side == 0 else (self.right, self.lines2)
+
+    def sideFlags(self, side):
+        """Returns the flags of the rows as shown on side."""
+        return self.flags
+
+    def text(self, side, row):
+        """Returns the text shown in row on side, None if the side has no line there."""
+        indices, lines = self.column(side)
+        if indices[row] >= 0:
+            return lines[indices[row]]
+        if self.flags[row] == GAP:
+            i1, i2 = self.gaps[row][2*side:2*side+2]
+            return EXCERPT_GAP%(i1+1, i2) if i2 > i1 else None
+        return None
+
+    def rowMarks(self, side, row):
+        """Returns the offsets of the changed characters of the line in row on side. Lines of
+        changed rows without a counterpart are changed as a whole, line pairs are compared with
+        markIntraline."""
+        marks = self.marks.get(row)
+        if marks is not None:
+            return marks[side]
+        if self.flags[row] != CHANGED:
+            return ()
+        i, j = self.left[row], self.right[row]
+        if i >= 0 and j >= 0:
+            return markIntraline(self.lines1[i], self.lines2[j])[side]
+        line = self.text(side, row)
+        return (0, len(line)) if line is not None else ()
+
+    def linesBefore(self, side, row):
+        """Returns the number of lines of side shown above row."""
+        indices = self.column(side)[0]
+        for r in range(row-1, -1, -1):
+            if indices[r] >= 0:
+                return indices[r]+1
+        return 0
+
+    def editedRows(self, side, lines):
+        """Returns the range of rows whose lines on side differ from lines, None if none do."""
+        indices, old = self.column(side)
+        prefix = 0
+        while prefix < len(old) and prefix < len(lines) and old[prefix] == lines[prefix]:
+            prefix += 1
+        if prefix == len(old) == len(lines):
+            return None
+        suffix = 0
+        while suffix < len(old)-prefix and suffix < len(lines)-prefix and old[-1-suffix] == lines[-1-suffix]:
+            suffix += 1
+        rowStart = indices.index(prefix) if prefix < len(old) else len(self)
+        rowEnd = indices.index(len(old)-suffix) if suffix > 0 else len(self)
+        return rowStart, rowEnd
+
+    def splice(self, rowStart, rowEnd, window, lines1, lines2):
+        """Returns the diff of the edited files lines1 and lines2, with the rows [rowStart, rowEnd)
+        replaced by window, the alignment of the lines in between."""
+        result = AlignedDiff(lines1, lines2)
+        rowShift = len(window)-(rowEnd-rowStart)
+        for side, lines in ((0, lines1), (1, lines2)):
+            indices = self.column(side)[0]
+            lineStart = self.linesBefore(side, rowStart)
+            lineShift = len(lines)-len(self.column(side)[1])
+            spliced = indices[:rowStart]
+            spliced.extend(i+lineStart if i >= 0 else -1 for i in window.column(side)[0])
+            spliced.extend(i+lineShift if i >= 0 else -1 for i in indices[rowEnd:])
+            if side == 0:
+                result.left = spliced
+            else:
+                result.right = spliced
+        result.flags = self.flags[:rowStart]+window.flags+self.flags[rowEnd:]
+        for old, new in ((self.marks, result.marks), (self.gaps, result.gaps)):
+            new.update((r, v) for r, v in old.items() if r < rowStart)
+            new.update((r+rowShift, v) for r, v in old.items() if r >= rowEnd)
+        result.marks.update((r+rowStart, v) for r, v in window.marks.items())
+        return result
+
+    @classmethod
+    def fromMarked(cls, lines1, lines2, fromlist, tolist, flaglist):
+        """Converts the marked lines of difflib._mdiff (see alignLinesDifflib)."""
+        aligned = cls(lines1, lines2)
+        i = j = 0
+        for left, right, flag in zip(fromlist, tolist, flaglist):
+            marks = (markedRanges(left) if left is not None else (), markedRanges(right) if right is not None else ())
+            aligned.appendRow(i if left is not None else -1, j if right is not None else -1,
+                              CHANGED if flag else UNCHANGED, marks)
+            i += left is not None
+            j += right is not None
+        return aligned
+
+def alignLines(lines1, lines2, algorithm=DIFF_ALGORITHM):
+    """Aligns two files side by side, returns an AlignedDiff."""
+    if algorithm == "difflib":
+        return AlignedDiff.fromMarked(lines1, lines2, *alignLinesDifflib(lines1, lines2))
+    aligned = AlignedDiff(lines1, lines2)
+    for tag, i1, i2, j1, j2 in diffOpcodes(lines1, lines2, algorithm):
+        if tag == "equal":
+            aligned.appendEqual(i1, i2, j1)
+        else:
+            aligned.appendChanged(i1, i2, j1, j2)
+    return aligned
+
+def alignLinesDifflib(lines1, lines2):
     diffs = difflib._mdiff(lines1, lines2)
     fromlist, tolist, flaglist = [], [], []
     # pull from/to data and flags from mdiff style iterator
@@ -78,106 +651,2302 @@ def aligner(lines1, lines2):
     #    print([l])
     return fromlist, tolist, flaglist
 
-class cd:
-    """Context manager for changing the current working directory"""
-    def __init__(self, newPath):
-        self.newPath = os.path.expanduser(newPath)
+def coarseAlign(lines1, lines2):
+    """Degraded alignment in linear time: common prefix and suffix are matched, everything in between is marked as changed."""
+    prefix = 0
+    while prefix < len(lines1) and prefix < len(lines2) and lines1[prefix] == lines2[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(lines1)-prefix and suffix < len(lines2)-prefix and lines1[-1-suffix] == lines2[-1-suffix]:
+        suffix += 1
+    aligned = AlignedDiff(lines1, lines2)
+    aligned.appendEqual(0, prefix, 0)
+    end1 = len(lines1)-suffix
+    end2 = len(lines2)-suffix
+    aligned.appendChanged(prefix, end1, prefix, end2)
+    aligned.appendEqual(end1, len(lines1), end2)
+    return aligned
 
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
+# rows of an AlignedMerge that both sides changed differently
+CONFLICT = 3
+
+class AlignedMerge(AlignedDiff):
+    """Three-way alignment of two files with their merge base. Row r shows line left[r] of lines1,
+    right[r] of lines2 and base[r] of baseLines (side 2). sides[r] has bit 0 set if the left line
+    differs from the base, bit 1 if the right line does. flags[r] is UNCHANGED, CHANGED, or CONFLICT
+    where both sides changed the base differently. Merges are only shown, not edited."""
+    readOnly = True
+
+    def __init__(self, lines1=(), lines2=(), baseLines=()):
+        AlignedDiff.__init__(self, lines1, lines2)
+        self.baseLines = baseLines
+        self.base = array('i')
+        self.sides = array('b')
+
+    def changes(self):
+        """Returns the number of rows changed on either side."""
+        return len(self.flags)-self.flags.count(UNCHANGED)
+
+    def conflicts(self):
+        return self.flags.count(CONFLICT)
+
+    def appendUnchanged(self, i, j, k, count):
+        self.left.extend(range(i, i+count))
+        self.right.extend(range(j, j+count))
+        self.base.extend(range(k, k+count))
+        self.flags.frombytes(bytes(count))
+        self.sides.frombytes(bytes(count))
+
+    def appendMerged(self, i, j, k, flag, sides):
+        self.left.append(i)
+        self.right.append(j)
+        self.base.append(k)
+        self.flags.append(flag)
+        self.sides.append(sides)
+
+    def column(self, side):
+        """Returns the line indices and the lines of side 0 (left), 1 (right) or 2 (base)."""
+        return (self.base, self.baseLines) if side == 2 else AlignedDiff.column(self, side)
+
+    def sideFlags(self, side):
+        if side == 2:
+            return self.flags
+        bit = 1 << side
+        return array('b', (flag if sides & bit else UNCHANGED for flag, sides in zip(self.flags, self.sides)))
+
+    def rowMarks(self, side, row):
+        """Returns the offsets of the characters of the line in row on side that differ from the
+        base, for the base those that differ from the side that changed it."""
+        sides = self.sides[row]
+        if side == 2:
+            other = 0 if sides & 1 else 1
+        else:
+            other = side
+        line = self.text(side, row)
+        if not sides & (1 << other) or line is None:
+            return ()
+        k = self.base[row]
+        i = self.column(other)[0][row]
+        if k < 0 or i < 0:
+            return (0, len(line))
+        return markIntraline(self.baseLines[k], self.column(other)[1][i])[0 if side == 2 else 1]
+
+def alignmentHunks(aligned):
+    """Returns the changed blocks of an AlignedDiff as (i1, i2, j1, j2, row1, row2): the lines of
+    both files and the rows they take."""
+    hunks = []
+    i = j = row = 0
+    for flag, run in itertools.groupby(aligned.flags):
+        rows = sum(1 for r in run)
+        i2 = i+rows-aligned.left[row:row+rows].count(-1)
+        j2 = j+rows-aligned.right[row:row+rows].count(-1)
+        if flag == CHANGED:
+            hunks.append((i, i2, j, j2, row, row+rows))
+        i, j, row = i2, j2, row+rows
+    return hunks
+
+def mergeAlignments(toLeft, toRight):
+    """Merges the alignments of the base with the left and with the right file (lines1 of both is
+    the base) into an AlignedMerge. Changes of both sides that overlap or touch in the base form
+    one block, which is a conflict unless both sides made the same change."""
+    merged = AlignedMerge(toLeft.lines2, toRight.lines2, toLeft.lines1)
+    hunks = sorted([h+(0,) for h in alignmentHunks(toLeft)]+[h+(1,) for h in alignmentHunks(toRight)])
+    i = j = k = 0 # next line of the left file, the right file and the base
+    n = 0
+    while n < len(hunks):
+        block = [hunks[n]]
+        start, end = hunks[n][:2]
+        n += 1
+        while n < len(hunks) and hunks[n][0] <= end:
+            block.append(hunks[n])
+            end = max(end, hunks[n][1])
+            n += 1
+        merged.appendUnchanged(i, j, k, start-k)
+        i, j, k = i+start-k, j+start-k, start
+        # outside of its own hunks, a side has the lines of the base
+        shifts = [0, 0]
+        for k1, k2, s1, s2, row1, row2, side in block:
+            shifts[side] += (s2-s1)-(k2-k1)
+        iEnd, jEnd = i+end-k+shifts[0], j+end-k+shifts[1]
+        if len(block) == 1:
+            # changed on one side only: its rows are the rows of that alignment
+            k1, k2, s1, s2, row1, row2, side = block[0]
+            aligned = toLeft if side == 0 else toRight
+            for base, line in zip(aligned.left[row1:row2], aligned.right[row1:row2]):
+                other = base-k+(j if side == 0 else i) if base >= 0 else -1
+                if side == 0:
+                    merged.appendMerged(line, other, base, CHANGED, 1)
+                else:
+                    merged.appendMerged(other, line, base, CHANGED, 2)
+        else:
+            flag = CHANGED if merged.lines1[i:iEnd] == merged.lines2[j:jEnd] else CONFLICT
+            for r in range(max(iEnd-i, jEnd-j, end-k)):
+                merged.appendMerged(i+r if i+r < iEnd else -1, j+r if j+r < jEnd else -1,
+                                    k+r if k+r < end else -1, flag, 3)
+        i, j, k = iEnd, jEnd, end
+    merged.appendUnchanged(i, j, k, len(merged.baseLines)-k)
+    return merged
+
+LARGE_ALIGN_CHUNK = 1024       # lines of each file compared at a time in huge-file mode
+LARGE_ALIGN_MAX_CHUNK = 65536  # chunks without common lines are widened up to this
+EXCERPT_CONTEXT = 5            # unchanged lines shown around each change of a huge file
+EXCERPT_HUNK_ROWS = 2000       # rows shown of one change
+EXCERPT_MAX_ROWS = 200000      # rows shown of the whole file
+EXCERPT_GAP = "\u22ef lines %i-%i not shown \u22ef\n"
+EXCERPT_GAP_LINES = re.compile("\u22ef lines \\d+-(\\d+) not shown")
+
+def largeFileHunks(lines1, lines2, cancelled=None):
+    """Yields the changed regions (i1, i2, j1, j2) of two long line sequences. They are compared
+    a chunk of lines at a time: each chunk is aligned on the lines that are unique in both chunks
+    (patience diff) and only accepted up to its last matching lines, the rest is compared again
+    with the following lines. Chunks without any common line are widened, and taken as changed
+    beyond LARGE_ALIGN_MAX_CHUNK."""
+    i = j = 0
+    chunk = LARGE_ALIGN_CHUNK
+    pending = None
+    while i < len(lines1) or j < len(lines2):
+        if cancelled is not None and cancelled.is_set():
+            return
+        if isinstance(lines1, LargeFile) and isinstance(lines2, LargeFile) and lines1.raw(i, i+chunk) == lines2.raw(j, j+chunk):
+            # identical bytes are identical lines, without decoding them
+            i, j = i+min(chunk, len(lines1)-i), j+min(chunk, len(lines2)-j)
+            continue
+        window1 = lines1[i:i+chunk]
+        window2 = lines2[j:j+chunk]
+        # skip the common prefix by bisection, so that chunks start at a difference
+        low, high = 0, min(len(window1), len(window2))
+        while low < high:
+            middle = (low+high+1)//2
+            if window1[low:middle] == window2[low:middle]:
+                low = middle
+            else:
+                high = middle-1
+        if low > 0:
+            i, j = i+low, j+low
+            continue
+        final = i+len(window1) == len(lines1) and j+len(window2) == len(lines2)
+        opcodes = diffOpcodes(window1, window2, "patience")
+        if not final:
+            last = max((k for k, op in enumerate(opcodes) if op[0] == "equal"), default=None)
+            if last is None and chunk < LARGE_ALIGN_MAX_CHUNK:
+                chunk *= 4
+                continue
+            if last is None:
+                opcodes = [("replace", 0, len(window1), 0, len(window2))]
+            else:
+                opcodes = opcodes[:last+1]
+        chunk = LARGE_ALIGN_CHUNK
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                continue
+            hunk = (i+i1, i+i2, j+j1, j+j2)
+            if pending is not None and pending[1] == hunk[0] and pending[3] == hunk[2]:
+                hunk = (pending[0], hunk[1], pending[2], hunk[3])
+            elif pending is not None:
+                yield pending
+            pending = hunk
+        i += opcodes[-1][2]
+        j += opcodes[-1][4]
+    if pending is not None:
+        yield pending
+
+def alignLargeFiles(lines1, lines2, cancelled=None):
+    """Aligns two huge files as an excerpt: only the changed regions are aligned, with
+    EXCERPT_CONTEXT unchanged lines around them. Lines that are not shown are replaced by one
+    GAP row. The AlignedDiff refers to lists of the shown lines, not to the files, and its gaps
+    hold the original line ranges. Returns None if cancelled."""
+    shown1, shown2 = [], []
+    aligned = AlignedDiff(shown1, shown2)
+    def show(rows1, rows2):
+        # returns where the rows start in the shown lines
+        start = (len(shown1), len(shown2))
+        shown1.extend(rows1)
+        shown2.extend(rows2)
+        return start
+    def unchanged(i1, i2, j1, head, tail):
+        # shows head lines at the start and tail lines at the end of an unchanged region
+        if i2-i1 <= head+tail+1:
+            head = i2-i1
+        rows = lines1[i1:i1+head]
+        k1, k2 = show(rows, rows)
+        aligned.appendEqual(k1, k1+len(rows), k2)
+        if head < i2-i1:
+            aligned.appendGap(i1+head, i2-tail, j1+head, j1+(i2-i1)-tail)
+            rows = lines1[i2-tail:i2]
+            k1, k2 = show(rows, rows)
+            aligned.appendEqual(k1, k1+len(rows), k2)
+    i = j = 0
+    for i1, i2, j1, j2 in largeFileHunks(lines1, lines2, cancelled):
+        if len(aligned) > EXCERPT_MAX_ROWS:
+            break
+        unchanged(i, i1, j, EXCERPT_CONTEXT if i > 0 else 0, EXCERPT_CONTEXT)
+        shown = min(max(i2-i1, j2-j1), EXCERPT_HUNK_ROWS)
+        block1 = lines1[i1:min(i2, i1+shown)]
+        block2 = lines2[j1:min(j2, j1+shown)]
+        k1, k2 = show(block1, block2)
+        aligned.appendChanged(k1, k1+len(block1), k2, k2+len(block2))
+        if shown < max(i2-i1, j2-j1):
+            aligned.appendGap(min(i2, i1+shown), i2, min(j2, j1+shown), j2)
+        i, j = i2, j2
+    if cancelled is not None and cancelled.is_set():
+        return None
+    if len(aligned) > EXCERPT_MAX_ROWS:
+        aligned.appendGap(i, len(lines1), j, len(lines2))
+    else:
+        unchanged(i, len(lines1), j, EXCERPT_CONTEXT if i > 0 else 0, 0)
+    return aligned
+
+MARKED_TEXT = re.compile('\0[-+^](.*?)\1', re.S)
+
+def markedRanges(line):
+    """Returns the offsets of the characters that difflib._mdiff enclosed by \\0+, \\0-, \\0^
+    and \\1 in a line, counted without the markers."""
+    ranges = []
+    removed = 0
+    for match in MARKED_TEXT.finditer(line):
+        start = match.start()-removed
+        ranges += (start, start+len(match.group(1)))
+        removed += 3
+    return tuple(ranges)
+
+def checkAlignment(lines1, lines2, aligned):
+    """Returns a list of problems of an aligned diff, empty if it is consistent with both files."""
+    problems = []
+    if not len(aligned.left) == len(aligned.right) == len(aligned.flags):
+        problems.append("columns have different lengths")
+    if [i for i in aligned.left if i >= 0] != list(range(len(lines1))):
+        problems.append("left side does not reproduce file 1")
+    if [j for j in aligned.right if j >= 0] != list(range(len(lines2))):
+        problems.append("right side does not reproduce file 2")
+    for i, j, flag in zip(aligned.left, aligned.right, aligned.flags):
+        if flag == UNCHANGED and (i < 0 or j < 0 or lines1[i] != lines2[j]):
+            problems.append("unchanged row differs")
+            break
+    for row in range(len(aligned)):
+        for side in (0, 1):
+            text = aligned.text(side, row) or ""
+            marks = aligned.rowMarks(side, row)
+            if list(marks) != sorted(marks) or any(m > len(text) for m in marks):
+                problems.append("changed characters outside of row %i"%row)
+    return problems
+
+def diffEngineSelfTest(filePairs, algorithms=("histogram", "patience", "myers")):
+    """Differential test of the diff engines against difflib. Returns the number of failures."""
+    failures = 0
+    for algorithm in algorithms:
+        identical = 0
+        changed = [0, 0]
+        elapsed = [0.0, 0.0]
+        for name, lines1, lines2 in filePairs:
+            t = time.time()
+            reference = alignLines(lines1, lines2, "difflib")
+            elapsed[0] += time.time()-t
+            t = time.time()
+            result = alignLines(lines1, lines2, algorithm)
+            elapsed[1] += time.time()-t
+            problems = checkAlignment(lines1, lines2, result)
+            # Myers finds a shortest edit script, it keeps at least as many lines as difflib
+            if algorithm == "myers" and result.flags.count(UNCHANGED) < reference.flags.count(UNCHANGED):
+                problems.append("fewer unchanged lines than difflib")
+            if problems:
+                failures += 1
+                print("FAIL", algorithm, name, ", ".join(problems))
+            identical += result == reference
+            changed[0] += reference.changes()
+            changed[1] += result.changes()
+        print("%-10s %i/%i identical to difflib, changed rows %i (difflib %i), %.3fs (difflib %.3fs)"%(
+            algorithm, identical, len(filePairs), changed[1], changed[0], elapsed[1], elapsed[0]))
+    return failures
+
+def randomFilePairs(count=200, seed=0):
+    """Random file pairs with insertions, deletions, moves and repeated lines for diffEngineSelfTest."""
+    import random
+    rng = random.Random(seed)
+    pairs = []
+    for n in range(count):
+        vocabulary = ["line %i\n"%i for i in range(rng.randint(1, 40))]+["\n", "}\n"]
+        lines1 = [rng.choice(vocabulary) for i in range(rng.randint(0, 80))]
+        lines2 = list(lines1)
+        for edit in range(rng.randint(0, 8)):
+            position = rng.randint(0, len(lines2))
+            operation = rng.random()
+            if operation < 0.4:
+                lines2[position:position] = [rng.choice(vocabulary) for i in range(rng.randint(1, 4))]
+            elif operation < 0.8:
+                del lines2[position:position+rng.randint(1, 4)]
+            elif position < len(lines2):
+                lines2[position] = lines2[position].rstrip("\n")+" changed\n"
+        pairs.append(("random%i"%n, lines1, lines2))
+    return pairs
+
+class DiffJobError:
+    """Sent back by a diff worker instead of the result of a job that raised an exception."""
+    def __init__(self, message):
+        self.message = message
+
+def diffWorkerMain(connection):
+    # loop of a diff worker process: receive (function, args), send back the result
+    while True:
+        try:
+            func, args = connection.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = func(*args)
+        except Exception as e:
+            traceback.print_exc()
+            result = DiffJobError("%s: %s"%(type(e).__name__, e))
+        try:
+            connection.send(result)
+        except OSError:
+            return # the pool has been shut down
+
+
+# job priorities, lower values are served first
+PRIORITY_VIEW = 0        # file shown in the editors
+PRIORITY_PREFETCH = 5    # neighbouring steps of the file history
+PRIORITY_BACKGROUND = 10 # file list sizing
+ALIGNER_TIMEOUT = 1.0    # seconds until a coarse diff is shown instead
+EDIT_DEBOUNCE_MS = 150   # delay after the last keystroke before the diff is updated
+INPROCESS_ALIGN_LINES = 2000 # smaller edit windows are re-aligned without the worker pool
+
+
+class DiffJob:
+    """Handle for a computation submitted to the DiffWorkerPool."""
+    def __init__(self, func, args, priority):
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.started = None
+        self.result = None
+        self.error = None # why the job failed, if it did
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Returns the result, or None if cancelled, failed (see error) or not finished within timeout."""
+        self.done.wait(timeout)
+        return self.result
+
+    def finish(self, result, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class DiffWorker:
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=diffWorkerMain, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.job = None
+
+    def kill(self):
+        self.process.terminate()
+        self.connection.close()
+        self.process.join()
+
+
+class DiffWorkerPool:
+    """Warm worker processes for diff computations, with priorities and cancellation of running jobs.
+    A running job is cancelled by killing its worker, which is replaced by a fresh process."""
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        # workers are forked from a separate server process: forking this multithreaded process directly would
+        # let workers inherit pipes that other threads are using for starting git
+        self.context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+        if self.context.get_start_method() == "forkserver":
+            # import this module once in the server instead of in every worker, NumPy is skipped if it is missing
+            self.context.set_forkserver_preload(["__main__", __name__, "numpy"])
+        self.spare = None # started in advance, so that a killed worker is replaced without waiting for imports
+        self.lock = threading.Lock()
+        self.pending = [] # heap of (priority, sequence, job)
+        self.sequence = itertools.count()
+        self.workers = []
+        self.wakeup_receiver, self.wakeup_sender = multiprocessing.Pipe(duplex=False)
+        self.dispatcher = None
+
+    def _start(self):
+        if self.dispatcher is None:
+            self.workers = [DiffWorker(self.context) for i in range(self.processes)]
+            self.spare = DiffWorker(self.context)
+            self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+            self.dispatcher.start()
+
+    def _wakeup(self):
+        self.wakeup_sender.send(None)
+
+    def submit(self, func, args, priority=PRIORITY_BACKGROUND):
+        job = DiffJob(func, args, priority)
+        with self.lock:
+            self._start()
+            heapq.heappush(self.pending, (priority, next(self.sequence), job))
+        self._wakeup()
+        return job
+
+    def cancel(self, job):
+        if job.done.is_set():
+            return
+        job.cancelled = True
+        job.finish(None)
+        self._wakeup()
+
+    def cancelAll(self, minPriority=PRIORITY_BACKGROUND):
+        """Cancels all queued and running jobs with a priority value of at least minPriority."""
+        with self.lock:
+            jobs = [entry[2] for entry in self.pending]+[w.job for w in self.workers if w.job is not None]
+        for job in jobs:
+            if job.priority >= minPriority:
+                self.cancel(job)
+
+    def _traceJob(self, worker, outcome):
+        # jobs are shown in the trace as spans of their worker process
+        job = worker.job
+        if tracer.enabled and job is not None and job.started is not None:
+            pid = worker.process.pid
+            tracer.processNames[pid] = "diff worker"
+            tracer.record(job.func.__name__, "job", job.started, time.perf_counter(),
+                          {"priority": job.priority, "outcome": outcome}, pid=pid, tid=pid)
+
+    def _replace(self, worker):
+        self._traceJob(worker, "killed")
+        worker.kill()
+        index = self.workers.index(worker)
+        if self.spare is not None:
+            self.workers[index] = self.spare
+            self.spare = None
+        else:
+            del self.workers[index]
+
+    def _replenish(self):
+        """Starts the workers and the spare taken by _replace, without holding the lock, as submit and
+        cancel would wait for the process start otherwise. Returns whether a worker was started."""
+        started = False
+        while True:
+            with self.lock:
+                if len(self.workers) >= self.processes and self.spare is not None:
+                    return started
+            worker = DiffWorker(self.context)
+            started = True
+            with self.lock:
+                if len(self.workers) < self.processes:
+                    self.workers.append(worker)
+                else:
+                    self.spare = worker
+
+    def _assign(self):
+        with self.lock:
+            while self.pending and self.pending[0][2].cancelled:
+                heapq.heappop(self.pending)
+            for worker in self.workers:
+                # kill workers whose job has been cancelled
+                if worker.job is not None and worker.job.cancelled:
+                    self._replace(worker)
+            while self.pending:
+                idle = [w for w in self.workers if w.job is None]
+                priority, seq, job = self.pending[0]
+                if job.cancelled:
+                    heapq.heappop(self.pending)
+                    continue
+                if not idle:
+                    if not self.workers:
+                        break # replaced workers are started outside the lock
+                    # preempt the least important running job if a more important one is waiting
+                    victim = max(self.workers, key=lambda w: w.job.priority)
+                    if victim.job.priority <= priority:
+                        break
+                    heapq.heappush(self.pending, (victim.job.priority, next(self.sequence), victim.job))
+                    self._replace(victim)
+                    continue
+                heapq.heappop(self.pending)
+                worker = idle[0]
+                try:
+                    job.started = time.perf_counter()
+                    worker.connection.send((job.func, job.args))
+                    worker.job = job
+                except Exception:
+                    traceback.print_exc()
+                    self._replace(worker)
+                    job.finish(None, "cannot send the job to a diff worker")
+
+    def _dispatch(self):
+        while True:
+            self._assign()
+            if self._replenish():
+                continue # pending jobs can go to the new workers
+            connections = [w.connection for w in self.workers if w.job is not None]
+            for ready in multiprocessing.connection.wait(connections+[self.wakeup_receiver]):
+                if ready is self.wakeup_receiver:
+                    while self.wakeup_receiver.poll():
+                        self.wakeup_receiver.recv()
+                    continue
+                with self.lock:
+                    worker = [w for w in self.workers if w.connection is ready]
+                    if not worker:
+                        continue
+                    worker = worker[0]
+                    job = worker.job
+                    error = None
+                    try:
+                        result = ready.recv()
+                        self._traceJob(worker, "done")
+                        worker.job = None
+                    except (EOFError, OSError):
+                        # worker died, start a new one
+                        self._replace(worker)
+                        result = None
+                        error = "the diff worker died"
+                    if isinstance(result, DiffJobError):
+                        result, error = None, result.message
+                if not job.cancelled:
+                    job.finish(result, error)
+
+diffPool = DiffWorkerPool()
+
+# aligned diffs are kept across sessions in this SQLite database, shared by all gitar processes;
+# set GITAR_DIFF_CACHE to another file, or to "off", and GITAR_DIFF_CACHE_MB to change its size
+DIFF_CACHE_PATH = os.environ.get("GITAR_DIFF_CACHE", os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "gitar", "diffs.sqlite"))
+DIFF_CACHE_BYTES = int(os.environ.get("GITAR_DIFF_CACHE_MB", "256"))*1024*1024
+DIFF_CACHE_VERSION = 3        # increase when alignLines or encodeAlignment produce different results
+DIFF_CACHE_TIMEOUT = 5.0      # seconds to wait for another process that writes to the database
+DIFF_CACHE_REFRESH = 3600     # seconds, the last use of an entry is updated at most this often
+DIFF_CACHE_EVICT_CHECK = 64   # the size of the database is checked after this many new entries
+
+def encodeAlignment(aligned):
+    """Compact form of an AlignedDiff without gaps for the diff cache. Unchanged rows are only
+    counted, changed rows are stored as [has left line, has right line]. The changed characters are
+    not stored, they are computed for the rows that are shown."""
+    runs = []
+    for i, j, flag in zip(aligned.left, aligned.right, aligned.flags):
+        if flag == CHANGED:
+            if not runs or isinstance(runs[-1], int):
+                runs.append([])
+            runs[-1].append([int(i >= 0), int(j >= 0)])
+        elif runs and isinstance(runs[-1], int):
+            runs[-1] += 1
+        else:
+            runs.append(1)
+    return zlib.compress(json.dumps(runs, separators=(",", ":")).encode('utf-8'))
+
+def decodeAlignment(data, lines1, lines2):
+    """Rebuilds an AlignedDiff from encodeAlignment and both files, None if it does not fit them."""
+    aligned = AlignedDiff(lines1, lines2)
+    i = j = 0
+    for run in json.loads(zlib.decompress(data).decode('utf-8')):
+        if isinstance(run, int):
+            aligned.appendEqual(i, i+run, j)
+            i += run
+            j += run
+        else:
+            for hasLeft, hasRight in run:
+                aligned.appendRow(i if hasLeft else -1, j if hasRight else -1, CHANGED)
+                i += hasLeft
+                j += hasRight
+    if i != len(lines1) or j != len(lines2):
+        return None
+    return aligned
+
+class DiffCache:
+    """Aligned diffs and change counts of file pairs, keyed by the blob SHAs of both files and the
+    diff options. Every thread has its own connection, the database runs in WAL mode so that several
+    gitar processes can use it at once. The least recently used entries are evicted when it grows
+    beyond its size, and database errors only ever cause cache misses."""
+    def __init__(self, path, maxBytes):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.enabled = sqlite3 is not None and path not in ("", "off")
+        self.options = "%s/%i"%(DIFF_ALGORITHM, DIFF_CACHE_VERSION)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.inserted = 0
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None and self.enabled:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=DIFF_CACHE_TIMEOUT, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS alignments (sha1 TEXT, sha2 TEXT, options TEXT, "
+                                   "changes INTEGER, data BLOB, used INTEGER, PRIMARY KEY (sha1, sha2, options))")
+                connection.execute("CREATE INDEX IF NOT EXISTS alignmentsUsed ON alignments (used)")
+            except (sqlite3.Error, OSError) as e:
+                print("Diff cache %s not available (%s)"%(self.path, e))
+                self.enabled = False
+                return None
+            self.local.connection = connection
+        return connection
+
+    def lookup(self, key, column):
+        connection = self.connection()
+        if connection is None or key is None:
+            return None
+        now = int(time.time())
+        try:
+            row = connection.execute("SELECT %s FROM alignments WHERE sha1=? AND sha2=? AND options=?"%column,
+                                     key+(self.options,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE alignments SET used=? WHERE sha1=? AND sha2=? AND options=? AND used<?",
+                                   (now,)+key+(self.options, now-DIFF_CACHE_REFRESH))
+        except sqlite3.Error as e:
+            print("Diff cache lookup failed (%s)"%e)
+            return None
+        return None if row is None else row[0]
+
+    def changes(self, key):
+        """Returns the number of changed rows of the file pair key (sha1, sha2), None if unknown."""
+        return self.lookup(key, "changes")
+
+    def get(self, key, lines1, lines2):
+        """Returns the aligned diff of lines1 and lines2, whose blob SHAs are key, None if unknown."""
+        data = self.lookup(key, "data")
+        if data is None:
+            return None
+        try:
+            return decodeAlignment(data, lines1, lines2)
+        except (ValueError, TypeError, zlib.error):
+            return None
+
+    def put(self, key, aligned=None, changes=None):
+        """Stores the aligned diff of the file pair key, or only its number of changed rows."""
+        connection = self.connection()
+        if connection is None or key is None:
+            return
+        if aligned is not None:
+            changes = aligned.changes()
+        data = encodeAlignment(aligned) if aligned is not None and not aligned.excerpt else None
+        try:
+            connection.execute("INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?)",
+                               key+(self.options, changes, data, int(time.time())))
+        except sqlite3.Error as e:
+            print("Diff cache update failed (%s)"%e)
+            return
+        with self.lock:
+            self.inserted += 1
+            check = self.inserted%DIFF_CACHE_EVICT_CHECK == 1
+        if check:
+            self.evict(connection)
+
+    def evict(self, connection):
+        """Deletes the least recently used entries while the database is larger than its size."""
+        try:
+            while True:
+                pageSize = connection.execute("PRAGMA page_size").fetchone()[0]
+                pages = connection.execute("PRAGMA page_count").fetchone()[0]
+                free = connection.execute("PRAGMA freelist_count").fetchone()[0]
+                if (pages-free)*pageSize <= self.maxBytes:
+                    break
+                entries = connection.execute("SELECT COUNT(*) FROM alignments").fetchone()[0]
+                if entries == 0:
+                    break
+                connection.execute("DELETE FROM alignments WHERE rowid IN "
+                                   "(SELECT rowid FROM alignments ORDER BY used LIMIT ?)", (max(1, entries//10),))
+        except sqlite3.Error as e:
+            print("Diff cache eviction failed (%s)"%e)
+
+    def clear(self):
+        connection = self.connection()
+        if connection is not None:
+            try:
+                connection.execute("DELETE FROM alignments")
+            except sqlite3.Error as e:
+                print("Diff cache not cleared (%s)"%e)
+
+diffCache = DiffCache(DIFF_CACHE_PATH, DIFF_CACHE_BYTES)
+
+def aligner(lines1, lines2, priority=PRIORITY_VIEW, timeout=ALIGNER_TIMEOUT, cacheKey=None):
+    """Aligns two files in the diff worker pool. Returns a coarse alignment if this takes
+    longer than timeout, and None if the job was cancelled. With the blob SHAs of both files
+    as cacheKey the result is looked up in and added to the diff cache."""
+    with tracer.span("aligner", "align", lines1=len(lines1), lines2=len(lines2)):
+        return waitAligner(submitAligner(lines1, lines2, priority, cacheKey), lines1, lines2, timeout, cacheKey)
+
+def submitAligner(lines1, lines2, priority=PRIORITY_VIEW, cacheKey=None):
+    """Starts aligning two files like aligner, so that several alignments run in parallel.
+    Returns the AlignedDiff if it is in the diff cache, else the job to pass to waitAligner."""
+    result = diffCache.get(cacheKey, lines1, lines2)
+    if result is not None:
+        return result
+    return diffPool.submit(alignLines, (lines1, lines2, DIFF_ALGORITHM), priority)
+
+def waitAligner(job, lines1, lines2, timeout=ALIGNER_TIMEOUT, cacheKey=None):
+    """Returns the result of submitAligner, see aligner."""
+    if isinstance(job, AlignedDiff):
+        return job
+    result = job.wait(timeout)
+    if result is not None:
+        result.withLines(lines1, lines2)
+        diffCache.put(cacheKey, result)
+    elif not job.cancelled:
+        diffPool.cancel(job)
+        print("Aligner timed out, showing coarse diff")
+        result = coarseAlign(lines1, lines2)
+    return result
+
+class CatFileProcess:
+    """One running `git cat-file --batch` (or `--batch-check`) process."""
+    def __init__(self, path_to_repository, mode="--batch"):
+        self.mode = mode
+        self.process = subprocess.Popen(["git", "cat-file", mode], cwd=path_to_repository,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def request(self, spec, spillSize=None):
+        # returns (sha, type, size, data) or None if the object does not exist, data larger
+        # than spillSize is copied to a temporary file in chunks and returned as that file
+        self.process.stdin.write(spec.encode('utf-8')+b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if header == b"":
+            raise IOError("git cat-file terminated")
+        fields = header.decode('utf-8', 'replace').split()
+        if len(fields) != 3 or fields[-1] in ("missing", "ambiguous"):
+            return None
+        sha, objtype, size = fields[0], fields[1], int(fields[2])
+        data = None
+        if self.mode == "--batch" and spillSize is not None and size > spillSize:
+            data = tempfile.TemporaryFile()
+            remaining = size
+            while remaining > 0:
+                chunk = self.process.stdout.read(min(remaining, 1024*1024))
+                if chunk == b"":
+                    raise IOError("git cat-file terminated")
+                data.write(chunk)
+                remaining -= len(chunk)
+            data.flush()
+            self.process.stdout.read(1)
+        elif self.mode == "--batch":
+            data = self.process.stdout.read(size)
+            self.process.stdout.read(1) # trailing newline
+        return sha, objtype, size, data
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(1)
+        except Exception:
+            self.process.kill()
+
+
+# byte budget of the in-memory blob cache, can be set with the environment variable GITAR_BLOB_CACHE_MB
+BLOB_CACHE_BUDGET = int(os.environ.get("GITAR_BLOB_CACHE_MB", "256"))*1024*1024
+NULL_SHA = "0"*40
+
+def isFullSha(rev):
+    return len(rev) == 40 and all(c in "0123456789abcdef" for c in rev)
+
+class BlobCache:
+    """Blob contents keyed by SHA, evicting least recently used blobs beyond a byte budget."""
+    def __init__(self, budget=BLOB_CACHE_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.blobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sha):
+        with self.lock:
+            data = self.blobs.get(sha)
+            if data is not None:
+                self.blobs.move_to_end(sha)
+            return data
+
+    def sizeOf(self, data):
+        return len(data)
+
+    def put(self, sha, data):
+        if self.sizeOf(data) > self.budget:
+            return
+        with self.lock:
+            if sha in self.blobs:
+                self.blobs.move_to_end(sha)
+                return
+            self.blobs[sha] = data
+            self.size += self.sizeOf(data)
+            while self.size > self.budget:
+                evicted_sha, evicted = self.blobs.popitem(last=False)
+                self.size -= self.sizeOf(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.blobs.clear()
+            self.size = 0
+
+blobCache = BlobCache()
+
+
+# object backend: "python" reads .git/objects directly and falls back to the git CLI for anything
+# it does not support, "git" always uses git cat-file. Set with the environment variable GITAR_OBJECT_BACKEND
+OBJECT_BACKEND = os.environ.get("GITAR_OBJECT_BACKEND", "git")
+DELTA_BASE_CACHE_BUDGET = 64*1024*1024
+# delta chains with more instruction bytes than this are applied faster by git than in Python
+DELTA_INLINE_LIMIT = 4096
+TREE_CACHE_ENTRIES = 1024
+PACK_OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+class DeltaBaseCache(BlobCache):
+    """Resolved (type, data) of pack entries used as delta bases, keyed by (pack, offset)."""
+    def sizeOf(self, entry):
+        return len(entry[1])
+
+def applyDelta(base, delta):
+    """Builds an object from its delta base and a git delta (copy and insert instructions)."""
+    i = 0
+    for header in range(2): # source and target size
+        while delta[i] & 0x80:
+            i += 1
+        i += 1
+    parts = []
+    append = parts.append
+    length = len(delta)
+    while i < length:
+        op = delta[i]
+        i += 1
+        if op & 0x80:
+            # copy from the base, offset and size bytes are present as flagged by the low 7 bits
+            offset = size = 0
+            if op & 0x01:
+                offset = delta[i]
+                i += 1
+            if op & 0x02:
+                offset |= delta[i] << 8
+                i += 1
+            if op & 0x04:
+                offset |= delta[i] << 16
+                i += 1
+            if op & 0x08:
+                offset |= delta[i] << 24
+                i += 1
+            if op & 0x10:
+                size = delta[i]
+                i += 1
+            if op & 0x20:
+                size |= delta[i] << 8
+                i += 1
+            if op & 0x40:
+                size |= delta[i] << 16
+                i += 1
+            append(base[offset:offset+(size or 0x10000)])
+        elif op:
+            append(delta[i:i+op])
+            i += op
+        else:
+            raise ValueError("invalid delta instruction")
+    return b"".join(parts)
+
+def deltaTargetSize(delta):
+    """Returns the size of the object that a git delta builds."""
+    i = 0
+    while delta[i] & 0x80: # skip the source size
+        i += 1
+    i += 1
+    size = shift = 0
+    while True:
+        byte = delta[i]
+        i += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size
+
+def inflate(buffer, offset, size):
+    """Decompresses the zlib stream of an object with the given uncompressed size starting at offset."""
+    decompressor = zlib.decompressobj()
+    view = memoryview(buffer)
+    chunk = size+1024 # compressed objects are rarely larger than this
+    parts = []
+    while not decompressor.eof:
+        if offset >= len(view):
+            raise ValueError("truncated object")
+        parts.append(decompressor.decompress(view[offset:offset+chunk]))
+        offset += chunk
+        chunk = 65536
+    data = b"".join(parts)
+    if len(data) != size:
+        raise ValueError("object size mismatch")
+    return data
 
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
+class PackFile:
+    """A memory-mapped pack with its version 2 index."""
+    def __init__(self, indexPath):
+        with open(indexPath, "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.index[:8] != b"\377tOc\0\0\0\2":
+            raise ValueError("unsupported pack index version")
+        with open(indexPath[:-4]+".pack", "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fanout = struct.unpack(">256I", self.index[8:8+1024])
+        count = self.fanout[255]
+        self.shaTable = 8+1024
+        self.offsetTable = self.shaTable+24*count # behind the SHAs and the CRCs
+        self.largeOffsetTable = self.offsetTable+4*count
+
+    def find(self, binsha):
+        """Returns the pack offset of an object, or None if the pack does not contain it."""
+        low = self.fanout[binsha[0]-1] if binsha[0] else 0
+        high = self.fanout[binsha[0]]
+        index = self.index
+        while low < high:
+            middle = (low+high)//2
+            position = self.shaTable+20*middle
+            sha = index[position:position+20]
+            if sha < binsha:
+                low = middle+1
+            elif sha > binsha:
+                high = middle
+            else:
+                position = self.offsetTable+4*middle
+                offset = struct.unpack(">I", index[position:position+4])[0]
+                if offset & 0x80000000:
+                    position = self.largeOffsetTable+8*(offset & 0x7fffffff)
+                    offset = struct.unpack(">Q", index[position:position+8])[0]
+                return offset
+        return None
+
+    def entry(self, offset, maxSize=None):
+        """Returns (type number, delta base, data) of the entry at offset. The delta base is an offset
+        into this pack for offset deltas, a binary SHA for reference deltas, and None for full objects.
+        Raises KeyError for full objects larger than maxSize."""
+        pack = self.pack
+        start = offset
+        byte = pack[offset]
+        offset += 1
+        objtype = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        while byte & 0x80:
+            byte = pack[offset]
+            offset += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        base = None
+        if objtype == PACK_OFS_DELTA:
+            byte = pack[offset]
+            offset += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = pack[offset]
+                offset += 1
+                distance = ((distance+1) << 7) | (byte & 0x7f)
+            base = start-distance
+        elif objtype == PACK_REF_DELTA:
+            base = pack[offset:offset+20]
+            offset += 20
+        elif maxSize is not None and size > maxSize:
+            raise KeyError("large object")
+        return objtype, base, inflate(pack, offset, size)
+
+class PackedObjectStore:
+    """Reads loose and packed objects of a repository directly from its object directories.
+    Raises KeyError for objects it cannot find or decode, which callers read through git instead."""
+    def __init__(self, objectDirectories):
+        self.directories = objectDirectories
+        self.packs = {}
+        self.packsScanned = None
+        self.lock = threading.Lock()
+        self.deltaBases = DeltaBaseCache(DELTA_BASE_CACHE_BUDGET)
+        self.trees = OrderedDict()
+        self.scanPacks()
+
+    def scanPacks(self):
+        """Opens packs that appeared since the last scan (e.g. after a fetch or gc)."""
+        with self.lock:
+            scanned = []
+            for directory in self.directories:
+                packDirectory = os.path.join(directory, "pack")
+                try:
+                    scanned.append(os.stat(packDirectory).st_mtime_ns)
+                    names = os.listdir(packDirectory)
+                except OSError:
+                    continue
+                for name in names:
+                    path = os.path.join(packDirectory, name)
+                    if name.endswith(".idx") and path not in self.packs:
+                        try:
+                            self.packs[path] = PackFile(path)
+                        except (OSError, ValueError) as e:
+                            print("cannot read pack", path, e)
+                            self.packs[path] = None
+            changed = scanned != self.packsScanned
+            self.packsScanned = scanned
+            return changed
+
+    def readObject(self, sha):
+        """Returns (type, data) of the object with the given hex SHA."""
+        try:
+            return self._read(sha)
+        except KeyError:
+            # the object may be in a pack created after the last scan
+            if self.scanPacks():
+                return self._read(sha)
+            raise
+
+    def _read(self, sha):
+        binsha = bytes.fromhex(sha)
+        for pack in list(self.packs.values()):
+            if pack is not None:
+                offset = pack.find(binsha)
+                if offset is not None:
+                    return self._readPacked(pack, offset)
+        for directory in self.directories:
+            try:
+                f = open(os.path.join(directory, sha[:2], sha[2:]), "rb")
+            except OSError:
+                continue
+            with f:
+                # the header tells the size before the whole object is inflated
+                decompressor = zlib.decompressobj()
+                data = decompressor.decompress(f.read(4096))
+                header, data = data.split(b"\0", 1)
+                objtype, size = header.decode().split()
+                if int(size) > HUGE_FILE_BYTES:
+                    raise KeyError("large object")
+                data += decompressor.decompress(f.read())+decompressor.flush()
+            return objtype, data
+        raise KeyError(sha)
+
+    def _readPacked(self, pack, offset):
+        # follow the delta chain down to a full object or a cached base, then apply the deltas upwards.
+        # Objects of huge files are left to git, which streams them
+        chain = []
+        deltaSize = 0
+        while True:
+            cached = self.deltaBases.get((id(pack), offset))
+            if cached is not None:
+                objtype, data = cached
+                break
+            objtype, base, data = pack.entry(offset, None if chain else HUGE_FILE_BYTES)
+            if objtype in PACK_OBJECT_TYPES:
+                objtype = PACK_OBJECT_TYPES[objtype]
+                break
+            if not chain and deltaTargetSize(data) > HUGE_FILE_BYTES:
+                raise KeyError("large object")
+            chain.append((offset, data))
+            deltaSize += len(data)
+            if deltaSize > DELTA_INLINE_LIMIT:
+                raise KeyError("long delta chain")
+            if objtype == PACK_REF_DELTA:
+                base = pack.find(base) or base.hex()
+            if isinstance(base, int):
+                offset = base
+            else:
+                objtype, data = self.readObject(base)
+                offset = None # not an entry of this pack
+                break
+        for deltaOffset, delta in reversed(chain):
+            if offset is not None:
+                self.deltaBases.put((id(pack), offset), (objtype, data))
+            data = applyDelta(data, delta)
+            offset = deltaOffset
+        return objtype, data
+
+    def peel(self, sha, objtype):
+        """Returns the SHA of the object of objtype ("commit" or "tree") that sha refers to."""
+        for depth in range(10):
+            actual, data = self.readObject(sha)
+            if actual == objtype:
+                return sha
+            if actual == "commit" and objtype == "tree":
+                return data[5:45].decode() # first line: tree <sha>
+            if actual != "tag":
+                raise KeyError(sha)
+            sha = data[7:47].decode() # first line: object <sha>
+        raise KeyError(sha)
+
+    def tree(self, sha):
+        """Returns the entries of a tree as {name: (mode, sha)}."""
+        with self.lock:
+            entries = self.trees.get(sha)
+            if entries is not None:
+                self.trees.move_to_end(sha)
+                return entries
+        objtype, data = self.readObject(sha)
+        if objtype != "tree":
+            raise KeyError(sha)
+        entries = {}
+        i = 0
+        while i < len(data):
+            space = data.index(b" ", i)
+            nul = data.index(b"\0", space)
+            entries[data[space+1:nul].decode('utf-8', 'surrogateescape')] = (data[i:space], data[nul+1:nul+21].hex())
+            i = nul+21
+        with self.lock:
+            self.trees[sha] = entries
+            while len(self.trees) > TREE_CACHE_ENTRIES:
+                self.trees.popitem(last=False)
+        return entries
+
+    def lookupPath(self, commit, path):
+        """Returns the blob SHA of path in commit, None if there is no such file."""
+        sha = self.peel(commit, "tree")
+        for name in path.split("/"):
+            if sha is None:
+                return None
+            entry = self.tree(sha).get(name)
+            sha = entry[1] if entry is not None and entry[0] != b"160000" else None
+        return sha
+
+    def listTree(self, sha, prefix=""):
+        """Yields (path, blob SHA) of all files below a tree."""
+        for name, (mode, entrySha) in self.tree(sha).items():
+            if mode == b"40000":
+                yield from self.listTree(entrySha, prefix+name+"/")
+            elif mode != b"160000":
+                yield prefix+name, entrySha
+
+def openObjectStore(reader):
+    """Returns a PackedObjectStore for the repository of reader, or None if the repository is not supported."""
+    if OBJECT_BACKEND != "python":
+        return None
+    try:
+        objects = reader.command(["rev-parse", "--git-path", "objects"]).decode().strip()
+        objects = os.path.join(reader.path, objects)
+        try:
+            if reader.command(["rev-parse", "--show-object-format"]).decode().strip() != "sha1":
+                return None
+        except subprocess.CalledProcessError:
+            pass # git before 2.25 only supports SHA-1
+        directories = [objects]
+        try:
+            with open(os.path.join(objects, "info", "alternates")) as f:
+                directories += [os.path.join(objects, l.strip()) for l in f if l.strip() and not l.startswith("#")]
+        except OSError:
+            pass
+        return PackedObjectStore(directories)
+    except Exception as e:
+        print("reading objects through git:", e)
+        return None
+
+
+class GitObjectReader:
+    """Reads objects of one repository through a small pool of long-lived `git cat-file` processes.
+    Safe to use from several threads at once, every request takes a process from the pool."""
+    def __init__(self, path_to_repository, maxProcesses=3):
+        self.path = path_to_repository
+        self.maxProcesses = maxProcesses
+        self.lock = threading.Lock()
+        self.idle = {"--batch": queue.LifoQueue(), "--batch-check": queue.LifoQueue()}
+        self.running = {"--batch": 0, "--batch-check": 0}
+        self.blobIndex = {} # (commit sha, path) -> blob sha, filled from ls-tree/diff --raw output
+        self.indexedCommits = set() # commits whose whole tree is in blobIndex
+        self.store = None
+        self.storeOpened = False
+
+    def _acquire(self, mode):
+        try:
+            return self.idle[mode].get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            spawn = self.running[mode] < self.maxProcesses
+            if spawn:
+                self.running[mode] += 1
+        if not spawn:
+            return self.idle[mode].get()
+        try:
+            return CatFileProcess(self.path, mode)
+        except Exception:
+            with self.lock:
+                self.running[mode] -= 1
+            raise
+
+    def _release(self, proc, broken=False):
+        if broken or not proc.alive():
+            proc.close()
+            with self.lock:
+                self.running[proc.mode] -= 1
+        else:
+            self.idle[proc.mode].put(proc)
+
+    def _request(self, spec, mode, spillSize=None):
+        if "\n" in spec:
+            return None
+        proc = self._acquire(mode)
+        try:
+            with tracer.span("cat-file "+mode, "git", spec=spec):
+                result = proc.request(spec, spillSize)
+        except Exception:
+            self._release(proc, broken=True)
+            raise
+        self._release(proc)
+        return result
+
+    def objectStore(self):
+        """Returns the PackedObjectStore of the repository, None if objects are read through git."""
+        if not self.storeOpened:
+            with self.lock:
+                if not self.storeOpened:
+                    self.store = openObjectStore(self)
+                    self.storeOpened = True
+        return self.store
+
+    def readObject(self, spec, spillSize=None):
+        """Returns (sha, type, data) for a revision/path spec like 'branch:path', or None.
+        Data larger than spillSize is returned as a temporary file instead of bytes."""
+        store = self.objectStore()
+        if store is not None and isFullSha(spec):
+            try:
+                with tracer.span("read object", "git", sha=spec):
+                    objtype, data = store.readObject(spec)
+                return spec, objtype, data
+            except (KeyError, ValueError, OSError, zlib.error):
+                pass # read through git
+        result = self._request(spec, "--batch", spillSize)
+        if result is None:
+            return None
+        return result[0], result[1], result[3]
+
+    def blobSha(self, rev, path):
+        """Returns the SHA of the blob at path in rev, None if there is no such file."""
+        commit = rev if isFullSha(rev) else self.resolve(rev)
+        if commit is None:
+            return None
+        sha = self.blobIndex.get((commit, path))
+        store = self.objectStore()
+        if sha is None and store is not None:
+            try:
+                sha = store.lookupPath(commit, path)
+            except (KeyError, ValueError, OSError, zlib.error):
+                pass # look up through git
+        if sha is None:
+            result = self._request("%s:%s"%(commit, path), "--batch-check")
+            if result is None or result[1] != "blob":
+                return None
+            sha = result[0]
+            self.blobIndex[(commit, path)] = sha
+        return sha
+
+    def read(self, rev, path, spillSize=None):
+        """Returns the contents of path at rev, served from the blob cache when its SHA is known.
+        Blobs larger than spillSize are not cached and returned as a temporary file."""
+        sha = self.blobSha(rev, path)
+        if sha is None:
+            return None
+        return self.readBlob(sha, spillSize)
+
+    def readBlob(self, sha, spillSize=None):
+        """Returns the contents of the blob sha like read(), None if it is not a blob."""
+        data = blobCache.get(sha)
+        if data is None:
+            result = self.readObject(sha, spillSize)
+            if result is None or result[1] != "blob":
+                return None
+            data = result[2]
+            if isinstance(data, bytes):
+                blobCache.put(sha, data)
+        return data
+
+    def addToIndex(self, commit, path, sha):
+        if sha == NULL_SHA or commit is None:
+            return
+        if len(self.blobIndex) > 1000000:
+            self.clearIndex()
+        self.blobIndex[(commit, path)] = sha
+
+    def clearIndex(self):
+        self.indexedCommits.clear()
+        self.blobIndex.clear()
+
+    def indexTree(self, rev):
+        """Records the blob SHAs of all files of rev using one `git ls-tree` call (or the
+        object store), so that later reads of rev need no path lookups. Does nothing if
+        rev has been indexed before."""
+        commit = self.resolve(rev)
+        if commit is None or commit in self.indexedCommits:
+            return
+        self.indexedCommits.add(commit)
+        store = self.objectStore()
+        if store is not None:
+            try:
+                for path, sha in store.listTree(store.peel(commit, "tree")):
+                    self.addToIndex(commit, path, sha)
+                return
+            except (KeyError, ValueError, OSError, zlib.error):
+                pass # list through git
+        output = self.command(["ls-tree", "-r", "-z", "--full-tree", commit])
+        for entry in output.split(b"\0"):
+            if entry == b"":
+                continue
+            info, path = entry.split(b"\t", 1)
+            mode, objtype, sha = info.split()
+            if objtype == b"blob":
+                self.addToIndex(commit, path.decode('utf-8', 'replace'), sha.decode())
+
+    def indexRawDiff(self, output, oldCommit, newCommit):
+        """Records blob SHAs from `git diff --raw -z --no-abbrev` output and returns the (old path, new path)
+        of the changed files."""
+        paths = []
+        for status, oldPath, newPath, oldSha, newSha in parseRawDiff(output):
+            self.addToIndex(oldCommit, oldPath, oldSha)
+            self.addToIndex(newCommit, newPath, newSha)
+            paths.append((oldPath, newPath))
+        return paths
+
+    def resolve(self, rev, objtype="commit"):
+        """Returns the SHA of rev (peeled to objtype), or None if it does not exist."""
+        store = self.objectStore()
+        if store is not None and objtype and isFullSha(rev):
+            try:
+                return store.peel(rev, objtype)
+            except (KeyError, ValueError, OSError, zlib.error):
+                pass # resolve through git
+        result = self._request("%s^{%s}"%(rev, objtype) if objtype else rev, "--batch-check")
+        if result is None:
+            return None
+        return result[0]
+
+    def command(self, args):
+        """Runs a git command in the repository and returns its raw output."""
+        with tracer.span("git "+args[0], "git", args=" ".join(args)):
+            return subprocess.check_output(["git"]+list(args), cwd=self.path, stderr=subprocess.DEVNULL)
+
+    def popen(self, args):
+        """Starts a git command in the repository for reading its output as a stream."""
+        return subprocess.Popen(["git"]+list(args), cwd=self.path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        for mode, idle in self.idle.items():
+            while True:
+                try:
+                    proc = idle.get_nowait()
+                except queue.Empty:
+                    break
+                proc.close()
+                with self.lock:
+                    self.running[mode] -= 1
+
+
+def parseRawDiff(output):
+    """Parses `git diff --raw -z --no-abbrev` output into (status, old path, new path, old SHA, new SHA) tuples."""
+    entries = []
+    fields = output.split(b"\0")
+    i = 0
+    while i < len(fields)-1:
+        info = fields[i].decode().split()
+        if len(info) < 5:
+            break
+        status = info[4]
+        oldPath = fields[i+1].decode('utf-8', 'replace')
+        if status[0] in "RC":
+            newPath = fields[i+2].decode('utf-8', 'replace')
+            i += 3
+        else:
+            newPath = oldPath
+            i += 2
+        entries.append((status, oldPath, newPath, info[2], info[3]))
+    return entries
+
+objectReaders = {}
+objectReadersLock = threading.Lock()
+
+def getObjectReader(path_to_repository=None):
+    """Returns the shared object reader for a repository (default: the one containing the working directory)."""
+    if path_to_repository is None or path_to_repository == "":
+        path_to_repository = getGitToplevelDir() or os.getcwd()
+    path_to_repository = os.path.abspath(path_to_repository)
+    with objectReadersLock:
+        reader = objectReaders.get(path_to_repository)
+        if reader is None:
+            reader = GitObjectReader(path_to_repository)
+            objectReaders[path_to_repository] = reader
+    return reader
+
+@atexit.register
+def closeObjectReaders():
+    with objectReadersLock:
+        for reader in objectReaders.values():
+            reader.close()
+        objectReaders.clear()
+
+# files larger than this are not loaded as a whole, only the regions around their differences are
+# shown. Can be set with the environment variable GITAR_HUGE_FILE_MB
+HUGE_FILE_BYTES = int(float(os.environ.get("GITAR_HUGE_FILE_MB", "16"))*1024*1024)
+BINARY_SNIFF_BYTES = 8000 # like git, files with a NUL byte in the first 8000 bytes are binary
+LINE_INDEX_STRIDE = 256   # one of this many line starts of a large file is kept in memory
+
+@functools.lru_cache(maxsize=None)
+def skipLines(count):
+    """Returns a pattern matching count lines, which skips them without a Python loop."""
+    return re.compile(b"(?:[^\n]*\n){%i}"%count)
+
+class LargeFile:
+    """The lines of a file too large to be held as a list, decoded on access from a memory map
+    of the file. Supports len(), indexing, slicing and iteration like the line lists of getFromGit,
+    lines are only split at \\n."""
+    def __init__(self, file):
+        self.file = file
+        self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.data)
+        self.starts = [0]
+        position = 0
+        while True:
+            match = skipLines(LINE_INDEX_STRIDE).match(self.data, position)
+            if match is None:
+                break
+            position = match.end()
+            self.starts.append(position)
+        rest = self.data[position:]
+        self.count = (len(self.starts)-1)*LINE_INDEX_STRIDE+rest.count(b"\n")+(1 if rest and not rest.endswith(b"\n") else 0)
+
+    def __len__(self):
+        return self.count
+
+    def offset(self, line):
+        """Returns the byte offset where line starts."""
+        if line >= self.count:
+            return self.size
+        match = skipLines(line%LINE_INDEX_STRIDE).match(self.data, self.starts[line//LINE_INDEX_STRIDE])
+        return match.end() if match else self.size
+
+    def raw(self, start, end):
+        """Returns the bytes of the lines [start, end)."""
+        start, end = max(start, 0), min(end, self.count)
+        if start >= end:
+            return b""
+        return self.data[self.offset(start):self.offset(end)]
+
+    def lines(self, start, end):
+        text = self.raw(start, end).decode('utf-8', 'replace')
+        if not text:
+            return []
+        lines = text.split("\n")
+        if text.endswith("\n"):
+            lines.pop()
+        return [l.rstrip()+"\n" for l in lines]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.count)
+            return self.lines(start, end)[::step]
+        if key < 0:
+            key += self.count
+        if not 0 <= key < self.count:
+            raise IndexError("line index out of range")
+        return self.lines(key, key+1)[0]
+
+    def __iter__(self):
+        for start in range(0, self.count, 4096):
+            yield from self.lines(start, start+4096)
+
+def binaryPlaceholder(data):
+    """Describes binary contents in one line, with the SHA git gives the same contents."""
+    sha = hashlib.sha1(b"blob %i\0"%len(data))
+    sha.update(data)
+    return ["Binary file, %i bytes, %s\n"%(len(data), sha.hexdigest())]
+
+def decodeLines(data):
+    """Turns file contents (bytes, or a file object for large files) into the lines shown in the editors."""
+    if isinstance(data, bytes):
+        if b"\0" in data[:BINARY_SNIFF_BYTES]:
+            return binaryPlaceholder(data)
+        return [l.rstrip()+"\n" for l in data.decode('utf-8', 'replace').splitlines()]
+    lines = LargeFile(data)
+    if b"\0" in lines.data[:BINARY_SNIFF_BYTES]:
+        return binaryPlaceholder(lines.data)
+    return lines
 
 def getFromGit(path_to_repository, branchname, filepath):
-    lines=""
+    """Returns the lines of filepath in the working copy (branch "" or ".") or at branchname, with
+    a LargeFile for files above HUGE_FILE_BYTES. Returns "" if the file cannot be read."""
     try:
         if branchname == "" or branchname==".":
-            #print(path_to_repository+filepath)
-            file = open((path_to_repository+filepath).strip())
-            #print("file opened")
-            lines = file.readlines()
-            return [l.rstrip()+"\n" for l in lines]
+            path = (path_to_repository+filepath).strip()
+            if not os.path.exists(path):
+                return "" # deleted in the working copy
+            if os.path.getsize(path) > HUGE_FILE_BYTES:
+                data = open(path, "rb")
+            else:
+                with open(path, "rb") as file:
+                    data = file.read()
+        else:
+            data = getObjectReader(path_to_repository).read(branchname, filepath.strip(), spillSize=HUGE_FILE_BYTES)
+            if data is None:
+                return ""
+        return decodeLines(data)
+    except Exception as e:
+        print("Cannot read %s:%s (%s)"%(branchname, filepath.strip(), e))
+        return ""
+
+def contentKey(path_to_repository, branchname, filepath):
+    """Returns the git blob SHA of filepath in the working copy (branch "" or ".") or at branchname,
+    which identifies its contents in the diff cache. NULL_SHA for a missing file, None on errors."""
+    try:
+        if branchname == "" or branchname==".":
+            path = (path_to_repository+filepath).strip()
+            if not os.path.exists(path):
+                return NULL_SHA
+            sha = hashlib.sha1()
+            with open(path, "rb") as file:
+                if os.path.getsize(path) > HUGE_FILE_BYTES:
+                    sha.update(b"blob %i\0"%os.fstat(file.fileno()).st_size)
+                    for chunk in iter(lambda: file.read(1024*1024), b""):
+                        sha.update(chunk)
+                else:
+                    data = file.read()
+                    sha.update(b"blob %i\0"%len(data))
+                    sha.update(data)
+            return sha.hexdigest()
+        return getObjectReader(path_to_repository).blobSha(branchname, filepath.strip()) or NULL_SHA
+    except Exception as e:
+        print("Cannot hash %s:%s (%s)"%(branchname, filepath.strip(), e))
+        return None
+
+def diffCacheKey(path_to_repository, branch1, branch2, filepath, leftPath=None):
+    """The key of filepath in the diff cache when comparing branch1 with branch2, None if unknown.
+    leftPath is the path of the file in branch1 if it has been renamed."""
+    if not diffCache.enabled:
+        return None
+    key = (contentKey(path_to_repository, branch1, leftPath or filepath), contentKey(path_to_repository, branch2, filepath))
+    return None if None in key else key
+
+def pathspec(paths):
+    """Arguments that limit a git command to the given paths, taken literally."""
+    return ["--"]+[":(literal)"+p for p in paths] if paths else []
+
+def getChangedFilesFromGit(path_to_repository, branch1, branch2, locallyChangedOnly=False, paths=()):
+    """Returns (path in branch1, path in branch2) of the changed files, the paths differ for renamed files."""
+    lines=""
+    diffOptions = ["diff", "--ignore-space-at-eol", "-G.", "--raw", "-z", "--no-abbrev"]
+    limit = pathspec(paths)
+    try:
+        reader = getObjectReader(path_to_repository)
+        # the raw diff also tells us the blob SHAs of both sides, which lets the blob cache
+        # serve unchanged blobs when only one of the commits changes
+        if branch1=="" and branch2=="":
+            lines = reader.indexRawDiff(reader.command(diffOptions+limit), None, None)
+        elif branch1 == "":
+            # the working copy is the new side of the diff
+            commit2 = reader.resolve(branch2)
+            lines = reader.indexRawDiff(reader.command(diffOptions+[branch2]+limit), commit2, None)
+            return [(newPath, oldPath) for oldPath, newPath in lines]
+        else:
+            if branch1==".":
+                branch1  = getGitCurrentBranch()
+            if branch2==".":
+                branch2  = getGitCurrentBranch()
+            commit1 = reader.resolve(branch1)
+            commit2 = reader.resolve(branch2)
+            if locallyChangedOnly:
+                # diffed from the merge base, branch1 is the new side
+                lines = reader.indexRawDiff(reader.command(diffOptions+['%s...%s' % (branch2, branch1)]+limit), None, commit1)
+                return [(newPath, oldPath) for oldPath, newPath in lines]
+            else:
+                lines = reader.indexRawDiff(reader.command(diffOptions+[branch1, branch2]+limit), commit1, commit2)
+        return lines
+    except:
+        print("not a git directory")
+        return [(f, f) for f in subprocess.check_output("ls", shell=True).decode('utf-8').splitlines()]
+
+def indexCommitTrees(path_to_repository, *branches):
+    """Records the blob SHAs of all files of the compared commits in the object reader's index.
+    Files that are not in the diff, like the ones the history and blame views open, are then
+    read without looking up their path first."""
+    reader = getObjectReader(path_to_repository)
+    for branch in branches:
+        if branch == "":
+            continue # the working copy has no tree
+        if branch == ".":
+            branch = getGitCurrentBranch()
+        try:
+            reader.indexTree(branch)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            print("could not index %s: %s"%(branch, e))
+
+def getDiffNumstat(path_to_repository, branch1, branch2, locallyChangedOnly=False, paths=()):
+    """Returns {path: (added, deleted)} for all files changed between branch1 and branch2 (or only
+    the given paths) from one `git diff --numstat` call, binary files map to None. Renamed files
+    are keyed by their path in branch2, like the file list. locallyChangedOnly counts the changes
+    of branch1 since the merge base, like getChangedFilesFromGit."""
+    counts = {}
+    locallyChangedOnly = locallyChangedOnly and "" not in (branch1, branch2)
+    # against the working copy or the merge base, branch2 is the old side of the diff
+    renamedPath = 1 if (branch1 == "" and branch2 != "") or locallyChangedOnly else 2
+    diffOptions = ["diff", "--ignore-space-at-eol", "-G.", "--numstat", "-z"]
+    try:
+        reader = getObjectReader(path_to_repository)
+        if branch1 == "." or (branch1 != "" and branch2 == "."):
+            branch1, branch2 = [getGitCurrentBranch() if b == "." else b for b in (branch1, branch2)]
+        revisions = [b for b in (branch1, branch2) if b != ""]
+        if locallyChangedOnly:
+            revisions = ['%s...%s' % (branch2, branch1)]
+        fields = reader.command(diffOptions+revisions+pathspec(paths)).split(b"\0")
+    except:
+        print("Error running git diff --numstat")
+        return counts
+    i = 0
+    while i < len(fields):
+        if fields[i] == b"":
+            i += 1
+            continue
+        added, deleted, path = fields[i].decode('utf-8', 'replace').split("\t", 2)
+        if path == "":
+            # renamed file, old and new path follow as separate fields
+            path = fields[i+renamedPath].decode('utf-8', 'replace')
+            i += 3
+        else:
+            i += 1
+        counts[path] = None if added == "-" else (int(added), int(deleted))
+    return counts
+
+def loadAlignedFiles(path_to_repository, branch1, branch2, filepath, leftPath=None):
+    """Reads filepath from both revisions and aligns it, for showing the diff view. A file renamed
+    in branch1 is read from leftPath there."""
+    lines1 = getFromGit(path_to_repository, branch1, leftPath or filepath)
+    lines2 = getFromGit(path_to_repository, branch2, filepath)
+    if isinstance(lines1, LargeFile) or isinstance(lines2, LargeFile):
+        with tracer.span("alignLargeFiles", "align", lines1=len(lines1), lines2=len(lines2)):
+            return alignLargeFiles(lines1, lines2)
+    return aligner(lines1, lines2, cacheKey=diffCacheKey(path_to_repository, branch1, branch2, filepath, leftPath))
+
+def getBlobFromGit(path_to_repository, sha):
+    """Returns the lines of the blob sha like getFromGit, "" for NULL_SHA or if it cannot be read."""
+    if sha == NULL_SHA:
+        return ""
+    try:
+        data = getObjectReader(path_to_repository).readBlob(sha, spillSize=HUGE_FILE_BYTES)
+        return "" if data is None else decodeLines(data)
+    except Exception as e:
+        print("Cannot read blob %s (%s)"%(sha, e))
+        return ""
+
+def loadAlignedBlobs(path_to_repository, sha1, sha2, priority=PRIORITY_VIEW, timeout=ALIGNER_TIMEOUT):
+    """Reads two blobs by their SHAs and aligns them, for the steps of the file history."""
+    lines1 = getBlobFromGit(path_to_repository, sha1)
+    lines2 = getBlobFromGit(path_to_repository, sha2)
+    if isinstance(lines1, LargeFile) or isinstance(lines2, LargeFile):
+        with tracer.span("alignLargeFiles", "align", lines1=len(lines1), lines2=len(lines2)):
+            return alignLargeFiles(lines1, lines2)
+    return aligner(lines1, lines2, priority, timeout, cacheKey=(sha1, sha2) if diffCache.enabled else None)
+
+# merge bases of commit pairs, and diverged files of (merge base tree, tree 1, tree 2) triples
+mergeBaseCache = {}
+divergedCache = OrderedDict()
+divergedCacheLock = threading.Lock()
+DIVERGED_CACHE_ENTRIES = 32
+
+def getMergeBase(reader, commit1, commit2):
+    """Returns the merge base of two commits, None for unrelated histories."""
+    key = (reader.path, commit1, commit2)
+    with divergedCacheLock:
+        if key in mergeBaseCache:
+            return mergeBaseCache[key]
+    try:
+        base = reader.command(["merge-base", commit1, commit2]).decode().strip()
+    except subprocess.CalledProcessError:
+        base = None
+    with divergedCacheLock:
+        mergeBaseCache[key] = base
+    return base
+
+def divergedFiles(path_to_repository, branch1, branch2):
+    """Returns (path in the merge base, path in branch1, path in branch2, status in branch1, status
+    in branch2) of all files changed on both branches since their merge base. Renamed files are matched by their path in the
+    merge base. Only the trees are compared, with one `git diff-tree` per branch."""
+    reader = getObjectReader(path_to_repository)
+    commit1 = reader.resolve(branch1)
+    commit2 = reader.resolve(branch2)
+    if commit1 is None or commit2 is None:
+        return []
+    base = getMergeBase(reader, commit1, commit2)
+    baseTree = reader.resolve(base, "tree") if base else reader.command(["hash-object", "-t", "tree", "/dev/null"]).decode().strip()
+    key = (reader.path, baseTree, reader.resolve(commit1, "tree"), reader.resolve(commit2, "tree"))
+    with divergedCacheLock:
+        if key in divergedCache:
+            divergedCache.move_to_end(key)
+            return divergedCache[key]
+    # both sides are compared at the same time, diff-tree skips subtrees with identical SHAs
+    diffOptions = ["diff-tree", "-r", "-z", "--no-abbrev", "-M", "--ignore-space-at-eol", "-G."]
+    with tracer.span("git diff-tree", "git", base=baseTree):
+        processes = [reader.popen(diffOptions+[baseTree, tree]) for tree in key[2:]]
+        outputs = [process.communicate()[0] for process in processes]
+    if any(process.returncode != 0 for process in processes):
+        raise subprocess.CalledProcessError(1, "git diff-tree")
+    side1 = {}
+    for status, oldPath, newPath, oldSha, newSha in parseRawDiff(outputs[0]):
+        side1[oldPath] = (newPath, status)
+        reader.addToIndex(commit1, newPath, newSha)
+    diverged = []
+    for status, oldPath, newPath, oldSha, newSha in parseRawDiff(outputs[1]):
+        if oldPath in side1:
+            path1, status1 = side1[oldPath]
+            diverged.append((oldPath, path1, newPath, status1, status))
+            reader.addToIndex(commit2, newPath, newSha)
+    diverged.sort(key=lambda entry: entry[2])
+    with divergedCacheLock:
+        divergedCache[key] = diverged
+        while len(divergedCache) > DIVERGED_CACHE_ENTRIES:
+            divergedCache.popitem(last=False)
+    return diverged
+
+# three-way views of (merge base blob, blob 1, blob 2) triples
+mergeCache = OrderedDict()
+MERGE_CACHE_ENTRIES = 64
+
+def loadMergedFiles(path_to_repository, branch1, branch2, filepath, timeout=ALIGNER_TIMEOUT):
+    """Reads filepath from both revisions and from their merge base, and aligns both with the base
+    in parallel, for the three-way view. Returns (merge base, AlignedMerge), or (None, AlignedDiff)
+    with the two-way diff if the revisions have no merge base or a file is huge."""
+    reader = getObjectReader(path_to_repository)
+    branch1, branch2 = [getGitCurrentBranch() if b == "." else b for b in (branch1, branch2)]
+    commit1 = reader.resolve(branch1)
+    commit2 = reader.resolve(branch2)
+    base = getMergeBase(reader, commit1, commit2) if commit1 and commit2 else None
+    if base is None:
+        return None, loadAlignedFiles(path_to_repository, branch1, branch2, filepath)
+    # a renamed file is read from its path in each revision
+    paths = next((entry[:3] for entry in divergedFiles(path_to_repository, branch1, branch2) if entry[2] == filepath),
+                 (filepath,)*3)
+    key = tuple(reader.blobSha(commit, path) or NULL_SHA for commit, path in zip((base, commit1, commit2), paths))
+    with divergedCacheLock:
+        if key in mergeCache:
+            mergeCache.move_to_end(key)
+            return base, mergeCache[key]
+    # the base is read once for both alignments
+    baseLines, lines1, lines2 = [getBlobFromGit(path_to_repository, sha) for sha in key]
+    if any(isinstance(lines, LargeFile) for lines in (baseLines, lines1, lines2)):
+        return None, loadAlignedFiles(path_to_repository, branch1, branch2, filepath, paths[1])
+    pairs = [(lines, (key[0], sha) if diffCache.enabled else None) for lines, sha in ((lines1, key[1]), (lines2, key[2]))]
+    with tracer.span("aligner", "align", lines1=len(lines1), lines2=len(lines2), base=len(baseLines)):
+        jobs = [submitAligner(baseLines, lines, PRIORITY_VIEW, cacheKey) for lines, cacheKey in pairs]
+        toLeft, toRight = [waitAligner(job, baseLines, lines, timeout, cacheKey) for job, (lines, cacheKey) in zip(jobs, pairs)]
+    if toLeft is None or toRight is None:
+        return base, None
+    with tracer.span("mergeAlignments", "align", rows=len(toLeft)+len(toRight)):
+        merged = mergeAlignments(toLeft, toRight)
+    with divergedCacheLock:
+        mergeCache[key] = merged
+        while len(mergeCache) > MERGE_CACHE_ENTRIES:
+            mergeCache.popitem(last=False)
+    return base, merged
+
+def getDivergedFiles(path_to_repository, branch1, branch2):
+    """Returns (path in branch1, path in branch2) of the files changed on both branches, the
+    paths differ for renamed files."""
+    branch1, branch2 = [getGitCurrentBranch() if b == "." else b for b in (branch1, branch2)]
+    if branch1 == "" or branch2 == "":
+        # the working copy has no tree to compare, compare the file lists instead
+        set1 = getChangedFilesFromGit(path_to_repository, branch1, branch2, True)
+        set2 = set(path2 for path2, path1 in getChangedFilesFromGit(path_to_repository, branch2, branch1, True))
+        return [(path1, path2) for path1, path2 in set1 if path2 in set2]
+    try:
+        return [(path1, path2) for basePath, path1, path2, status1, status2 in divergedFiles(path_to_repository, branch1, branch2)]
+    except:
+        print("Error comparing", branch1, branch2)
+        return []
+
+# files aligned longer than this are exported with a coarse diff
+EXPORT_TIMEOUT = 30.0
+
+def exportRecord(filepath, counts, aligned, status="aligned"):
+    """Returns the export record of one file: a dict of the path, the line counts and the aligned rows."""
+    record = {"path": filepath}
+    if counts:
+        record["added"], record["deleted"] = counts
+    record["status"] = status
+    if aligned is None:
+        return record
+    rows = []
+    changedValues = {UNCHANGED: False, CHANGED: True, GAP: None}
+    for r, flag in enumerate(aligned.flags):
+        row = {"changed": changedValues[flag]}
+        for side, name in enumerate(("left", "right")):
+            text = aligned.text(side, r)
+            if text is None:
+                row[name] = None
+                continue
+            text = row[name] = text.rstrip("\n")
+            offsets = aligned.rowMarks(side, r)
+            marks = [[start, min(end, len(text))] for start, end in zip(offsets[::2], offsets[1::2]) if start < len(text)]
+            if marks:
+                row[name+"Marks"] = marks
+        rows.append(row)
+    record["rows"] = rows
+    return record
+
+def exportFile(path_to_repository, branch1, branch2, filepath, counts, render, leftPath=None):
+    # runs in a diff worker, so that reading, aligning and formatting are parallel
+    lines1 = getFromGit(path_to_repository, branch1, leftPath or filepath)
+    lines2 = getFromGit(path_to_repository, branch2, filepath)
+    if isinstance(lines1, LargeFile) or isinstance(lines2, LargeFile):
+        return render(exportRecord(filepath, counts, alignLargeFiles(lines1, lines2), "excerpt"))
+    return render(exportRecord(filepath, counts, alignLines(lines1, lines2)))
+
+def exportDiffs(path_to_repository, branch1, branch2, render, diverged=False, locallyChangedOnly=False):
+    """Yields render(record) of every changed file in list order, see exportRecord. Files are
+    processed in parallel in the diff worker pool, with at most two files per worker in flight
+    to bound the memory use."""
+    if diverged:
+        files = getDivergedFiles(path_to_repository, branch1, branch2)
+    else:
+        files = getChangedFilesFromGit(path_to_repository, branch1, branch2, locallyChangedOnly)
+    numstat = getDiffNumstat(path_to_repository, branch1, branch2, locallyChangedOnly and not diverged)
+    window = 2*diffPool.processes
+    running = []
+    files = iter(files)
+    while True:
+        for leftPath, filepath in files:
+            counts = numstat.get(filepath, ())
+            job = None
+            if counts is not None:
+                job = diffPool.submit(exportFile, (path_to_repository, branch1, branch2, filepath, counts, render, leftPath), PRIORITY_BACKGROUND)
+            running.append((leftPath, filepath, counts, job))
+            if len(running) >= window:
+                break
+        if not running:
+            return
+        leftPath, filepath, counts, job = running.pop(0)
+        if job is None:
+            yield render(exportRecord(filepath, counts, None, "binary"))
+            continue
+        output = job.wait(EXPORT_TIMEOUT)
+        if output is None and job.error is not None:
+            print("Could not export", filepath+":", job.error, file=sys.stderr)
+            record = exportRecord(filepath, counts, None, "failed")
+            record["error"] = job.error
+            output = render(record)
+        elif output is None:
+            diffPool.cancel(job)
+            print("Could not align", filepath, "in time, exporting coarse diff", file=sys.stderr)
+            lines1 = getFromGit(path_to_repository, branch1, leftPath)
+            lines2 = getFromGit(path_to_repository, branch2, filepath)
+            if isinstance(lines1, LargeFile) or isinstance(lines2, LargeFile):
+                output = render(exportRecord(filepath, counts, None, "too large"))
+            else:
+                output = render(exportRecord(filepath, counts, coarseAlign(lines1, lines2), "coarse"))
+        yield output
+
+def jsonRecord(record):
+    return json.dumps(record)+"\n"
+
+HTML_HEADER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%s</title>
+<style>
+body { font-family: sans-serif; background: #eaeaea; }
+table { border-collapse: collapse; width: 100%%; table-layout: fixed; background: white; margin-bottom: 2em; }
+td { font-family: monospace; white-space: pre-wrap; vertical-align: top; padding: 0 4px; border-right: 1px solid #ccc; }
+td.n { width: 4em; color: #888; text-align: right; }
+tr.c td { background: #ffdddd; }
+td.pad { background: #dddddd !important; }
+span.m { background: #ff8888; }
+tr.s td { color: #888; text-align: center; background: #f4f4f4; }
+</style></head><body>
+<h1>%s</h1>
+"""
+HTML_FOOTER = "</body></html>\n"
+
+def htmlLine(text, marks):
+    parts = []
+    position = 0
+    for start, end in marks:
+        parts.append(html.escape(text[position:start]))
+        parts.append('<span class="m">%s</span>'%html.escape(text[start:end]))
+        position = end
+    parts.append(html.escape(text[position:]))
+    return "".join(parts)
+
+def htmlRecord(record):
+    """Formats a record as a heading and a side-by-side table for the HTML report."""
+    counts = " (+%i -%i)"%(record["added"], record["deleted"]) if "added" in record else ""
+    parts = ['<h2>%s%s</h2>\n'%(html.escape(record["path"]), counts)]
+    if "rows" not in record:
+        parts.append("<p>%s file</p>\n"%html.escape(record["status"]))
+        return "".join(parts)
+    parts.append("<table>\n")
+    numbers = [0, 0]
+    for row in record["rows"]:
+        if row["changed"] is None:
+            # lines left out of the excerpt of a huge file
+            ranges = [EXCERPT_GAP_LINES.match(row[side] or "") for side in ("left", "right")]
+            numbers = [int(r.group(1)) if r else n for r, n in zip(ranges, numbers)]
+            parts.append('<tr class="s"><td colspan="4">%s</td></tr>\n'%html.escape(row["left"] or row["right"]))
+            continue
+        cells = []
+        for i, side in enumerate(("left", "right")):
+            if row[side] is None:
+                cells.append('<td class="n"></td><td class="pad"></td>')
+            else:
+                numbers[i] += 1
+                cells.append('<td class="n">%i</td><td>%s</td>'%(numbers[i], htmlLine(row[side], row.get(side+"Marks", []))))
+        parts.append('<tr%s>%s</tr>\n'%(' class="c"' if row["changed"] else "", "".join(cells)))
+    parts.append("</table>\n")
+    return "".join(parts)
+
+def exportMain(args):
+    """gitar.py --export json|html [--diverged] [--local-only] [branch1] [branch2]: writes the
+    aligned diffs of all changed files to stdout without opening a window."""
+    if not args or args[0] not in ("json", "html"):
+        print("usage: gitar.py --export json|html [--diverged] [--local-only] [branch1] [branch2]", file=sys.stderr)
+        return 2
+    outputFormat = args[0]
+    options = [a for a in args[1:] if a.startswith("--")]
+    branches = [a for a in args[1:] if not a.startswith("--")]
+    # same branch arguments as the window
+    branch1 = ""
+    branch2 = getGitCurrentBranch()
+    if len(branches) == 1:
+        branch2 = branches[0]
+    elif len(branches) == 2:
+        branch1, branch2 = branches
+    gitpath = getGitToplevelDir()
+    render = jsonRecord if outputFormat == "json" else htmlRecord
+    out = open(sys.stdout.fileno(), "w", encoding="utf-8", closefd=False)
+    if outputFormat == "html":
+        title = html.escape("%s vs. %s"%(branch1 or "working copy", branch2))
+        out.write(HTML_HEADER%(title, title))
+    for output in exportDiffs(gitpath, branch1, branch2, render, diverged="--diverged" in options, locallyChangedOnly="--local-only" in options):
+        out.write(output)
+        out.flush()
+    if outputFormat == "html":
+        out.write(HTML_FOOTER)
+    out.flush()
+    return 0
+
+# number of git commands running at the same time, and how long ref lookups are reused
+GIT_CONCURRENCY = 4
+GIT_MEMO_SECONDS = 2.0
+
+class GitExecutor(QObject):
+    """Runs git commands and functions calling git on a bounded number of threads.
+    Identical calls that are in flight share one execution, calls with memoize>0 reuse their
+    result for that many seconds, and request() delivers results to the main thread."""
+    delivered = pyqtSignal(object, object) # callback, future
+
+    def __init__(self, maxThreads=GIT_CONCURRENCY):
+        QObject.__init__(self)
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=maxThreads, thread_name_prefix="git",
+                                                          initializer=self._initWorker)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.memo = {} # key: (expiry time, future)
+        self.delivered.connect(self._deliver)
+
+    def _initWorker(self):
+        self.local.worker = True
+
+    def submit(self, func, *args, memoize=0):
+        """Returns a future for func(*args), sharing a running or memoised call with the same arguments."""
+        key = (func, args)
+        with self.lock:
+            memo = self.memo.get(key)
+            if memo is not None and memo[0] > time.monotonic():
+                return memo[1]
+            # a job of this executor runs nested calls inline, as waiting for a queued one could deadlock
+            inline = getattr(self.local, "worker", False)
+            future = self.inflight.get(key)
+            if future is not None and (future.running() or not inline):
+                return future
+            if inline:
+                future = concurrent.futures.Future()
+            else:
+                future = self.inflight[key] = self.pool.submit(func, *args)
+        if inline:
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(lambda f: self._finished(key, f, memoize))
+        return future
+
+    def _finished(self, key, future, memoize):
+        with self.lock:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+            if memoize > 0 and future.exception() is None:
+                self.memo[key] = (time.monotonic()+memoize, future)
+
+    def command(self, args, path=None, memoize=0):
+        """Returns a future for the output of `git args` run in path (default: the working directory)."""
+        return self.submit(gitCommand, tuple(args), path, memoize=memoize)
+
+    def request(self, callback, func, *args, memoize=0):
+        """Calls func(*args) in the background and callback(result) in the main thread."""
+        self.prune()
+        return self.deliver(self.submit(func, *args, memoize=memoize), callback)
+
+    def prune(self):
+        """Forgets expired memoised results, which are otherwise only dropped when asked for again."""
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, (expiry, future) in self.memo.items() if expiry <= now]:
+                del self.memo[key]
+
+    def deliver(self, future, callback):
+        """Calls callback(result) in the main thread when future is done."""
+        future.add_done_callback(lambda f: self.delivered.emit(callback, f))
+        return future
+
+    def _deliver(self, callback, future):
+        try:
+            callback(future.result())
+        except Exception:
+            traceback.print_exc()
+
+    def invalidate(self):
+        """Forgets memoised results, e.g. after refs have changed."""
+        with self.lock:
+            self.memo.clear()
+
+def gitCommand(args, path=None):
+    with tracer.span("git "+args[0], "git", args=" ".join(args)):
+        return subprocess.check_output(["git"]+list(args), cwd=path or None, stderr=subprocess.DEVNULL)
+
+gitExecutor = GitExecutor()
+
+def runCommand(commandString, memoize=0):
+    args = shlex.split(commandString)
+    try:
+        if args[0] == "git":
+            output = gitExecutor.command(args[1:], memoize=memoize).result()
         else:
-            with cd(path_to_repository):
-                lines = subprocess.check_output('git show %s:%s'%(branchname, filepath), shell=True).decode('utf-8').splitlines()
-            return [l.rstrip()+"\n" for l in  lines]
+            output = subprocess.check_output(args)
+        return output.decode('utf-8').strip()
     except:
-        #print("file error")
+        print("Error running command:", commandString)
         return ""
 
-def getChangedFilesFromGit(path_to_repository, branch1, branch2, locallyChangedOnly=False):
-    lines=""
-    try:
-        with cd(path_to_repository):
-            if branch1=="" and branch2=="":
-                lines = subprocess.check_output('git diff --ignore-space-at-eol -G. --name-only', shell=True).decode('utf-8').splitlines()
-            elif branch1 == "":
-                    lines = subprocess.check_output('git diff --ignore-space-at-eol -G. --name-only %s'%branch2, shell=True).decode('utf-8').splitlines()
-            else:
-                if branch1==".":
-                    branch1  = getGitCurrentBranch()
-                if branch2==".":
-                    branch2  = getGitCurrentBranch()
-                if locallyChangedOnly:
-                    lines = subprocess.check_output('git diff --ignore-space-at-eol -G. --name-only %s...%s' % (branch2, branch1), shell=True).decode(
-                    'utf-8').splitlines()
-                else:
-                    lines = subprocess.check_output('git diff --ignore-space-at-eol -G. --name-only %s %s' % (branch1, branch2), shell=True).decode(
-                        'utf-8').splitlines()
-        return [l+"\n" for l in  lines]
-    except:
-        print("not a git directory")
-        return subprocess.check_output("ls", shell=True).decode('utf-8').splitlines()
+def getGitToplevelDir():
+    dir = runCommand('git rev-parse --show-toplevel', memoize=GIT_MEMO_SECONDS)
+    if dir == "":
+        print("not a git directory")
+        return ""
+    return dir+'/'
+
+def getGitRefs():
+    """Returns the local and remote branches and the current branch ("" for a detached HEAD),
+    from a single git call."""
+    try:
+        output = gitExecutor.command(["for-each-ref", "--format=%(HEAD)%09%(symref)%09%(refname:short)", "refs/heads", "refs/remotes"],
+                                     memoize=GIT_MEMO_SECONDS).result().decode('utf-8', 'replace')
+    except subprocess.CalledProcessError:
+        print("Error reading the branches")
+        return [], ""
+    branches = []
+    current = ""
+    for line in output.splitlines():
+        head, symref, name = line.split("\t", 2)
+        if symref:
+            continue # e.g. origin/HEAD
+        branches.append(name)
+        if head == "*":
+            current = name
+    return branches, current
+
+def getGitCurrentBranch():
+    return getGitRefs()[1]
+
+def getGitBranchOfCommit(commitHash):
+    name = runCommand('git name-rev %s'%commitHash, memoize=GIT_MEMO_SECONDS).split()
+    if len(name) < 2:
+        return ""
+    return name[1].split('~')[0]
+
+GIT_LOG_FORMAT = "--format=%H%x1f%aI%x1f%an%x1f%s"
+
+def gitLogCommand(revision, file=""):
+    # one NUL terminated record per commit with fields separated by \x1f
+    return ["log", "-z", GIT_LOG_FORMAT, revision, "--"]+([file] if file else [])
+
+def parseLogRecord(record):
+    """Returns (commit, date, author, message) of one `git log -z` record."""
+    fields = record.decode('utf-8', 'replace').split("\x1f")
+    return tuple(fields) if len(fields) == 4 else (fields[0], "", "", "")
+
+def getGitLog(branch="", file=""):
+    reader = getObjectReader()
+    revision = (reader.resolve(branch) or branch) if branch != "" else "HEAD"
+    try:
+        output = reader.command(gitLogCommand(revision, file))
+    except:
+        print("Error running git log on", branch, file)
+        output = b""
+    return [parseLogRecord(record) for record in output.split(b"\0") if record.strip()]
+
+# one record per commit starting with \x1e, followed by the --raw lines of the file
+HISTORY_LOG_FORMAT = "--format=%x1e%H%x1f%P%x1f%aI%x1f%an%x1f%s"
+
+def getFileHistory(path_to_repository, branch, filepath):
+    """Returns the commits of branch that changed filepath, oldest first, as (commit, parent, date,
+    author, message, old blob SHA, new blob SHA) from one `git log --raw` call. Merges are compared
+    with their first parent, so that every step starts from the version of the step before."""
+    reader = getObjectReader(path_to_repository)
+    revision = (reader.resolve(branch) or branch) if branch not in ("", ".") else "HEAD"
+    try:
+        output = reader.command(["log", "-z", "--raw", "--no-abbrev", "--first-parent", "-m",
+                                 HISTORY_LOG_FORMAT, revision, "--", filepath])
+    except subprocess.CalledProcessError:
+        print("Error reading the history of", branch, filepath)
+        return []
+    history = []
+    for record in output.split(b"\x1e"):
+        header, separator, raw = record.partition(b"\0")
+        fields = header.decode('utf-8', 'replace').split("\x1f")
+        changes = [c for c in parseRawDiff(raw.lstrip(b"\n")) if filepath in (c[1], c[2])]
+        if len(fields) != 5 or not changes:
+            continue
+        commit, parents, date, author, message = fields
+        status, oldPath, newPath, oldSha, newSha = changes[0]
+        parent = parents.split(" ")[0]
+        # the versions of all steps are known now and need no lookup when they are shown
+        reader.addToIndex(parent or None, oldPath, oldSha)
+        reader.addToIndex(commit, newPath, newSha)
+        history.append((commit, parent, date, author, message, oldSha, newSha))
+    history.reverse()
+    return history
+
+
+class CommitLogModel(QAbstractListModel):
+    """Commit list of a branch, read from a running `git log` in pages as the view scrolls down.
+    Pages are read by the git executor and appended in the main thread when they arrive."""
+    PAGE_SIZE = 200
+
+    def __init__(self, branch):
+        QAbstractListModel.__init__(self)
+        self.branch = branch
+        self.entries = []
+        self.rows = {} # commit hash -> row
+        self.buffer = b""
+        self.fetching = False
+        self.wanted = None # [commit, callback, resolved] waiting for the page containing the commit
+        self.process = None
+        self.starting = True
+        self.closed = False
+        gitExecutor.request(self.started, self.startLog)
+
+    def startLog(self):
+        """Starts git log in the background, finding the repository runs git too."""
+        try:
+            return getObjectReader().popen(gitLogCommand(self.branch))
+        except:
+            print("Error running git log on", self.branch)
+            return None
+
+    def started(self, process):
+        self.starting = False
+        if self.closed:
+            if process is not None:
+                process.kill()
+                process.wait()
+            return
+        self.process = process
+        if process is not None:
+            self.fetchMore()
+        elif self.wanted is not None:
+            self.continueFind()
+
+    def close(self):
+        self.closed = True
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
 
-def getDivergedFiles(path_to_repository, branch1, branch2):
-    set1 = getChangedFilesFromGit(path_to_repository, branch1, branch2, True)
-    set2 = getChangedFilesFromGit(path_to_repository, branch2, branch1, True)
-    combined = [value for value in set1 if value in set2]
-    return combined 
+    def readPage(self, process, count):
+        """Reads up to count records in the background, returns them and whether git log has finished."""
+        records = []
+        with tracer.span("git log page", "git", branch=self.branch):
+            while len(records) < count:
+                try:
+                    data = process.stdout.read1(65536)
+                except (OSError, ValueError):
+                    data = b"" # closed meanwhile
+                if data == b"":
+                    *complete, _ = (self.buffer+b"\0").split(b"\0")
+                    records.extend(parseLogRecord(r) for r in complete if r.strip())
+                    return records, True
+                self.buffer += data
+                *complete, self.buffer = self.buffer.split(b"\0")
+                records.extend(parseLogRecord(r) for r in complete if r.strip())
+        return records, False
 
-def runCommand(commandString):
-    try:
-        output = subprocess.check_output(commandString, shell=True).decode('utf-8').strip()
-        return output
-    except:
-        print("Error running command:", commandString)
-        return ""
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
 
-def getGitToplevelDir():
-    try:
-        dir = subprocess.check_output('git rev-parse --show-toplevel', shell=True).decode('utf-8').strip()
-        return dir+'/'
-    except:
-        print("not a git directory")
-        return ""
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.process is not None and not self.fetching
 
-def getGitBranches():
-    dir = runCommand('git branch -a')
-    branches = [b.strip("*").strip() for b in dir.splitlines()]
-    return branches
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self.fetching = True
+        process = self.process
+        gitExecutor.request(lambda page: self.appendPage(process, *page), self.readPage, process, self.PAGE_SIZE)
 
-def getGitCurrentBranch():
-    dir = runCommand('git symbolic-ref HEAD --short')
-    return dir
+    def appendPage(self, process, records, finished):
+        self.fetching = False
+        if process is not self.process:
+            return # closed meanwhile
+        if finished:
+            self.close()
+        if records:
+            self.beginInsertRows(QModelIndex(), len(self.entries), len(self.entries)+len(records)-1)
+            for record in records:
+                self.rows[record[0]] = len(self.entries)
+                self.entries.append(record)
+            self.endInsertRows()
+        if self.wanted is not None:
+            self.continueFind()
 
-def getGitBranchOfCommit(commitHash):
-    branch = runCommand('git name-rev %s'%commitHash).split()[1]
-    return branch.split('~')[0]
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.entries):
+            return None
+        commit, date, author, message = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return abbreviateString(author+": "+message, length=50)
+        if role == Qt.ToolTipRole:
+            return date+" - "+author+": "+message
+        return None
 
-def getGitLog(branch="", file=""):
-    output = runCommand('git log --pretty=format:"%H %aI %an: %s" ' + branch + ' -- '+file)
-    log = []
-    for l in output.splitlines():
-        fields = l.split()
-        commit = fields[0]
-        date = fields[1]
-        rest = " ".join(l.split()[2:])
-        author = rest.split(":")[0]
-        message = ":".join(rest.split(":")[1:])
-        log.append((commit, date, author, message))
-    return log
+    def entry(self, row):
+        return self.entries[row]
+
+    def commitOnBranch(self, commit):
+        """The full SHA of commit if it is on the branch, else None. Runs in the background."""
+        reader = getObjectReader()
+        commit = reader.resolve(commit)
+        if commit is None:
+            return None
+        try:
+            reader.command(["merge-base", "--is-ancestor", commit, self.branch])
+        except subprocess.CalledProcessError:
+            return None # not on this branch
+        return commit
+
+    def findCommit(self, commit, callback):
+        """Calls callback(row) with the row of a commit once it is loaded, loading further pages
+        if it is on the branch. The row is -1 if the commit is not found."""
+        if commit in self.rows:
+            callback(self.rows[commit])
+            return
+        self.wanted = [commit, callback, False]
+        gitExecutor.request(lambda resolved: self.startFind(commit, resolved), self.commitOnBranch, commit)
+
+    def startFind(self, commit, resolved):
+        if self.wanted is None or self.wanted[0] != commit:
+            return # another commit is wanted now
+        self.wanted = [resolved, self.wanted[1], True]
+        self.continueFind()
+
+    def continueFind(self):
+        commit, callback, resolved = self.wanted
+        if not resolved:
+            return
+        if commit in self.rows:
+            self.wanted = None
+            callback(self.rows[commit])
+        elif commit is None or (self.process is None and not self.starting):
+            self.wanted = None
+            callback(-1)
+        elif self.starting:
+            return # the first page follows when git log has started
+        else:
+            self.fetchMore()
 
 def abbreviateString(s, length=40):
     if len(s)>length:
@@ -193,48 +2962,177 @@ class GitAnnotation:
     time   = ""
     code   = ""
 
+def parseBlameIncremental(stream):
+    """Parses `git blame --porcelain --incremental` output, yields one list of GitAnnotation per blamed range."""
+    commits = {}
+    group = None
+    for raw in stream:
+        l = raw.decode('utf-8', 'replace').rstrip("\n")
+        if group is None:
+            fields = l.split()
+            if len(fields) != 4:
+                continue
+            group = (fields[0], int(fields[2]), int(fields[3]))
+            info = commits.setdefault(fields[0], {})
+            continue
+        key, _, value = l.partition(" ")
+        if key != "filename":
+            info[key] = value
+            continue
+        commit, first, count = group
+        group = None
+        if "date" not in info:
+            timestamp = int(info.get("author-time", "0"))
+            tz = info.get("author-tz", "+0000")
+            offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))*(-1 if tz[0] == "-" else 1)
+            stamp = datetime.datetime.fromtimestamp(timestamp, datetime.timezone(offset))
+            info["date"], info["time"] = stamp.strftime("%Y-%m-%d"), stamp.strftime("%H:%M:%S")
+        annotations = []
+        for n in range(count):
+            annot = GitAnnotation()
+            annot.line = first-1+n
+            annot.commit = commit
+            annot.author = info.get("author", "")
+            annot.date   = info["date"]
+            annot.time   = info["time"]
+            annotations.append(annot)
+        yield annotations
+
+# blame results per (commit, path), working copy files are keyed by their modification time
+blameCache = OrderedDict()
+blameCacheLock = threading.Lock()
+BLAME_CACHE_ENTRIES = 200
+
+def blameKey(branch, file):
+    file = file.strip()
+    if branch == "":
+        try:
+            stat = os.stat(os.path.join(getObjectReader().path, file))
+        except OSError:
+            return None
+        return ("", file, stat.st_mtime_ns, stat.st_size)
+    commit = getObjectReader().resolve(branch)
+    return (commit, file) if commit is not None else None
+
+def getCachedBlame(key):
+    with blameCacheLock:
+        blame = blameCache.get(key)
+        if blame is not None:
+            blameCache.move_to_end(key)
+        return blame
+
+def storeBlame(key, blame):
+    with blameCacheLock:
+        blameCache[key] = blame
+        while len(blameCache) > BLAME_CACHE_ENTRIES:
+            blameCache.popitem(last=False)
+
+def blameCommand(key):
+    commit, file = key[0], key[1]
+    return ["blame", "--porcelain", "--incremental"]+([commit] if commit != "" else [])+["--", file]
+
+def collectBlame(groups):
+    lines = {}
+    for annotations in groups:
+        for annot in annotations:
+            lines[annot.line] = annot
+    return [lines.get(n) for n in range(max(lines)+1)] if lines else []
+
+@traced("git")
 def getGitBlame(branch = "", file=""):
-    re_blame = re.compile(r"([0-9a-f]+)[\s]+\(([a-zA-Z\s+]+)\s+(\d+\-\d+-\d+)\s(\d+\:\d+\:\d+)\s([\+\-0-9]+)\s+(\d+)\)(.*)")
-    
-    
-    output = runCommand('git blame -cl ' + branch + ' -- '+file)
-    output = output.splitlines()
-    
-    annotation = []
-    for ln, l in enumerate(output):
-        parse = re_blame.match(l).groups()
-        annot = GitAnnotation()
-        annot.line = ln
-        annot.commit = parse[0]
-        annot.author = parse[1]
-        annot.date   = parse[2]
-        annot.time   = parse[3]
-        annot.code   = parse[6]
-        annotation.append(annot)
-        
-    return annotation
+    key = blameKey(branch, file)
+    if key is None:
+        return []
+    blame = getCachedBlame(key)
+    if blame is None:
+        try:
+            process = getObjectReader().popen(blameCommand(key))
+            blame = collectBlame(parseBlameIncremental(process.stdout))
+            process.wait()
+        except:
+            print("Error running git blame on", branch, file)
+            return []
+        storeBlame(key, blame)
+    return blame
+
+
+class BlameThread(QThread):
+    """Runs git blame in the background and streams the annotated lines in batches."""
+    annotated = pyqtSignal(object, object) # key, list of GitAnnotation
+    completed = pyqtSignal(object, object) # key, complete blame
+
+    def __init__(self, key):
+        QThread.__init__(self)
+        self.key = key
+        self.process = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process is not None:
+            self.process.kill()
+
+    def run(self):
+        try:
+            self.process = getObjectReader().popen(blameCommand(self.key))
+        except:
+            print("Error running git blame on", self.key)
+            return
+        if self.cancelled:
+            self.process.kill()
+        groups = []
+        batch = []
+        lastEmit = time.time()
+        with tracer.span("git blame", "git", file=self.key[1]):
+            for annotations in parseBlameIncremental(self.process.stdout):
+                batch.extend(annotations)
+                groups.append(annotations)
+                if len(batch) > 1000 or time.time()-lastEmit > 0.1:
+                    self.annotated.emit(self.key, batch)
+                    batch = []
+                    lastEmit = time.time()
+            self.process.wait()
+        if self.cancelled or self.process.returncode != 0:
+            return
+        if batch:
+            self.annotated.emit(self.key, batch)
+        blame = collectBlame(groups)
+        storeBlame(self.key, blame)
+        self.completed.emit(self.key, blame)
+
+# syntax highlighting by file suffix, lexers are created when a file of their language is first shown
+LEXER_SUFFIXES = {"c":"cpp", "h":"cpp", "cpp":"cpp", "cc":"cpp", "cxx":"cpp", "hpp":"cpp", "py":"python", "sh":"bash"}
+LEXER_CLASSES = {"cpp": QsciLexerCPP, "python": QsciLexerPython, "bash": QsciLexerBash}
+
+@functools.lru_cache(maxsize=None)
+def editorStyles():
+    """Returns the author and timeline margin styles, which all editors share."""
+    colormap = ['77AADD', '99DDFF', '44BB99', 'BBCC33', 'AAAA00', 'EEDD88', 'EE8866', 'FFAABB', 'DDDDDD']
+
+    authorColors = [QsciStyle() for x in colormap]
+    for index, x in enumerate(colormap):
+        authorColors[index].setPaper(QColor("#ff"+x))
+        authorColors[index].setColor(QColor("#ff000000"))
+
+    timelineColors = [QsciStyle() for x in range(0, 15)]
+    for index, x in enumerate(timelineColors):
+        r=128
+        g=int(255-(index*100/len(timelineColors)))
+        b=128
+        timelineColors[index].setPaper(QColor("#88{:02X}{:02X}{:02X}".format(r,g,b)))
+        timelineColors[index].setColor(QColor("#88000000"))
+    return authorColors, timelineColors
+
+# markers of the lines of changed rows: the background and the margin of changes, and of conflicts
+CHANGE_MARKERS = {CHANGED: 0b11, CONFLICT: 0b110}
 
 class EditorWidget(QWidget):
     def __init__(self, parent=None):
         QWidget.__init__(self)
         self.parent=parent
-        self.lexers={"cpp":QsciLexerCPP(), "python":QsciLexerPython()}
-        self.suffixToLexer={"c":"cpp", "h":"cpp", "cpp":"cpp", "py":"python", "sh":"bash"}
-        colormap = ['77AADD', '99DDFF', '44BB99', 'BBCC33', 'AAAA00', 'EEDD88', 'EE8866', 'FFAABB', 'DDDDDD']
-        
-        self.authorColors = [QsciStyle() for x in colormap]
-        for index, x in enumerate(colormap):
-            self.authorColors[index].setPaper(QColor("#ff"+x))
-            self.authorColors[index].setColor(QColor("#ff000000"))
-            
-        self.timelineColors = [QsciStyle() for x in range(0, 15)]
-        for index, x in enumerate(self.timelineColors):
-            r=128
-            g=int(255-(index*100/len(self.timelineColors)))
-            b=128
-            self.timelineColors[index].setPaper(QColor("#88{:02X}{:02X}{:02X}".format(r,g,b)))
-            self.timelineColors[index].setColor(QColor("#88000000"))
-            
+        self.lexers={} # language -> lexer of this editor
+        self.authorColors, self.timelineColors = editorStyles()
+
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
         self.toolbar=QWidget()
@@ -246,7 +3144,17 @@ class EditorWidget(QWidget):
         self.configureEditor(self.editor)
         
         self.filename=None
-        self.rawText=None
+        self.aligned = None # the AlignedDiff shown
+        self.side = 0       # which of its files, 0 for left and 1 for right
+        self.excerpt = False
+        self.lineRows = array('i')        # row of the AlignedDiff shown in each line
+        self.intralinePainted = bytearray() # lines whose changed characters are marked
+        self.edited = False # the text has been edited since the last update, lineRows may not fit it
+        self.blame = None
+        self.blameKey = None
+        self.blameRequest = None # (branch, file) whose blame key is being resolved
+        self.blameThread = None
+        self.blameThreads = set()
         self.saveButton = QPushButton("save")
         self.saveButton.setFixedWidth(80)
         self.saveButton.setDisabled(True)
@@ -264,18 +3172,15 @@ class EditorWidget(QWidget):
         self.toolbarLayout.setContentsMargins(0, 0, 0, 0)
         self.layout.setContentsMargins(0, 0, 0, 0)
 
-        self.marginTextStyle= QsciStyle()
-        self.marginTextStyle.setPaper(QColor("#ffFF8888"))
-
-        
-
         if parent is not None: # connect to update for text change
             self.editor.textChanged.connect(self.parent.updateAfterEdit)
+        self.editor.textChanged.connect(self.textEdited)
+        # the changed characters are marked for the lines that come into view
+        self.editor.SCN_PAINTED.connect(self.paintIntraline)
 
 
     def configureEditor(self, editor):
-        self.__lexer = self.lexers["cpp"]
-        editor.setLexer(self.__lexer)
+        self.__lexer = None # set when the first file is shown
         #editor.setMarginType(1, QsciScintilla.TextMargin)
         editor.setMarginType(1, QsciScintilla.SymbolMargin)
         editor.setMarginType(2, QsciScintilla.TextMargin) #margin for author/blame info
@@ -287,7 +3192,7 @@ class EditorWidget(QWidget):
         
         editor.setMarginMarkerMask(1, 0b11)
         editor.setMarginMarkerMask(0, 0b11)
-        editor.setMarginMarkerMask(3, 0b11111111111111100)
+        editor.setMarginMarkerMask(3, 0b11111111111111000)
         editor.setMarginsForegroundColor(QColor("#ffFF8888"))
         editor.markerDefine(QsciScintilla.Background, 0)
         editor.setMarkerBackgroundColor(QColor("#22FF8888"),0)
@@ -295,6 +3200,8 @@ class EditorWidget(QWidget):
         editor.markerDefine(QsciScintilla.Rectangle, 1)
         editor.setMarkerBackgroundColor(QColor("#ffFF8888"),1)
         editor.setMarkerForegroundColor(QColor("#ffFF8888"),1)
+        editor.markerDefine(QsciScintilla.Background, 2) # conflicts of a three-way view
+        editor.setMarkerBackgroundColor(QColor("#44FFAA00"),2)
         
         for idx, col in enumerate(self.timelineColors):
             editor.markerDefine(QsciScintilla.Rectangle, idx+3)
@@ -308,16 +3215,27 @@ class EditorWidget(QWidget):
         editor.setIndicatorForegroundColor(QColor("#44FF8888"),0)
         editor.setAnnotationDisplay(QsciScintilla.AnnotationStandard)
 
+    def lexer(self, fileSuffix):
+        """Returns the lexer for files with fileSuffix, None for unknown suffixes."""
+        language = LEXER_SUFFIXES.get(fileSuffix)
+        if language is None:
+            return None
+        if language not in self.lexers:
+            self.lexers[language] = LEXER_CLASSES[language]()
+        return self.lexers[language]
+
     def timelineLeftClick(self, margin_nr, line_nr, state):
-        if self.blame is not None:
+        if self.blame and line_nr < len(self.blame) and self.blame[line_nr] is not None:
             ln = self.blame[line_nr]
             print(line_nr, ln.commit, ln.date, ln.time, ln.author)
-            branchName = getGitBranchOfCommit(ln.commit)
-            print("commit is on branch", branchName)
-            self.parent.branch2 = ln.commit
-            self.parent.rightBranchSelector.setSelection(branchName)
-            self.parent.rightBranchSelector.setCommit(ln.commit)
-            self.parent.updateDiffView()
+            gitExecutor.request(lambda branchName: self.jumpToCommit(ln.commit, branchName), getGitBranchOfCommit, ln.commit)
+
+    def jumpToCommit(self, commit, branchName):
+        print("commit is on branch", branchName)
+        self.parent.branch2 = commit
+        self.parent.rightBranchSelector.setSelection(branchName)
+        self.parent.rightBranchSelector.setCommit(commit)
+        self.parent.updateDiffView()
 
     def timelineRightClick(self, margin_nr, line_nr, state):
         print("Margin clicked (right mouse btn)!")
@@ -327,35 +3245,30 @@ class EditorWidget(QWidget):
 
 
     def refreshText(self):
-        self.updateText(self.rawText, self.branch, self.filename)
+        if self.aligned is None:
+            return # nothing loaded yet, the file is shown with the current options once it arrives
+        self.updateText(self.aligned, self.side, self.branch, self.filename)
 
-    def updateText(self, text, branch, filename, fileSuffix="c"):
+    @traced("render")
+    def updateText(self, aligned, side, branch, filename, fileSuffix="c"):
+        """Shows one side of an AlignedDiff. An excerpt of a huge file is read-only and has no
+        blame, its lines are not the lines of the file."""
+        excerpt = aligned.excerpt
         self.editor.blockSignals(True) # turn off signals to avoid update loops
         self.branch = branch
-        self.rawText = text
+        self.aligned = aligned
+        self.side = side
+        self.excerpt = excerpt
+        self.editor.setReadOnly(aligned.readOnly)
 
         self.blame = None
+        self.blameKey = None
+        self.blameRequest = None
         self.editor.setMarginWidth(2, 0) # hide blame margin by default
         self.editor.setMarginWidth(3, 0)
-        authors = defaultdict(lambda: 0)
-        times = defaultdict(lambda: 0)
         
-        if self.annotateCheckbox.isChecked():
-            self.blame = getGitBlame(self.branch, filename)
-            for ln in self.blame:
-                authors[ln.author] = authors[ln.author]+1  #count contributions, and sort top-down
-                times[ln.date] = 0
-                
-            sort_authors = sorted(authors.items(), key=lambda x: x[1], reverse=True)
-            sort_times = sorted(times.items(), key=lambda x: x[0], reverse=True)
-            #rebuild author dict with descending ID by contributions
-            for index, rec in enumerate(sort_authors):
-                authors[rec[0]] = [index, rec[1]]
-            # index all commit times new to old
-            for index, rec in enumerate(sort_times):
-                times[rec[0]] = index
-            #print(times.items())
-            #print(authors.items())
+        if self.annotateCheckbox.isChecked() and not excerpt:
+            self.requestBlame(branch, filename)
             self.editor.setMarginWidth(2, "0000") # show blame margin
             self.editor.setMarginWidth(3, "0000") # show timeline margin
         
@@ -366,6 +3279,8 @@ class EditorWidget(QWidget):
         else:
             self.saveButton.setText("checkout")
             self.saveButton.setDisabled(False)
+        if excerpt:
+            self.saveButton.setDisabled(True)
 
         firstLine = 0
         cursorLine = 0
@@ -375,69 +3290,255 @@ class EditorWidget(QWidget):
             cursorLine, cursorIndex = self.editor.getCursorPosition()
         self.filename = filename # store filename
         label = branch+":"+filename
-        if fileSuffix in self.suffixToLexer.keys():
-            self.__lexer = self.lexers[self.suffixToLexer[fileSuffix]]
+        if excerpt:
+            label += "  (changes of a large file)"
+        lexer = self.lexer(fileSuffix)
+        if lexer is not None and self.__lexer is not lexer:
+            self.__lexer = lexer
             self.editor.setLexer(self.__lexer)
-            #label+="     ("+self.suffixToLexer[fileSuffix]+")"
         
         
         
         self.editor.setMarginsBackgroundColor(QColor("#ff888888"))
-        self.editor.clearAnnotations(-1)
-        self.editor.setText("")
         self.label.setText(label)
-        skipped_lines = 0
-        annotation=None
-
-        for linenumber, l in enumerate(text):
-            idx=linenumber-skipped_lines
-            if l is None:
-                #editor.append("\n")
-                if annotation is None:
-                    annotation="<"
-                else:
-                    annotation+="\n<"
-                skipped_lines+=1
-                #self.editor.setMarginText(idx, "~", marginTextStyle)
-                self.editor.markerAdd(idx, 1)
-            else:
 
-                if '\0' in l or '\1' in l:
-                    self.editor.append(l.replace('\0+', '').replace('\0-', '').replace('\m', '').replace('\0^', '').replace('\1', ''))
-                    self.editor.markerAdd(idx, 0)
-                    self.editor.markerAdd(idx, 1)
-                    #self.editor.setMarginText(idx, l[1], marginTextStyle)
-                    ind_left = l.find('\0')
-                    ind_right = l.rfind("\1")
-                    #print(ind_left, ind_right, len(l))
-                    self.editor.fillIndicatorRange(idx, ind_left, idx, ind_right, 0)
-                else:
-                    self.editor.append(l)
-                    
-                bltag = ""
-                if self.blame is not None:
-                    author_idx= min(authors[self.blame[idx].author][0], len(self.authorColors)-1) # get color index 
-                    time_idx = min(times[self.blame[idx].date], len(self.timelineColors)-2)
-                    bltag = "".join([a[0] for a in self.blame[idx].author.split()])
-                    self.editor.setMarginText(idx, bltag, self.authorColors[author_idx])
-                    #self.editor.setMarginText(idx, bltag, self.timelineColors[time_idx])
-                    self.editor.markerAdd(idx, time_idx+3)
-                    #self.editor.fillIndicatorRange(idx, ind_left, idx, ind_right, 0)
-                    
-                if annotation is not None:
-                    if (idx>0):
-                        self.editor.annotate(idx-1, annotation, 0)
-                    else:
-                        #self.editor.append("\n")
-                        self.editor.annotate(idx, annotation, 0)
-                    annotation=None
+        # build the whole document and its decorations first, then hand them to Scintilla in bulk
+        document, markers, lineRows, annotations = self.renderPlan(aligned, side, 0, len(aligned))
+        self.lineRows = lineRows
+        self.intralinePainted = bytearray(len(lineRows))
+        self.edited = False
+        self.editor.setUpdatesEnabled(False)
+        self.editor.clearAnnotations(-1)
+        self.editor.SendScintilla(QsciScintillaBase.SCI_SETUNDOCOLLECTION, False)
+        self.editor.setText(document)
+        self.editor.setModified(False)
+        self.editor.SendScintilla(QsciScintillaBase.SCI_EMPTYUNDOBUFFER)
+        self.editor.SendScintilla(QsciScintillaBase.SCI_SETUNDOCOLLECTION, True)
+        self.applyDecorations(markers, annotations)
+        self.editor.setUpdatesEnabled(True)
         self.editor.setFirstVisibleLine(firstLine)
         self.editor.setCursorPosition(cursorLine, cursorIndex)
         self.editor.blockSignals(False) # turn signals on again
+        self.paintIntraline()
+
+    def renderPlan(self, aligned, side, rowStart, rowEnd):
+        """Turns the rows [rowStart, rowEnd) of one side of an AlignedDiff into the document text,
+        a marker mask per line, the row of each line and pad annotations (line, text)."""
+        indices, source = aligned.column(side)
+        flags = aligned.sideFlags(side)
+        lines = []
+        markers = []
+        lineRows = array('i')
+        annotations = []
+        pads = 0
+        for row, index, flag in zip(range(rowStart, rowEnd), indices[rowStart:rowEnd], flags[rowStart:rowEnd]):
+            if index >= 0:
+                line = source[index]
+            else:
+                line = aligned.text(side, row) if flag == GAP else None
+                if line is None:
+                    pads += 1
+                    continue
+            if pads > 0:
+                # pad lines of the other side are shown as annotation below the previous line
+                annotations.append((len(lines)-1, "\n".join(["<"]*pads)))
+                pads = 0
+            markers.append(CHANGE_MARKERS.get(flag, 0))
+            lineRows.append(row)
+            lines.append(line)
+        if pads > 0:
+            annotations.append((len(lines)-1, "\n".join(["<"]*pads)))
+        return "".join(lines), markers, lineRows, annotations
+
+    def applyDecorations(self, markers, annotations, firstLine=0):
+        send = self.editor.SendScintilla
+        for line, mask in enumerate(markers, firstLine):
+            if mask:
+                send(QsciScintillaBase.SCI_MARKERADDSET, line, mask)
+        for line, annotation in annotations:
+            # pads before the first line are shown below line 0
+            line = max(firstLine+line, 0)
+            send(QsciScintillaBase.SCI_ANNOTATIONSETTEXT, line, annotation.encode('utf-8'))
+            send(QsciScintillaBase.SCI_ANNOTATIONSETSTYLE, line, 0)
+
+    @traced("render")
+    def patchText(self, aligned, rowStart, rowEnd):
+        """Shows aligned, which differs from the current diff only in the rows [rowStart, rowEnd),
+        by redecorating the lines of these rows. The editor must already contain their text (e.g.
+        after an edit)."""
+        self.aligned = aligned
+        lineStart = aligned.linesBefore(self.side, rowStart)
+        lineEnd = aligned.linesBefore(self.side, rowEnd)
+        send = self.editor.SendScintilla
+        self.editor.blockSignals(True)
+        for line in range(lineStart, lineEnd):
+            send(QsciScintillaBase.SCI_MARKERDELETE, line, 0)
+            send(QsciScintillaBase.SCI_MARKERDELETE, line, 1)
+        start = send(QsciScintillaBase.SCI_POSITIONFROMLINE, lineStart)
+        end = send(QsciScintillaBase.SCI_POSITIONFROMLINE, lineEnd) if lineEnd < self.editor.lines() else self.editor.length()
+        send(QsciScintillaBase.SCI_SETINDICATORCURRENT, 0)
+        send(QsciScintillaBase.SCI_INDICATORCLEARRANGE, start, end-start)
+        for line in range(max(lineStart-1, 0), lineEnd):
+            self.editor.clearAnnotations(line)
+        document, markers, lineRows, annotations = self.renderPlan(aligned, self.side, rowStart, rowEnd)
+        self.applyDecorations(markers, annotations, firstLine=lineStart)
+        # the lines below keep their marks, their rows move with the rows of the patch
+        indices = aligned.column(self.side)[0]
+        tail = array('i', itertools.compress(range(rowEnd, len(aligned)), map((0).__le__, indices[rowEnd:])))
+        painted = self.intralinePainted
+        self.lineRows = self.lineRows[:lineStart]+lineRows+tail
+        self.intralinePainted = painted[:lineStart]+bytearray(len(lineRows))+painted[len(painted)-len(tail):]
+        self.edited = False
+        self.editor.blockSignals(False)
+        self.paintIntraline()
+
+    def textEdited(self):
+        self.edited = True
+
+    def paintIntraline(self):
+        """Marks the changed characters of the changed lines in view that are not marked yet."""
+        aligned = self.aligned
+        if aligned is None or self.edited or self.editor.signalsBlocked():
+            return
+        send = self.editor.SendScintilla
+        first = send(QsciScintillaBase.SCI_DOCLINEFROMVISIBLE, self.editor.firstVisibleLine())
+        last = min(first+send(QsciScintillaBase.SCI_LINESONSCREEN)+1, len(self.lineRows))
+        painted = self.intralinePainted
+        if all(painted[first:last]):
+            return
+        indices, source = aligned.column(self.side)
+        send(QsciScintillaBase.SCI_SETINDICATORCURRENT, 0)
+        for line in range(first, last):
+            if painted[line]:
+                continue
+            painted[line] = 1
+            row = self.lineRows[line]
+            offsets = aligned.rowMarks(self.side, row)
+            if offsets and offsets[-1] > offsets[0]:
+                text = source[indices[row]]
+                # indicator positions are byte offsets into the UTF-8 document
+                position = send(QsciScintillaBase.SCI_POSITIONFROMLINE, line)+len(text[:offsets[0]].encode('utf-8'))
+                send(QsciScintillaBase.SCI_INDICATORFILLRANGE, position, len(text[offsets[0]:offsets[-1]].encode('utf-8')))
+
+    def requestBlame(self, branch, filename):
+        """Resolves the blame key in the background, then takes the blame from the cache or
+        starts streaming it from git."""
+        self.blame = []
+        self.blameRequest = request = (branch, filename)
+        gitExecutor.request(lambda key: self.startBlame(request, key), blameKey, branch, filename)
+
+    def startBlame(self, request, key):
+        if request != self.blameRequest or self.blame is None:
+            return # another file is shown meanwhile, or without blame
+        self.blameKey = key
+        if self.blameThread is not None and self.blameThread.key != self.blameKey:
+            self.blameThread.cancel()
+            self.blameThread = None
+        if self.blameKey is None:
+            return
+        blame = getCachedBlame(self.blameKey)
+        if blame is not None:
+            self.blame = blame
+            self.applyBlame(range(len(blame)))
+        elif self.blameThread is None:
+            self.blameThread = BlameThread(self.blameKey)
+            self.blameThread.annotated.connect(self.blameAnnotated)
+            self.blameThread.completed.connect(self.blameCompleted)
+            # keep a reference until the thread has finished, also when it is replaced
+            self.blameThreads.add(self.blameThread)
+            self.blameThread.finished.connect(functools.partial(self.blameThreadFinished, self.blameThread))
+            self.blameThread.start()
+
+    def blameThreadFinished(self, thread):
+        self.blameThreads.discard(thread)
+        if self.blameThread is thread:
+            self.blameThread = None
+
+    def blameAnnotated(self, key, annotations):
+        if key != self.blameKey or self.blame is None:
+            return
+        lineCount = max(annot.line for annot in annotations)+1
+        if lineCount > len(self.blame):
+            self.blame = self.blame+[None]*(lineCount-len(self.blame))
+        for annot in annotations:
+            self.blame[annot.line] = annot
+        self.applyBlame([annot.line for annot in annotations])
+
+    def blameCompleted(self, key, blame):
+        if key != self.blameKey or self.blame is None:
+            return
+        # colors depend on all lines, so the final result is applied once more
+        self.blame = blame
+        for idx in range(len(self.timelineColors)):
+            self.editor.SendScintilla(QsciScintillaBase.SCI_MARKERDELETEALL, idx+3)
+        self.applyBlame(range(len(blame)))
+
+    def blameRanking(self):
+        authors = defaultdict(lambda: 0)
+        times = defaultdict(lambda: 0)
+        for ln in self.blame:
+            if ln is None:
+                continue
+            authors[ln.author] = authors[ln.author]+1  #count contributions, and sort top-down
+            times[ln.date] = 0
+        sort_authors = sorted(authors.items(), key=lambda x: x[1], reverse=True)
+        sort_times = sorted(times.items(), key=lambda x: x[0], reverse=True)
+        #rebuild author dict with descending ID by contributions
+        for index, rec in enumerate(sort_authors):
+            authors[rec[0]] = [index, rec[1]]
+        # index all commit times new to old
+        for index, rec in enumerate(sort_times):
+            times[rec[0]] = index
+        return authors, times
+
+    @traced("render")
+    def applyBlame(self, lines):
+        send = self.editor.SendScintilla
+        authors, times = self.blameRanking()
+        appliedStyles = set()
+        lineCount = self.editor.lines()
+        for idx in lines:
+            if idx >= lineCount or idx >= len(self.blame) or self.blame[idx] is None:
+                continue
+            author_idx= min(authors[self.blame[idx].author][0], len(self.authorColors)-1) # get color index 
+            time_idx = min(times[self.blame[idx].date], len(self.timelineColors)-2)
+            bltag = "".join([a[0] for a in self.blame[idx].author.split()])
+            style = self.authorColors[author_idx]
+            if author_idx not in appliedStyles:
+                # the first use of a style goes through QScintilla, which registers it with the editor
+                self.editor.setMarginText(idx, bltag, style)
+                appliedStyles.add(author_idx)
+            else:
+                send(QsciScintillaBase.SCI_MARGINSETTEXT, idx, bltag.encode('utf-8'))
+                send(QsciScintillaBase.SCI_MARGINSETSTYLE, idx, style.style())
+            send(QsciScintillaBase.SCI_MARKERADD, idx, time_idx+3)
 
     def getText(self):
         return self.editor.text().splitlines(True)
 
+    def replaceLines(self, lines):
+        """Changes the text to lines, replacing only the lines that differ."""
+        old = self.getText()
+        prefix = 0
+        while prefix < len(old) and prefix < len(lines) and old[prefix] == lines[prefix]:
+            prefix += 1
+        if prefix == len(old) == len(lines):
+            return
+        suffix = 0
+        while suffix < len(old)-prefix and suffix < len(lines)-prefix and old[-1-suffix] == lines[-1-suffix]:
+            suffix += 1
+        send = self.editor.SendScintilla
+        lineEnd = len(old)-suffix
+        start = send(QsciScintillaBase.SCI_POSITIONFROMLINE, prefix)
+        end = send(QsciScintillaBase.SCI_POSITIONFROMLINE, lineEnd) if lineEnd < self.editor.lines() else self.editor.length()
+        text = "".join(lines[prefix:len(lines)-suffix]).encode('utf-8')
+        self.editor.blockSignals(True)
+        send(QsciScintillaBase.SCI_SETTARGETSTART, start)
+        send(QsciScintillaBase.SCI_SETTARGETEND, end)
+        send(QsciScintillaBase.SCI_REPLACETARGET, len(text), text)
+        self.editor.setModified(False)
+        self.editor.blockSignals(False)
+
     def saveText(self):
         if self.branch == "":
             f=open(self.filename, "w")
@@ -470,45 +3571,78 @@ class BranchSelector(QWidget):
         #self.layout.addWidget(self.commitSlider)
         self.menulayout.setContentsMargins(0,0,0,0)
         self.layout.setContentsMargins(0,0,0,0)
-        self.gitlog = None
+        self.commitLog = None
+        self.commitMenuGeneration = 0
+        self.pendingCommit = None # commit to select when the commit list has been read
+        self.commitIndex = -1
+
+    def setBranches(self, branches, selection):
+        """Replaces the branch list and selects selection without notifying the callback."""
+        self.branchesMenu.blockSignals(True)
+        self.branchesMenu.clear()
+        self.branchesMenu.addItems(branches)
+        self.branchesMenu.setCurrentIndex(max(self.branchesMenu.findText(selection), 0))
+        self.branchesMenu.blockSignals(False)
+        self.updateCommitMenu()
 
     def setSelection(self, selection):
         index = self.branchesMenu.findText(selection)
         print("found selection", selection)
-        if index >= 0 and index!=self.commitMenu.currentIndex():
+        if index >= 0 and index!=self.branchesMenu.currentIndex():
             self.branchesMenu.setCurrentIndex(index)
         else:
             print("selection not found")
 
     def setCommit(self, commit):
-        index = [x[0] for x in self.gitlog].index(commit)
+        """Selects commit once the commit list has been read that far, if it is on the branch."""
+        self.pendingCommit = commit
+        if self.commitLog is not None:
+            log = self.commitLog
+            log.findCommit(commit, lambda index: self.commitFound(log, commit, index))
+
+    def commitFound(self, log, commit, index):
+        if log is not self.commitLog or commit != self.pendingCommit:
+            return # the branch or the wanted commit has changed meanwhile
+        self.pendingCommit = None
         if index >= 0:
             self.commitMenu.setCurrentIndex(index)
-            print("jumping to commit ", self.gitlog[index])
+            print("jumping to commit ", self.commitLog.entry(index))
         else:
             print("commit not found", commit)
 
     def updateCommitMenu(self):
         selectedBranch = self.branchesMenu.currentText()
-        if selectedBranch ==".":
-            selectedBranch = getGitCurrentBranch()
-        if selectedBranch == "":
-            self.gitlog = None
-        else:
-            self.gitlog = getGitLog(branch=selectedBranch)
         print ("updating commit list...")
+        self.commitMenuGeneration += 1
+        generation = self.commitMenuGeneration
         self.commitMenu.blockSignals(True)
-        self.commitMenu.clear()
-        if self.gitlog is None or len(self.gitlog) == 0:
-            return
-        print(self.gitlog[0])
-        self.commitMenu.addItems([abbreviateString(log[2]+": "+log[3], length=50) for log in self.gitlog])
-        for i in range(0, len(self.gitlog)):
-            self.commitMenu.setItemData(i, self.gitlog[i][1]+" - "+self.gitlog[i][2]+": "+self.gitlog[i][3], Qt.ToolTipRole)
+        if self.commitLog is not None:
+            self.commitLog.close()
+        self.commitLog = None
+        self.commitMenu.setModel(QStandardItemModel())
+        self.commitIndex = -1
+        self.commitMenu.blockSignals(False)
+        self.updateCommitSlider()
+        if selectedBranch ==".":
+            gitExecutor.request(lambda branch: self.showCommitLog(generation, branch), getGitCurrentBranch)
+        elif selectedBranch != "":
+            self.showCommitLog(generation, selectedBranch)
 
+    def showCommitLog(self, generation, branch):
+        if generation != self.commitMenuGeneration:
+            return # another branch has been selected meanwhile
+        self.commitMenu.blockSignals(True)
+        self.commitLog = CommitLogModel(branch)
+        self.commitLog.rowsInserted.connect(self.updateCommitSlider)
+        self.commitMenu.setModel(self.commitLog)
+        self.commitMenu.setCurrentIndex(0)
         self.commitMenu.blockSignals(False)
+        if self.pendingCommit is not None:
+            self.setCommit(self.pendingCommit)
+
+    def updateCommitSlider(self, *args):
         self.commitSlider.setMinimum(0)
-        self.commitSlider.setMaximum(len(self.gitlog))
+        self.commitSlider.setMaximum(self.commitLog.rowCount() if self.commitLog is not None else 0)
 
     def selectionChange(self, i):
         self.updateCommitMenu()
@@ -516,75 +3650,622 @@ class BranchSelector(QWidget):
             self.callback()
 
     def commitChange(self, i):
+        previous, self.commitIndex = self.commitIndex, i
+        if previous == -1:
+            return # the first page has arrived, its first commit is the branch that is shown already
         if self.callback is not None:
             self.callback()
 
     def getCurrentBranch(self):
         #return self.branchesMenu.currentText()
-        if self.gitlog is not None:
-            return self.gitlog[self.commitMenu.currentIndex()][0]
+        if self.commitLog is not None and self.commitMenu.currentIndex() >= 0:
+            return self.commitLog.entry(self.commitMenu.currentIndex())[0]
         else:
             return self.branchesMenu.currentText()
 
 
+UNKNOWN, BINARY = -1, -2 # values of the line count columns of the file list
+
+class FileListModel(QAbstractListModel):
+    """Changed files of a comparison, stored in columns: the paths in git's order, their numstat
+    counts (BINARY for binary files) and aligned sizes, UNKNOWN until known. Labels are made
+    when the view asks for them. A filter by substring, or by extension as "*.ext", hides the
+    other files, narrowing the previous filter when it is extended."""
+    def __init__(self):
+        QAbstractListModel.__init__(self)
+        self.paths = []
+        self.rows = {} # path -> index in paths
+        self.leftPaths = {} # path -> path on the left side, for files renamed there
+        self.added = array('i')
+        self.deleted = array('i')
+        self.sizes = array('i')
+        self.filterText = ""
+        self.shown = None # indices of the paths matching the filter, None without a filter
+
+    def setFiles(self, paths, numstat, leftPaths={}):
+        self.beginResetModel()
+        self.paths = paths
+        self.leftPaths = leftPaths
+        self.rows = {path: index for index, path in enumerate(paths)}
+        self.added = array('i', [UNKNOWN])*len(paths)
+        self.deleted = array('i', [UNKNOWN])*len(paths)
+        self.sizes = array('i', [UNKNOWN])*len(paths)
+        for path, counts in numstat.items():
+            self.setCounts(self.rows.get(path), counts)
+        self.shown = self.match(self.filterText, range(len(paths)))
+        self.endResetModel()
+
+    def setCounts(self, index, counts):
+        if index is not None and counts != ():
+            self.added[index], self.deleted[index] = counts if counts is not None else (BINARY, BINARY)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.paths) if self.shown is None else len(self.shown)
+
+    def entry(self, row):
+        """Index in paths of a row of the view."""
+        return row if self.shown is None else self.shown[row]
+
+    def path(self, row):
+        return self.paths[self.entry(row)]
+
+    def rowOfEntry(self, index):
+        """Row of paths[index] in the view, -1 if it is filtered out."""
+        if self.shown is None:
+            return index
+        row = bisect.bisect_left(self.shown, index)
+        return row if row < len(self.shown) and self.shown[row] == index else -1
+
+    def rowOfPath(self, path):
+        """Row of path in the view, -1 if it is not listed or filtered out."""
+        index = self.rows.get(path)
+        return -1 if index is None else self.rowOfEntry(index)
+
+    def label(self, index):
+        path = self.paths[index]
+        if self.added[index] == BINARY:
+            return path+": (binary)"
+        if self.sizes[index] != UNKNOWN:
+            return path+": (%i)"%self.sizes[index]
+        if self.added[index] != UNKNOWN:
+            return path+": (+%i -%i)"%(self.added[index], self.deleted[index])
+        return path+": (...)"
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid() and index.row() < self.rowCount():
+            return self.label(self.entry(index.row()))
+        return None
+
+    def setSizes(self, sizes):
+        """Sets the sizes of a batch of (path, size) and updates the view once."""
+        rows = []
+        for path, size in sizes:
+            index = self.rows.get(path)
+            if index is not None:
+                self.sizes[index] = size
+                rows.append(self.rowOfPath(path))
+        rows = [r for r in rows if r >= 0]
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)), [Qt.DisplayRole])
+
+    def matcher(self, text):
+        """Returns a function telling whether a path matches the filter text."""
+        if text.startswith("*."):
+            suffix = text[1:].lower()
+            return lambda path: path.lower().endswith(suffix)
+        text = text.lower()
+        return lambda path: text in path.lower()
+
+    def match(self, text, indices):
+        """The indices of paths matching the filter text, None for an empty filter."""
+        if text == "":
+            return None
+        matches = self.matcher(text)
+        paths = self.paths
+        return array('i', [i for i in indices if matches(paths[i])])
+
+    def setFilter(self, text):
+        # an extended substring only matches paths that matched before
+        narrowing = self.shown is not None and not self.filterText.startswith("*.") and text.startswith(self.filterText)
+        self.beginResetModel()
+        self.shown = self.match(text, self.shown if narrowing else range(len(self.paths)))
+        self.filterText = text
+        self.endResetModel()
+
+    def updateFiles(self, removed, paths, numstat):
+        """Removes the paths in removed and adds or updates paths (both sorted like git does),
+        moving the other rows instead of resetting the view."""
+        matches = self.matcher(self.filterText) if self.shown is not None else None
+        for path in removed:
+            index = bisect.bisect_left(self.paths, path)
+            if index == len(self.paths) or self.paths[index] != path:
+                continue
+            row = self.rowOfEntry(index)
+            if row >= 0:
+                self.beginRemoveRows(QModelIndex(), row, row)
+            del self.paths[index]
+            for column in (self.added, self.deleted, self.sizes):
+                del column[index]
+            if self.shown is not None:
+                if row >= 0:
+                    del self.shown[row]
+                self.shiftShown(index, -1)
+            if row >= 0:
+                self.endRemoveRows()
+        for path in paths:
+            index = bisect.bisect_left(self.paths, path)
+            if index == len(self.paths) or self.paths[index] != path:
+                shown = matches is None or matches(path)
+                row = index if self.shown is None else bisect.bisect_left(self.shown, index)
+                if shown:
+                    self.beginInsertRows(QModelIndex(), row, row)
+                self.paths.insert(index, path)
+                for column in (self.added, self.deleted, self.sizes):
+                    column.insert(index, UNKNOWN)
+                if self.shown is not None:
+                    self.shiftShown(index, 1)
+                    if shown:
+                        self.shown.insert(row, index)
+                if shown:
+                    self.endInsertRows()
+            else:
+                self.added[index] = self.deleted[index] = self.sizes[index] = UNKNOWN
+            self.setCounts(index, numstat.get(path, ()))
+            row = self.rowOfEntry(index)
+            if row >= 0:
+                self.dataChanged.emit(self.index(row), self.index(row), [Qt.DisplayRole])
+        self.rows = {path: index for index, path in enumerate(self.paths)}
+
+    def shiftShown(self, index, offset):
+        # the shown paths from index on have moved by offset in paths
+        for k in range(bisect.bisect_left(self.shown, index), len(self.shown)):
+            self.shown[k] += offset
+
+
+# background sizing jobs running longer than this keep their numstat estimate
+BACKGROUND_TIMEOUT = 10.0
+# sizes found by the background thread are sent to the file list at most this often
+SIZE_BATCH_SECONDS = 0.1
+
+PRIORITY_VISIBLE, PRIORITY_LISTED = 0, 1 # file list sizing order, visible rows first, then by row
+
+class SizingSnapshot:
+    """The file list and branches of one generation of the file list sizing, never changed."""
+    def __init__(self, generation, files, gitpath, branch1, branch2, leftPaths={}):
+        self.generation = generation
+        self.files = files
+        self.gitpath = gitpath
+        self.branch1 = branch1
+        self.branch2 = branch2
+        self.leftPaths = leftPaths # path -> path in branch1, for renamed files
+        self.cancelled = threading.Event()
+
 class FileListUpdateThread(QThread):
-    entryChanged = pyqtSignal(int, int)
+    """Computes the aligned change count of every listed file in the diff worker pool. Every
+    comparison starts a new generation with a snapshot of its file list, which cancels the jobs of
+    the previous one and drops their results. Files are taken from a priority queue, visible rows
+    first, and single files can be queued again, e.g. after they changed in the working copy.
+    Sizes are sent in batches, a new batch only after the file list has taken the previous one."""
+    entriesChanged = pyqtSignal(int, object) # generation, [(path, size)]
 
     def __init__(self, mainWindow):
         QThread.__init__(self)
         self.mainWindow = mainWindow
-        self.restart=False
-        self.stop = False
+        self.generation = 0
+        self.condition = threading.Condition()
+        self.snapshot = SizingSnapshot(0, (), "", "", "")
+        self.queue = [] # heap of (priority, row, path), paths no longer in queued are skipped
+        self.queued = set()
+        self.changed = set() # queued again while they may be running
+        self.visibleRows = ()
+        self.unacknowledged = 0 # batches sent to the file list and not taken yet
+        self.idle = True
+        self.stopping = False
+
+    def startSizing(self, files, gitpath, branch1, branch2, leftPaths={}):
+        """Starts a new generation sizing all files, without waiting for the previous one."""
+        files = tuple(f.strip() for f in files)
+        with self.condition:
+            self.newGeneration(SizingSnapshot(self.generation+1, files, gitpath, branch1, branch2, leftPaths))
+            self.queue = [(PRIORITY_LISTED, row, f) for row, f in enumerate(files)] # sorted, so a heap
+            self.queued = set(files)
+            self.queueVisibleRows()
+            self.idle = not files
+            self.condition.notify_all()
+        if not self.isRunning():
+            self.start()
+
+    def newGeneration(self, snapshot):
+        self.snapshot.cancelled.set()
+        self.snapshot = snapshot
+        self.generation = snapshot.generation
+        self.queue = []
+        self.queued = set()
+        self.changed = set()
+        self.unacknowledged = 0
+
+    def resize(self, files, paths, leftPaths):
+        """Takes a new snapshot of the file list and sizes paths again, the other files keep their sizes."""
+        snapshot = self.snapshot
+        files = tuple(f.strip() for f in files)
+        rows = {f: row for row, f in enumerate(files)}
+        with self.condition:
+            # same generation: sizes that are still on their way stay valid
+            self.snapshot = SizingSnapshot(snapshot.generation, files, snapshot.gitpath, snapshot.branch1, snapshot.branch2,
+                                           leftPaths)
+            self.snapshot.cancelled = snapshot.cancelled
+            for f in paths:
+                heapq.heappush(self.queue, (PRIORITY_LISTED, rows.get(f, 0), f))
+            self.queued.update(paths)
+            self.changed.update(paths)
+            self.idle = False
+            self.condition.notify_all()
+        if not self.isRunning():
+            self.start()
+
+    def cancel(self):
+        """Drops the current generation, its results are not sent any more."""
+        with self.condition:
+            self.newGeneration(SizingSnapshot(self.generation+1, (), "", "", ""))
+            self.condition.notify_all()
+
+    def stop(self):
+        """Cancels all work and waits until the thread has ended."""
+        with self.condition:
+            self.newGeneration(SizingSnapshot(self.generation+1, (), "", "", ""))
+            self.stopping = True
+            self.condition.notify_all()
+        self.wait()
+
+    def waitUntilIdle(self, timeout=None):
+        """Waits until all files of the current generation are sized and sent, returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.idle, timeout)
+
+    def acknowledge(self, generation):
+        """Called by the file list when it has taken a batch."""
+        with self.condition:
+            if generation == self.generation and self.unacknowledged > 0:
+                self.unacknowledged -= 1
+                self.condition.notify_all()
+
+    def setVisibleRows(self, rows):
+        """Sizes the files in these rows (of the snapshot's file list) first."""
+        with self.condition:
+            self.visibleRows = tuple(rows)
+            self.queueVisibleRows()
+            self.condition.notify_all()
+
+    def queueVisibleRows(self):
+        files = self.snapshot.files
+        for row in self.visibleRows:
+            if 0 <= row < len(files) and files[row] in self.queued:
+                heapq.heappush(self.queue, (PRIORITY_VISIBLE, row, files[row]))
+
+    def takeJobs(self, count):
+        jobs = []
+        while self.queue and len(jobs) < count:
+            priority, row, f = heapq.heappop(self.queue)
+            if f in self.queued:
+                self.queued.discard(f)
+                jobs.append(f)
+        return jobs
 
     def run(self):
-        print("thread start")
-        self.restart=True
-        #while self.restart:
-        self.restart=False
-        for i in range(0, self.mainWindow.file_list.count()):
-            try:
-                f = self.mainWindow.file_list.item(i).text().split(":")[0]
-            except:
-                restart=True
-                break
-            print ("processing", f)
+        snapshot = None
+        running = {} # path -> (job, started, key)
+        sized = []
+        sent = 0
+        started = None
+        while True:
+            with self.condition:
+                if self.stopping:
+                    break
+                if self.snapshot.generation != getattr(snapshot, "generation", None):
+                    # results of the previous generation are dropped
+                    for job, jobStarted, key in running.values():
+                        diffPool.cancel(job)
+                    running = {}
+                    sized = []
+                    started = time.perf_counter()
+                snapshot = self.snapshot
+                for f in self.changed & running.keys():
+                    # changed again while it was aligned
+                    diffPool.cancel(running.pop(f)[0])
+                self.changed = set()
+                finished = not self.queue and not running
+                # backpressure: the next batch waits until the file list has taken the last one,
+                # unless nobody listens (e.g. in the benchmark)
+                listening = self.receivers(self.entriesChanged) > 0
+                send = sized and (self.unacknowledged == 0 or not listening) and \
+                       (time.time()-sent > SIZE_BATCH_SECONDS or finished)
+                if send:
+                    self.unacknowledged += listening
+                elif finished and not sized:
+                    if not self.idle and started is not None and tracer.enabled:
+                        tracer.record("file list sizing", "background", started, time.perf_counter(),
+                                      {"generation": snapshot.generation})
+                    self.idle = True
+                    self.condition.notify_all()
+                    self.condition.wait()
+                    started = time.perf_counter()
+                    continue
+                # keep the pool busy, but only queue a few jobs ahead so visibility changes take effect quickly
+                jobs = self.takeJobs(2*diffPool.processes-len(running))
+            if send:
+                self.entriesChanged.emit(snapshot.generation, sized)
+                sized = []
+                sent = time.time()
+            for f in jobs:
+                if snapshot.cancelled.is_set():
+                    break
+                # known file pairs are sized without reading or aligning them
+                leftPath = snapshot.leftPaths.get(f, f)
+                key = diffCacheKey(snapshot.gitpath, snapshot.branch1, snapshot.branch2, f, leftPath)
+                size = diffCache.changes(key)
+                if size is not None:
+                    sized.append((f, size))
+                    continue
+                lines1 = getFromGit(snapshot.gitpath, snapshot.branch1, leftPath)
+                lines2 = getFromGit(snapshot.gitpath, snapshot.branch2, f)
+                if isinstance(lines1, LargeFile) or isinstance(lines2, LargeFile):
+                    # compared here in chunks, the files are not sent to the workers
+                    size = sum(max(i2-i1, j2-j1) for i1, i2, j1, j2 in largeFileHunks(lines1, lines2, snapshot.cancelled))
+                    if not snapshot.cancelled.is_set():
+                        diffCache.put(key, changes=size)
+                        sized.append((f, size))
+                    continue
+                job = diffPool.submit(alignLines, (lines1, lines2, DIFF_ALGORITHM), PRIORITY_BACKGROUND)
+                running[f] = (job, time.time(), key)
+            for f, (job, jobStarted, key) in list(running.items()):
+                if job.done.is_set():
+                    del running[f]
+                    if job.result is not None:
+                        diffCache.put(key, job.result)
+                        sized.append((f, job.result.changes()))
+                elif time.time()-jobStarted > BACKGROUND_TIMEOUT:
+                    del running[f]
+                    diffPool.cancel(job)
+            if running:
+                min(running.values(), key=lambda r: r[1])[0].done.wait(0.05)
+            elif finished and sized and not send:
+                # waiting for the file list to take the last batch
+                with self.condition:
+                    self.condition.wait(SIZE_BATCH_SECONDS)
+        for job, jobStarted, key in running.values():
+            diffPool.cancel(job)
+
+
+# how changes of the working copy are noticed: "auto" (inotify, polling where it is not available),
+# "poll" or "off". Set with the environment variable GITAR_WATCH
+WATCH_MODE = os.environ.get("GITAR_WATCH", "auto")
+WATCH_POLL_SECONDS = 2.0   # interval of the polling fallback
+WATCH_SETTLE_SECONDS = 0.2 # changes are reported once no further change arrived for this long
+WATCH_MAX_DELAY = 1.0      # but at the latest after this, during continuous changes
+WATCH_MAX_PATHS = 1000     # more changed paths at once (e.g. a checkout) reload the whole comparison
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+IN_NONBLOCK, IN_CLOEXEC = os.O_NONBLOCK, 0o2000000
+WATCH_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+def inotifyLibrary():
+    """Returns the C library if it provides inotify, None otherwise."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+class WorkingCopyWatcher(QThread):
+    """Reports files of the working copy that changed on disk, with inotify where the C library
+    provides it and by comparing modification times otherwise. Changed paths are relative to the
+    top level directory, directories end with "/" and None stands for "anything may have changed"."""
+    changed = pyqtSignal(object) # set of paths
+
+    def __init__(self):
+        QThread.__init__(self)
+        self.path = None
+        self.stopped = threading.Event()
+        self.ignored = set() # ignored directories, they are neither watched nor polled
+
+    def watch(self, path):
+        if path == self.path and self.isRunning():
+            return
+        self.stop()
+        self.path = path
+        self.stopped.clear()
+        self.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wait()
+        self.path = None
+
+    def run(self):
+        self.ignored = self.ignoredDirectories()
+        libc = inotifyLibrary() if WATCH_MODE == "auto" else None
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC) if libc is not None else -1
+        if fd < 0:
+            print("watching the working copy by polling")
+            self.poll()
+            return
+        try:
+            self.watchInotify(libc, fd)
+        except OSError as e:
+            # e.g. more directories than inotify watches
+            print("cannot watch the working copy with inotify (%s), polling"%e)
+            os.close(fd)
+            fd = -1
+            self.poll()
+        finally:
+            if fd >= 0:
+                os.close(fd)
+
+    def ignoredDirectories(self):
+        """Untracked directories that git ignores as a whole (e.g. build output), relative to the top level."""
+        try:
+            output = subprocess.check_output(["git", "ls-files", "-z", "--others", "--ignored", "--exclude-standard", "--directory"],
+                                             cwd=self.path, stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            return set()
+        return {os.path.normpath(p.decode('utf-8', 'surrogateescape')) for p in output.split(b"\0") if p.endswith(b"/")}
+
+    def withoutIgnored(self, paths):
+        """Drops the paths git ignores, using one `git check-ignore` call."""
+        paths = list(paths)
+        if not paths:
+            return set()
+        try:
+            result = subprocess.run(["git", "check-ignore", "-z", "--stdin"], cwd=self.path, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, input="\0".join(paths).encode('utf-8', 'surrogateescape'))
+        except OSError:
+            return set(paths)
+        ignored = set(result.stdout.decode('utf-8', 'surrogateescape').split("\0"))
+        return {p for p in paths if p not in ignored}
+
+    def directories(self, relative=""):
+        for root, dirs, files in os.walk(os.path.join(self.path, relative)):
+            directory = os.path.relpath(root, self.path)
+            dirs[:] = [d for d in dirs if d != ".git" and os.path.normpath(os.path.join(directory, d)) not in self.ignored]
+            yield directory, files
+
+    def watchInotify(self, libc, fd):
+        watches = {} # watch descriptor -> directory relative to the top level
+        def addTree(relative):
+            added = set()
+            for directory, files in self.directories(relative):
+                wd = libc.inotify_add_watch(fd, os.fsencode(os.path.join(self.path, directory)), WATCH_EVENTS)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                watches[wd] = directory
+                added.update(os.path.normpath(os.path.join(directory, f)) for f in files)
+            return added
+        addTree("")
+        changed = set()
+        first = None
+        while not self.stopped.is_set():
+            ready = select.select([fd], [], [], WATCH_SETTLE_SECONDS if changed else 0.5)[0]
+            if changed and (not ready or time.time()-first > WATCH_MAX_DELAY):
+                if None in changed:
+                    self.changed.emit(None)
+                else:
+                    self.emitChanged(changed)
+                changed = set()
+            if not ready:
+                continue
             try:
-                size = self.mainWindow.calcDiffSize(f)
-                print (f, size)
-                self.entryChanged.emit(i, size)
-            except:
-                print("error calculating diff size")
-            #check if we need to restart
-            if self.restart:
-                break
-    
-        print("thread end")
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not changed:
+                first = time.time()
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, i)
+                name = data[i+16:i+16+length].rstrip(b"\0").decode('utf-8', 'surrogateescape')
+                i += 16+length
+                if mask & IN_Q_OVERFLOW:
+                    changed.add(None)
+                    continue
+                if mask & IN_IGNORED:
+                    watches.pop(wd, None) # the directory was removed
+                    continue
+                directory = watches.get(wd)
+                if directory is None:
+                    continue
+                path = os.path.normpath(os.path.join(directory, name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        if not self.withoutIgnored([path]):
+                            self.ignored.add(path) # e.g. a new build directory
+                            continue
+                        # files may have been created before the directory is watched
+                        changed.update(addTree(path))
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        changed.add(path+"/") # everything below it
+                    continue
+                changed.add(path)
+
+    def emitChanged(self, changed):
+        """Reports the changed paths git does not ignore, so that ignored files neither cause
+        diffs nor count against WATCH_MAX_PATHS."""
+        if any(os.path.basename(p) == ".gitignore" for p in changed):
+            self.ignored = self.ignoredDirectories()
+        changed = self.withoutIgnored(changed)
+        if changed:
+            self.changed.emit(changed)
+
+    def poll(self):
+        snapshot = None
+        while not self.stopped.wait(WATCH_POLL_SECONDS if snapshot is not None else 0):
+            current = {}
+            for directory, files in self.directories():
+                for f in files:
+                    path = os.path.normpath(os.path.join(directory, f))
+                    try:
+                        stat = os.lstat(os.path.join(self.path, path))
+                    except OSError:
+                        continue
+                    current[path] = (stat.st_mtime_ns, stat.st_size)
+            if snapshot is not None:
+                changed = {p for p in current.keys() | snapshot.keys() if current.get(p) != snapshot.get(p)}
+                if changed:
+                    self.emitChanged(changed)
+            snapshot = current
+
 
+# the window should be painted within this many milliseconds after the start, see --startup-time
+STARTUP_TARGET_MS = int(os.environ.get("GITAR_STARTUP_TARGET_MS", "400"))
+
+# in history mode the steps this far on both sides of the shown one are loaded and aligned in advance,
+# with at most HISTORY_PREFETCH_JOBS at a time so that git threads stay free for the shown step
+HISTORY_PREFETCH = int(os.environ.get("GITAR_HISTORY_PREFETCH", "5"))
+HISTORY_PREFETCH_JOBS = 2
+HISTORY_DIFFS = 64 # aligned steps kept in memory
 
 class CustomMainWindow(QMainWindow):
 
-    def __init__(self):
+    def __init__(self, exitAfterStartup=False):
         super(CustomMainWindow, self).__init__()
 
         self.updateThread = FileListUpdateThread(self)
+        QApplication.instance().aboutToQuit.connect(self.updateThread.stop)
+        self.aligned = None # AlignedDiff of the shown file
+        self.fileModel = FileListModel()
+        self.selectingFile = False # moving the current row of the file list does not load the file
+        self.branchesGeneration = 0 # results of git queries for older selections are dropped
+        self.diffGeneration = 0
+        self.editGeneration = 0 # re-alignments of older edits are dropped
+        self.editJob = None # large edit window being re-aligned in the worker pool
+        self.editTimer = QTimer()
+        self.editTimer.setSingleShot(True)
+        self.editTimer.setInterval(EDIT_DEBOUNCE_MS)
+        self.editTimer.timeout.connect(self.realignAfterEdit)
+        self.watcher = WorkingCopyWatcher()
+        self.watcher.changed.connect(self.workingCopyChanged)
+        self.history = None # (gitpath, revision, filepath), steps of the file history
+        self.historyDiffs = OrderedDict() # (old blob SHA, new blob SHA) -> AlignedDiff
+        self.historyPending = {} # (old blob SHA, new blob SHA) -> future of loadAlignedBlobs
+        self.historyPrefetching = 0
 
         # Window setup
         # --------------
 
-        self.gitpath = getGitToplevelDir()
-        print(self.gitpath)
+        # the startup queries run in parallel while the window is built and shown,
+        # the branches and the file list are filled in when they are done
+        toplevel = gitExecutor.submit(getGitToplevelDir)
+        refs = gitExecutor.submit(getGitRefs)
+        self.gitpath = ""
         self.filepath = ""
         self.branch1 = ""
-        self.branch2 = getGitCurrentBranch()
-
-        branches = getGitBranches()
-
-        if len(sys.argv)==2:
-            self.branch2 = sys.argv[1]
-
-        if len(sys.argv)==3:
-            self.branch1 = sys.argv[1]
-            self.branch2 = sys.argv[2]
+        self.branch2 = ""
+        self.exitAfterStartup = exitAfterStartup
+        self.firstPaint = None
+        self.repositoryShown = False # selections are compared once the startup queries are done
 
 
         # 1. Define the geometry of the main window
@@ -600,20 +4281,38 @@ class CustomMainWindow(QMainWindow):
         self.__myFont = QFont()
         self.__myFont.setPointSize(14)
 
-        # File list widget
-        self.file_list=QListWidget()
-        self.file_list.currentItemChanged.connect(self.loadFiles)
+        # File list view: a one column table, as its rows get their (fixed) height from the header
+        # instead of a layout pass over all rows like in a QListView
+        self.file_list=QTableView()
+        self.file_list.setModel(self.fileModel)
+        self.file_list.horizontalHeader().hide()
+        self.file_list.verticalHeader().hide()
+        self.file_list.horizontalHeader().setStretchLastSection(True)
+        self.file_list.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.file_list.verticalHeader().setDefaultSectionSize(self.file_list.fontMetrics().height()+4)
+        self.file_list.setShowGrid(False)
+        self.file_list.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.file_list.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.file_list.selectionModel().currentChanged.connect(self.loadFiles)
         self.file_list.clicked.connect(self.updateDiffView)
-        self.updateThread.entryChanged.connect(self.updateDiffSize)
+        self.updateThread.entriesChanged.connect(self.updateDiffSizes)
+        self.file_list.verticalScrollBar().valueChanged.connect(self.updateVisibleRows)
+        self.fileFilter = QLineEdit()
+        self.fileFilter.setPlaceholderText("Filter: text or *.ext")
+        self.fileFilter.setClearButtonEnabled(True)
+        self.fileFilter.textChanged.connect(self.filterFiles)
 
         self.localChangesCheckbox = QCheckBox("Local changes only")
         self.divergedCheckbox = QCheckBox("diverged files only")
+        self.threeWayCheckbox = QCheckBox("three-way with merge base")
 
         self.file_view = QWidget()
         self.file_view_layout = QVBoxLayout()
         self.file_view.setLayout(self.file_view_layout)
         self.file_view_layout.addWidget(self.localChangesCheckbox)
         self.file_view_layout.addWidget(self.divergedCheckbox)
+        self.file_view_layout.addWidget(self.threeWayCheckbox)
+        self.file_view_layout.addWidget(self.fileFilter)
         self.file_view_layout.addWidget(self.file_list)
 
         self.file_view_dock = QDockWidget()
@@ -633,7 +4332,12 @@ class CustomMainWindow(QMainWindow):
 
         self.right_editor = EditorWidget(parent=self)
 
+        # the merge base between both sides, shown in three-way mode
+        self.base_editor = EditorWidget(parent=self)
+        self.base_editor.hide()
+
         self.comparison_area.addWidget(self.left_editor)
+        self.comparison_area.addWidget(self.base_editor)
         self.comparison_area.addWidget(self.right_editor)
 
 
@@ -644,126 +4348,463 @@ class CustomMainWindow(QMainWindow):
         self.branchesMenuLayout.setContentsMargins(0,0,0,0)
 
 
-        self.leftBranchSelector = BranchSelector(branches = ["", "."]+branches, callback = self.updateBranches)
-        self.rightBranchSelector = BranchSelector(branches = branches, callback = self.updateBranches)
-
-        self.leftBranchSelector.setSelection(self.branch1)
-        self.rightBranchSelector.setSelection(self.branch2)
+        self.leftBranchSelector = BranchSelector(callback = self.updateBranches)
+        self.rightBranchSelector = BranchSelector(callback = self.updateBranches)
 
         self.branchesMenuLayout.addWidget(self.leftBranchSelector)
         self.branchesMenuLayout.addWidget(self.rightBranchSelector)
 
+        # history mode: the slider steps through the commits of the right branch that changed the file
+        self.historyBar = QWidget()
+        self.historyBarLayout = QHBoxLayout()
+        self.historyBar.setLayout(self.historyBarLayout)
+        self.historyBarLayout.setContentsMargins(0,0,0,0)
+        self.historyCheckbox = QCheckBox("File history")
+        self.historySlider = QSlider(Qt.Horizontal)
+        self.historySlider.setTickPosition(QSlider.TicksBelow)
+        self.historySlider.setEnabled(False)
+        self.historyLabel = QLabel()
+        self.historyLabel.setMinimumWidth(500)
+        self.historyLabel.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Preferred) # no relayout on every step
+        self.historyBarLayout.addWidget(self.historyCheckbox)
+        self.historyBarLayout.addWidget(self.historySlider, 1)
+        self.historyBarLayout.addWidget(self.historyLabel)
+
         # ! Add editor to layout !
         self.__lyt.addWidget(self.branchesMenu)
+        self.__lyt.addWidget(self.historyBar)
         self.__lyt.addWidget(self.comparison_area)
 
+        # timing of the last operation, recorded while tracing is enabled
+        self.timingLabel = QLabel()
+        self.traceCheckbox = QCheckBox("Timing")
+        self.traceCheckbox.setChecked(tracer.enabled)
+        self.traceCheckbox.stateChanged.connect(self.setTracing)
+        self.saveTraceButton = QPushButton("Save trace...")
+        self.saveTraceButton.clicked.connect(self.saveTrace)
+        self.statusBar().addWidget(self.timingLabel, 1)
+        self.statusBar().addPermanentWidget(self.traceCheckbox)
+        self.statusBar().addPermanentWidget(self.saveTraceButton)
+
         self.show()
 
         self.left_editor.editor.verticalScrollBar().valueChanged.connect( self.right_editor.editor.verticalScrollBar().setValue)
+        self.left_editor.editor.verticalScrollBar().valueChanged.connect(self.base_editor.editor.verticalScrollBar().setValue)
         self.localChangesCheckbox.stateChanged.connect(self.updateBranches)
         self.divergedCheckbox.stateChanged.connect(self.updateBranches)
-        self.updateBranches()
+        self.threeWayCheckbox.stateChanged.connect(self.updateDiffView)
+        self.historyCheckbox.stateChanged.connect(self.setHistoryMode)
+        self.historySlider.valueChanged.connect(self.showHistoryStep)
+        gitExecutor.deliver(toplevel, lambda gitpath: gitExecutor.deliver(refs, lambda refs: self.showRepository(gitpath, *refs)))
 
     ''''''
 
-    def loadFiles(self, args):
+    def showRepository(self, gitpath, branches, currentBranch):
+        """Fills in the branches once the startup queries are done and compares the selected ones."""
+        self.gitpath = gitpath
+        print(self.gitpath)
+        self.branch2 = currentBranch
+
+        if len(sys.argv)==2:
+            self.branch2 = sys.argv[1]
+
+        if len(sys.argv)==3:
+            self.branch1 = sys.argv[1]
+            self.branch2 = sys.argv[2]
+
+        self.leftBranchSelector.setBranches(["", "."]+branches, self.branch1)
+        self.rightBranchSelector.setBranches(branches, self.branch2)
+        self.repositoryShown = True
+        self.updateBranches()
+
+    def paintEvent(self, event):
+        if self.firstPaint is None:
+            self.firstPaint = time.perf_counter()-STARTED
+            if tracer.enabled:
+                tracer.record("first paint", "operation", STARTED, STARTED+self.firstPaint)
+            if self.firstPaint*1000 > STARTUP_TARGET_MS:
+                print("slower than the startup target of %i ms"%STARTUP_TARGET_MS)
+        QMainWindow.paintEvent(self, event)
+
+    def startupFinished(self):
+        """Ends a --startup-time run once the first file list is shown."""
+        fileList = time.perf_counter()-STARTED
+        sys.stderr.write("startup: first paint %.1f ms, file list %.1f ms, target %i ms\n"%(
+            (self.firstPaint or fileList)*1000, fileList*1000, STARTUP_TARGET_MS))
+        QApplication.exit(0 if self.firstPaint is not None and self.firstPaint*1000 <= STARTUP_TARGET_MS else 1)
+
+    def closeEvent(self, event):
+        self.updateThread.stop()
+        self.watcher.stop()
+        QMainWindow.closeEvent(self, event)
+
+    def setTracing(self, state):
+        tracer.enabled = bool(state)
+        self.timingLabel.setText("")
+
+    def saveTrace(self):
+        path, selectedFilter = QFileDialog.getSaveFileName(self, "Save trace", "gitar-trace.json", "Chrome trace (*.json)")
+        if path:
+            tracer.exportChromeTrace(path)
+
+    def showTiming(self, operation, status=None):
+        """Shows the timing of operation while tracing is enabled, and status (e.g. counts of the
+        shown diff) if it is given, "" clears it."""
+        summary = tracer.endOperation(operation)
+        if summary is not None or status is not None:
+            self.timingLabel.setText("   ".join(text for text in (status, summary) if text))
+
+    def loadFiles(self, current, previous=None):
+        if self.selectingFile or not current.isValid():
+            return
         print("loading files")
-        if args is None:
-            #self.filepath = ""
-            pass
-        else:
-            self.filepath = args.text().split(":")[0]
+        self.filepath = self.fileModel.path(current.row())
         self.updateDiffView()
 
-    def calcDiffSize(self, filename):
-        lines1 = getFromGit(self.gitpath, self.branch1, filename)
-        lines2 = getFromGit(self.gitpath, self.branch2, filename)
-        try:
-            left, right, flags = aligner(lines1, lines2)
-            return flags.count(True)
-        except TypeError:
-            print("Aligner timed out")
-            return 0
+    def selectFile(self, path):
+        """Makes path the current row of the file list without loading it, returns False if it is not listed."""
+        row = self.fileModel.rowOfPath(path)
+        self.selectingFile = True
+        self.file_list.setCurrentIndex(self.fileModel.index(row))
+        self.selectingFile = False
+        return row >= 0
 
-    def updateDiffSize(self, i, size):
-        item = self.file_list.item(i)
-        if item is not None:
-            item.setText(self.files[i].strip()+": (%i)"%size)
+    def updateDiffSizes(self, generation, sizes):
+        self.updateThread.acknowledge(generation)
+        if generation != self.updateThread.generation:
+            return # result of a previous comparison
+        self.fileModel.setSizes(sizes)
+
+    def filterFiles(self, text):
+        self.selectingFile = True
+        self.fileModel.setFilter(text.strip())
+        self.selectingFile = False
+        if self.filepath:
+            self.selectFile(self.filepath)
+            self.file_list.scrollTo(self.file_list.currentIndex())
+        self.updateVisibleRows()
+
+    def updateVisibleRows(self, *args):
+        viewport = self.file_list.viewport().rect()
+        first = self.file_list.indexAt(viewport.topLeft()).row()
+        last = self.file_list.indexAt(viewport.bottomLeft()).row()
+        rows = self.fileModel.rowCount()
+        last = last if last >= 0 else rows-1
+        # the sizing thread works on all files, not only the ones matching the filter
+        self.updateThread.setVisibleRows([self.fileModel.entry(row) for row in range(max(first, 0), min(last+1, rows))])
 
     def updateDiffView(self):
         print("update diff")
-        lines1=[""]
-        lines2=[""]
+        self.editTimer.stop()
+        self.diffGeneration += 1
+        generation = self.diffGeneration
         editorPosition = self.left_editor.editor.verticalScrollBar().value()
-        
+        if self.historyCheckbox.isChecked() and self.filepath:
+            self.updateHistory(generation, editorPosition)
+            return
+        leftPath = self.fileModel.leftPaths.get(self.filepath, self.filepath)
+        view = (self.branch1, self.branch2, self.filepath, leftPath)
+        operation = tracer.beginOperation("show %s"%self.filepath)
         if self.filepath is None or self.filepath =="":
-            lines1 = []
-            lines2 = []
+            self.showDiff(generation, view, editorPosition, operation, AlignedDiff([], []))
+        elif self.threeWayCheckbox.isChecked() and "" not in (self.branch1, self.branch2):
+            gitExecutor.request(lambda merged: self.showDiff(generation, view, editorPosition, operation, merged[1], merged[0]),
+                                loadMergedFiles, self.gitpath, self.branch1, self.branch2, self.filepath)
         else:
-            lines1 = getFromGit(self.gitpath, self.branch1, self.filepath)
-            lines2 = getFromGit(self.gitpath, self.branch2, self.filepath)
-        
-        try:
-            left, right, flags = aligner(lines1, lines2)
-            self.left_editor.updateText( left,  self.branch1, self.filepath, fileSuffix=self.filepath.split(".")[-1])
-            self.right_editor.updateText(right, self.branch2, self.filepath, fileSuffix=self.filepath.split(".")[-1])
-        except TypeError:
+            # files are read and aligned in the background, the view is updated when both are done
+            gitExecutor.request(lambda result: self.showDiff(generation, view, editorPosition, operation, result),
+                                loadAlignedFiles, self.gitpath, self.branch1, self.branch2, self.filepath, leftPath)
+
+    def showDiff(self, generation, view, editorPosition, operation, result, baseRevision=None):
+        if generation != self.diffGeneration:
+            return # a newer file or revision has been selected meanwhile
+        if result is None:
             print("Aligner timed out")
+            return
+        branch1, branch2, filepath, leftPath = view
+        merge = isinstance(result, AlignedMerge)
+        if merge:
+            self.base_editor.updateText(result, 2, baseRevision, filepath, fileSuffix=filepath.split(".")[-1])
+        self.base_editor.setVisible(merge)
+        self.left_editor.updateText( result, 0, branch1, leftPath, fileSuffix=filepath.split(".")[-1])
+        self.right_editor.updateText(result, 1, branch2, filepath, fileSuffix=filepath.split(".")[-1])
+        self.aligned = result
         self.left_editor.editor.verticalScrollBar().setValue(editorPosition)
+        self.showTiming(operation, "%i changed rows, %i conflicts"%(result.changes(), result.conflicts()) if merge else "")
+
+    def setHistoryMode(self, state):
+        self.historySlider.setEnabled(bool(state))
+        if not state:
+            self.history = None
+            self.historyLabel.setText("")
+        self.updateDiffView()
+
+    def updateHistory(self, generation, editorPosition):
+        """Shows the selected file at the slider position of its history, reading the history first
+        if the file or the right branch has changed."""
+        revision = self.branch2 if self.branch2 not in ("", ".") else "HEAD"
+        key = (self.gitpath, revision, self.filepath)
+        if self.history is not None and self.history[0] == key:
+            self.showHistoryStep(self.historySlider.value(), editorPosition)
+            return
+        gitExecutor.request(lambda steps: self.showHistory(generation, key, steps, editorPosition), getFileHistory, *key)
+
+    def showHistory(self, generation, key, steps, editorPosition):
+        if generation != self.diffGeneration:
+            return # another file has been selected meanwhile
+        self.history = (key, steps)
+        # the slider starts at the latest change
+        self.historySlider.blockSignals(True)
+        self.historySlider.setRange(0, max(len(steps)-1, 0))
+        self.historySlider.setValue(len(steps)-1)
+        self.historySlider.blockSignals(False)
+        if not steps:
+            self.historyLabel.setText("no history")
+            self.showDiff(generation, (key[1], key[1], key[2], key[2]), editorPosition, tracer.beginOperation("history"), AlignedDiff([], []))
+            return
+        self.showHistoryStep(len(steps)-1, editorPosition)
+
+    def showHistoryStep(self, index, editorPosition=None):
+        """Shows the change of one commit to the file, at once if it has been prefetched."""
+        if self.history is None or not self.history[1]:
+            return
+        self.editTimer.stop()
+        self.diffGeneration += 1
+        generation = self.diffGeneration
+        if editorPosition is None:
+            editorPosition = self.left_editor.editor.verticalScrollBar().value()
+        steps = self.history[1]
+        commit, parent, date, author, message, sha1, sha2 = steps[index]
+        self.historyLabel.setText("%i/%i %s %s %s: %s"%(index+1, len(steps), commit[:8], date[:10], author, abbreviateString(message, 50)))
+        # the parent of a root commit does not exist, its side is empty
+        view = (parent or commit+"^", commit, self.filepath, self.filepath)
+        operation = tracer.beginOperation("history %s"%commit[:8])
+        key = (sha1, sha2)
+        if key in self.historyDiffs:
+            self.historyDiffs.move_to_end(key)
+            self.showDiff(generation, view, editorPosition, operation, self.historyDiffs[key])
+        else:
+            gitExecutor.deliver(self.loadHistoryStep(key, PRIORITY_VIEW),
+                                lambda result: self.showDiff(generation, view, editorPosition, operation, result))
+        self.prefetchHistory()
+
+    def loadHistoryStep(self, key, priority):
+        """Returns a future for the aligned diff of the blob pair key, shared with a running prefetch."""
+        future = self.historyPending.get(key)
+        if future is None:
+            timeout = ALIGNER_TIMEOUT if priority == PRIORITY_VIEW else BACKGROUND_TIMEOUT
+            future = self.historyPending[key] = gitExecutor.submit(loadAlignedBlobs, self.gitpath, key[0], key[1], priority, timeout)
+            gitExecutor.deliver(future, lambda result: self.historyStepLoaded(key, future, result))
+        return future
+
+    def historyStepLoaded(self, key, future, result):
+        if self.historyPending.get(key) is future:
+            del self.historyPending[key]
+        if result is not None:
+            self.historyDiffs[key] = result
+            while len(self.historyDiffs) > HISTORY_DIFFS:
+                self.historyDiffs.popitem(last=False)
+
+    def prefetchHistory(self):
+        """Loads the steps around the slider position that are not in memory yet, nearest first."""
+        if self.history is None or not self.historyCheckbox.isChecked():
+            return
+        steps = self.history[1]
+        index = self.historySlider.value()
+        for distance in range(1, HISTORY_PREFETCH+1):
+            for i in (index-distance, index+distance):
+                if self.historyPrefetching >= HISTORY_PREFETCH_JOBS:
+                    return
+                key = steps[i][5:] if 0 <= i < len(steps) else None
+                if key is not None and key not in self.historyDiffs and key not in self.historyPending:
+                    self.historyPrefetching += 1
+                    gitExecutor.deliver(self.loadHistoryStep(key, PRIORITY_PREFETCH), self.historyStepPrefetched)
+
+    def historyStepPrefetched(self, result):
+        self.historyPrefetching -= 1
+        if result is not None:
+            self.prefetchHistory()
 
     def updateAfterEdit(self):
+        # coalesce bursts of keystrokes into one re-alignment
+        self.editTimer.start()
+
+    def realignAfterEdit(self):
+        aligned = self.aligned
+        if aligned is None or aligned.readOnly:
+            return
         lines1 = self.left_editor.getText()
         lines2 = self.right_editor.getText()
-        left, right, flags = aligner(lines1, lines2)
-        self.left_editor.updateText( left,  self.branch1, self.filepath, fileSuffix=self.filepath.split(".")[-1])
-        self.right_editor.updateText(right, self.branch2, self.filepath, fileSuffix=self.filepath.split(".")[-1])
+        edits = [e for e in (aligned.editedRows(0, lines1), aligned.editedRows(1, lines2)) if e is not None]
+        if not edits:
+            return
+        self.editGeneration += 1
+        generation = self.editGeneration
+        if self.editJob is not None:
+            diffPool.cancel(self.editJob) # superseded by this edit
+            self.editJob = None
+        operation = tracer.beginOperation("edit")
+        # widen the edited rows to the surrounding hunks, everything outside stays aligned
+        flags = aligned.flags
+        rowStart = min(e[0] for e in edits)
+        rowEnd = max(e[1] for e in edits)
+        while rowStart > 0 and flags[rowStart-1] == CHANGED:
+            rowStart -= 1
+        while rowEnd < len(flags) and flags[rowEnd] == CHANGED:
+            rowEnd += 1
+        windows = []
+        for side, lines in ((0, lines1), (1, lines2)):
+            linesAfter = len(aligned.column(side)[1])-aligned.linesBefore(side, rowEnd)
+            windows.append(lines[aligned.linesBefore(side, rowStart):len(lines)-linesAfter])
+        if max(len(w) for w in windows) < INPROCESS_ALIGN_LINES:
+            with tracer.span("alignLines", "align", lines1=len(windows[0]), lines2=len(windows[1])):
+                result = alignLines(windows[0], windows[1])
+            self.spliceEdit(generation, aligned, rowStart, rowEnd, lines1, lines2, operation, result)
+        else:
+            # large windows are aligned in the pool and waited for in the background, like a loaded file
+            job = self.editJob = submitAligner(windows[0], windows[1])
+            gitExecutor.request(lambda result: self.spliceEdit(generation, aligned, rowStart, rowEnd, lines1, lines2, operation, result),
+                                lambda: waitAligner(job, windows[0], windows[1]))
+
+    def spliceEdit(self, generation, aligned, rowStart, rowEnd, lines1, lines2, operation, result):
+        if generation != self.editGeneration or aligned is not self.aligned:
+            return # edited again or another file shown meanwhile
+        self.editJob = None
+        if result is None:
+            return
+        self.aligned = aligned.splice(rowStart, rowEnd, result, lines1, lines2)
+        self.left_editor.patchText(self.aligned, rowStart, rowStart+len(result))
+        self.right_editor.patchText(self.aligned, rowStart, rowStart+len(result))
+        self.showTiming(operation)
 
     def updateBranches(self, *args):
-        self.updateThread.restart=True
+        if not self.repositoryShown:
+            return
+        self.updateThread.cancel()
+        # workers still sizing files of the previous comparison are freed right away
+        diffPool.cancelAll()
         # store editor file position
         editorPosition = self.left_editor.editor.verticalScrollBar().value()
 
         self.branch1 = str(self.leftBranchSelector.getCurrentBranch())
         self.branch2 = str(self.rightBranchSelector.getCurrentBranch())
         print(self.branch1, self.branch2)
-        self.file_list.clear()
+        self.branchesGeneration += 1
+        generation = self.branchesGeneration
+        operation = tracer.beginOperation("compare %s..%s"%tuple(b[:8] if isFullSha(b) else b for b in (self.branch1, self.branch2)))
         if self.divergedCheckbox.isChecked():
-            self.files = getDivergedFiles(self.gitpath, self.branch1, self.branch2)
+            files = gitExecutor.submit(getDivergedFiles, self.gitpath, self.branch1, self.branch2)
         else:
-            self.files = getChangedFilesFromGit(self.gitpath, self.branch1, self.branch2, locallyChangedOnly=self.localChangesCheckbox.isChecked())
-        
+            files = gitExecutor.submit(getChangedFilesFromGit, self.gitpath, self.branch1, self.branch2, self.localChangesCheckbox.isChecked())
+        # line counts are shown right away, the aligned counts follow from the background thread
+        numstat = gitExecutor.submit(getDiffNumstat, self.gitpath, self.branch1, self.branch2,
+                                     self.localChangesCheckbox.isChecked() and not self.divergedCheckbox.isChecked())
+        gitExecutor.deliver(files, lambda files: gitExecutor.deliver(numstat,
+                            lambda numstat: self.showChangedFiles(generation, files, numstat, editorPosition, operation)))
+        # the trees of both commits are indexed in the background, once per commit
+        gitExecutor.submit(indexCommitTrees, self.gitpath, self.branch1, self.branch2)
+
+    @traced("render")
+    def showChangedFiles(self, generation, files, numstat, editorPosition, operation):
+        if generation != self.branchesGeneration:
+            return # the branch selection has changed meanwhile
         print("collecting files")
-        #print(self.files)
-        ignore_list=["hex"]
-        for f in self.files:
-            # if comparing to working copy, only show files that exist locally
-            exist=True
-            size=0
-            # NOTE: commented out as it caused bugs in list view (disappearing files)
-            #if self.branch1=="" or self.branch2=="":
-            #    exist = os.path.isfile(self.gitpath+f.strip())
-
-            #if exist and not (f.strip().split(".")[-1]  in ignore_list):
-            #    size=self.calcDiffSize(f)
-            if exist:
-                self.file_list.addItem(f.strip()+": (...)")
+        # files are (path in branch1, path in branch2) pairs, listed by their path in branch2
+        paths = [path2 for path1, path2 in files]
+        leftPaths = {path2: path1 for path1, path2 in files if path1 != path2}
+        self.selectingFile = True
+        self.fileModel.setFiles(paths, numstat, leftPaths)
+        self.selectingFile = False
 
         # check if previously selected file is still there
-        filenames = [fn.split(":")[0].strip() for fn in self.files]
-        if self.filepath in filenames:
+        if self.selectFile(self.filepath):
             print("reselect file " + self.filepath)
-            findex = filenames.index(self.filepath)
-            
-            self.file_list.blockSignals(True)
-            self.file_list.setCurrentRow(findex)
-            self.file_list.blockSignals(False)
-            self.updateDiffView()
-            # reset editor scroll position
+            # the editor scroll position is restored when the diff has been loaded
             self.left_editor.editor.verticalScrollBar().setValue(editorPosition)
         else: 
             print("cannot reselect file: not found.", self.filepath)
+        if self.filepath:
+            self.updateDiffView()
+        self.showTiming(operation)
+        if self.exitAfterStartup:
+            self.exitAfterStartup = False
+            self.startupFinished()
         
-        self.updateThread.start()
+        self.updateVisibleRows()
+        self.updateThread.startSizing(self.fileModel.paths, self.gitpath, self.branch1, self.branch2, leftPaths)
+        self.watchWorkingCopy()
+
+    def watchWorkingCopy(self):
+        # only comparisons with the working copy follow the files on disk
+        if WATCH_MODE != "off" and "" in (self.branch1, self.branch2) and self.gitpath and not self.divergedCheckbox.isChecked():
+            self.watcher.watch(self.gitpath)
+        else:
+            self.watcher.stop()
+
+    def workingCopyChanged(self, paths):
+        """Diffs only the files that changed on disk, instead of the whole comparison."""
+        if paths is None or len(paths) > WATCH_MAX_PATHS:
+            self.updateBranches()
+            return
+        generation = self.branchesGeneration
+        # files renamed in the working copy are listed by their old path, which must be diffed too
+        # for git to find the rename
+        renamed = [path for path, leftPath in self.fileModel.leftPaths.items() if leftPath in paths]
+        paths = tuple(sorted(set(paths).union(renamed)))
+        files = gitExecutor.submit(getChangedFilesFromGit, self.gitpath, self.branch1, self.branch2, self.localChangesCheckbox.isChecked(), paths)
+        numstat = gitExecutor.submit(getDiffNumstat, self.gitpath, self.branch1, self.branch2, self.localChangesCheckbox.isChecked(), paths)
+        gitExecutor.deliver(files, lambda files: gitExecutor.deliver(numstat,
+                            lambda numstat: self.updateChangedFiles(generation, paths, files, numstat)))
+
+    @traced("render")
+    def updateChangedFiles(self, generation, paths, files, numstat):
+        """Adds, removes and relabels the list entries of paths (files, or directories ending with "/")
+        to match their current diff, and sizes them again."""
+        if generation != self.branchesGeneration:
+            return # the comparison has been reloaded meanwhile
+        exact = set(p for p in paths if not p.endswith("/"))
+        directories = tuple(p for p in paths if p.endswith("/"))
+        affected = lambda f: f in exact or f.startswith(directories)
+        current = [path2 for path1, path2 in files]
+        currentSet = set(current)
+        removed = [f for f in self.fileModel.paths if affected(f) and f not in currentSet]
+        leftPaths = dict(self.fileModel.leftPaths)
+        for f in removed:
+            leftPaths.pop(f, None)
+        for path1, path2 in files:
+            if path1 != path2:
+                leftPaths[path2] = path1
+            else:
+                leftPaths.pop(path2, None)
+        self.selectingFile = True # the selection must not follow the moved rows
+        self.fileModel.leftPaths = leftPaths
+        self.fileModel.updateFiles(removed, current, numstat)
+        self.selectingFile = False
+        self.updateVisibleRows()
+        self.updateThread.resize(self.fileModel.paths, current, leftPaths)
+        if self.filepath and affected(self.filepath):
+            self.reloadWorkingCopy()
+
+    def reloadWorkingCopy(self):
+        generation = self.diffGeneration
+        path = self.fileModel.leftPaths.get(self.filepath, self.filepath) if self.branch1 == "" else self.filepath
+        gitExecutor.request(lambda lines: self.showWorkingCopy(generation, lines), getFromGit, self.gitpath, "", path)
+
+    def showWorkingCopy(self, generation, lines):
+        """Brings changes on disk of the open file into the working copy editors by replacing
+        only the changed lines, and re-aligns them like an edit."""
+        if generation != self.diffGeneration:
+            return
+        editors = [e for e in (self.left_editor, self.right_editor) if e.aligned is not None and e.branch == ""]
+        if isinstance(lines, LargeFile) or any(e.excerpt for e in editors):
+            self.updateDiffView()
+            return
+        if any(e.editor.isModified() for e in editors):
+            print("not reloading", self.filepath, "from disk, it has unsaved changes")
+            return
+        for editor in editors:
+            editor.replaceLines(lines or [])
+        self.realignAfterEdit()
 
     ''''''
 
@@ -771,9 +4812,25 @@ class CustomMainWindow(QMainWindow):
 ''' End Class '''
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--selftest-diff":
+        # gitar.py --selftest-diff [branch1 branch2]: compare the diff engines with difflib
+        pairs = randomFilePairs()
+        if len(sys.argv) == 4:
+            gitpath = getGitToplevelDir()
+            for path1, path2 in getChangedFilesFromGit(gitpath, sys.argv[2], sys.argv[3]):
+                pairs.append((path2, getFromGit(gitpath, sys.argv[2], path1) or [], getFromGit(gitpath, sys.argv[3], path2) or []))
+        sys.exit(1 if diffEngineSelfTest(pairs) else 0)
+    if len(sys.argv) > 1 and sys.argv[1] == "--export":
+        sys.exit(exportMain(sys.argv[2:]))
+    # gitar.py --startup-time [branch1] [branch2]: prints the time until the window is painted and until
+    # the file list is shown on stderr, then exits, with status 1 if the paint missed STARTUP_TARGET_MS
+    exitAfterStartup = len(sys.argv) > 1 and sys.argv[1] == "--startup-time"
+    if exitAfterStartup:
+        del sys.argv[1]
+
     app = QApplication(sys.argv)
     QApplication.setStyle(QStyleFactory.create('Fusion'))
-    myGUI = CustomMainWindow()
+    myGUI = CustomMainWindow(exitAfterStartup)
 
     sys.exit(app.exec_())
 
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""Tests of gitar's diff engines and the parts built on them.
+
+path/to/gitar> python -m pytest test_gitar.py
+"""
+import os, random, shutil, subprocess
+import pytest
+import gitar
+from gitar import CHANGED, CONFLICT, UNCHANGED
+
+ALGORITHMS = ["histogram", "patience", "myers"]
+
+
+def mutate(rng, lines, edits=5):
+    """A copy of lines with some inserted, deleted and changed lines."""
+    lines = list(lines)
+    for edit in range(rng.randint(0, edits)):
+        position = rng.randint(0, len(lines))
+        operation = rng.random()
+        if operation < 0.4:
+            lines[position:position] = ["new %i %i\n"%(position, rng.randint(0, 3))]*rng.randint(1, 3)
+        elif operation < 0.7:
+            del lines[position:position+rng.randint(1, 3)]
+        elif position < len(lines):
+            lines[position] = lines[position].rstrip("\n")+" changed\n"
+    return lines
+
+def longestCommonSubsequence(lines1, lines2):
+    previous = [0]*(len(lines2)+1)
+    for line1 in lines1:
+        current = [0]
+        for j, line2 in enumerate(lines2):
+            current.append(previous[j]+1 if line1 == line2 else max(previous[j+1], current[j]))
+        previous = current
+    return previous[-1]
+
+def unchangedRows(aligned):
+    return aligned.flags.count(UNCHANGED)
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_alignmentsAreConsistent(algorithm):
+    pairs = gitar.randomFilePairs(300, seed=4)
+    pairs += [("empty", [], []), ("added", [], ["a\n", "b\n"]), ("deleted", ["a\n", "b\n"], []),
+              ("no newline", ["a\n", "b"], ["a\n", "b\n"]), ("repeated", ["}\n"]*20, ["}\n"]*15+["x\n"]+["}\n"]*5)]
+    for name, lines1, lines2 in pairs:
+        aligned = gitar.alignLines(lines1, lines2, algorithm)
+        assert gitar.checkAlignment(lines1, lines2, aligned) == [], name
+        assert aligned.changes() == 0 if lines1 == lines2 else aligned.changes() > 0, name
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_singleEditsAlignLikeDifflib(algorithm):
+    # with distinct lines and one edited block there is only one good alignment
+    rng = random.Random(1)
+    for n in range(300):
+        lines1 = ["line %i\n"%i for i in range(rng.randint(0, 60))]
+        lines2 = list(lines1)
+        position = rng.randint(0, len(lines2))
+        fresh = ["fresh %i\n"%i for i in range(rng.randint(1, 5))]
+        operation = rng.random()
+        if operation < 0.33:
+            lines2[position:position] = fresh
+        elif operation < 0.66:
+            del lines2[position:position+rng.randint(1, 5)]
+        else:
+            lines2[position:position+rng.randint(1, 5)] = fresh
+        assert gitar.alignLines(lines1, lines2, algorithm) == gitar.alignLines(lines1, lines2, "difflib"), n
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_unchangedLinesComparedToDifflib(algorithm):
+    # Myers keeps a longest common subsequence, which is at least what difflib keeps;
+    # histogram and patience may keep fewer lines, but never more than a common subsequence
+    for name, lines1, lines2 in gitar.randomFilePairs(200, seed=2):
+        kept = unchangedRows(gitar.alignLines(lines1, lines2, algorithm))
+        longest = longestCommonSubsequence(lines1, lines2)
+        assert kept <= longest, name
+        if algorithm == "myers":
+            assert kept == longest, name
+            assert kept >= unchangedRows(gitar.alignLines(lines1, lines2, "difflib")), name
+
+def test_diffEngineSelfTestPasses():
+    assert gitar.diffEngineSelfTest(gitar.randomFilePairs(50, seed=6)) == 0
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_encodedAlignmentsDecodeToTheSame(algorithm):
+    for name, lines1, lines2 in gitar.randomFilePairs(100, seed=8):
+        aligned = gitar.alignLines(lines1, lines2, algorithm)
+        data = gitar.encodeAlignment(aligned)
+        assert gitar.decodeAlignment(data, lines1, lines2) == aligned, name
+        # an alignment of other files is not used
+        assert gitar.decodeAlignment(data, lines1+["more\n"], lines2) is None, name
+        if lines2:
+            assert gitar.decodeAlignment(data, lines1, lines2[:-1]) is None, name
+
+def test_spliceKeepsAlignmentsConsistent():
+    # like editing in the window: one side changes, the changed rows around the edit are aligned
+    # again and spliced into the previous alignment
+    rng = random.Random(7)
+    for name, lines1, lines2 in gitar.randomFilePairs(200, seed=9):
+        aligned = gitar.alignLines(lines1, lines2)
+        for step in range(5):
+            side = rng.randint(0, 1)
+            edited = mutate(rng, aligned.column(side)[1], edits=2)
+            new1, new2 = (edited, aligned.lines2) if side == 0 else (aligned.lines1, edited)
+            rows = aligned.editedRows(side, edited)
+            if rows is None:
+                continue
+            rowStart, rowEnd = rows
+            while rowStart > 0 and aligned.flags[rowStart-1] == CHANGED:
+                rowStart -= 1
+            while rowEnd < len(aligned) and aligned.flags[rowEnd] == CHANGED:
+                rowEnd += 1
+            windows = []
+            for s, lines in ((0, new1), (1, new2)):
+                after = len(aligned.column(s)[1])-aligned.linesBefore(s, rowEnd)
+                windows.append(lines[aligned.linesBefore(s, rowStart):len(lines)-after])
+            aligned = aligned.splice(rowStart, rowEnd, gitar.alignLines(*windows), new1, new2)
+            assert gitar.checkAlignment(new1, new2, aligned) == [], name
+
+def largeFile(tmp_path, name, lines):
+    """Writes lines (the last one may lack its newline) and maps them as a LargeFile."""
+    path = tmp_path/name
+    path.write_bytes("".join(lines).encode('utf-8'))
+    return gitar.LargeFile(open(str(path), "rb"))
+
+def largeFilePair(tmp_path, seed):
+    rng = random.Random(seed)
+    lines1 = ["line %i\n"%i for i in range(5000)]
+    lines2 = mutate(rng, lines1, edits=30)
+    # a block without common lines, longer than a chunk
+    position = rng.randint(0, len(lines2)-700)
+    lines2[position:position+600] = ["fresh %i\n"%i for i in range(700)]
+    lines2[-1] = lines2[-1].rstrip("\n")
+    return lines1, lines2, largeFile(tmp_path, "a%i"%seed, lines1), largeFile(tmp_path, "b%i"%seed, lines2)
+
+@pytest.mark.parametrize("lines", [["x\n"]*512, ["Grüße %i \n"%i for i in range(700)]+["no newline"], ["only"]])
+def test_largeFileReadsLikeLines(tmp_path, lines):
+    large = largeFile(tmp_path, "file", lines)
+    expected = gitar.decodeLines("".join(lines).encode('utf-8'))
+    assert len(large) == len(expected)
+    assert list(large) == expected
+    assert large[0] == expected[0] and large[-1] == expected[-1]
+    assert large[250:300] == expected[250:300] and large[len(expected)-3:len(expected)+5] == expected[-3:]
+    with pytest.raises(IndexError):
+        large[len(expected)]
+
+def test_largeFileHunksRebuildTheNewFile(tmp_path, monkeypatch):
+    # small chunks, so that the hunks cross chunk borders and chunks are widened
+    monkeypatch.setattr(gitar, "LARGE_ALIGN_CHUNK", 64)
+    monkeypatch.setattr(gitar, "LARGE_ALIGN_MAX_CHUNK", 256)
+    for seed in range(5):
+        lines1, lines2, large1, large2 = largeFilePair(tmp_path, seed)
+        lines2 = gitar.decodeLines("".join(lines2).encode('utf-8'))
+        for side1, side2 in ((lines1, lines2), (large1, large2)):
+            rebuilt = []
+            i = 0
+            for i1, i2, j1, j2 in gitar.largeFileHunks(side1, side2):
+                assert i <= i1 <= i2 and j1 <= j2 and (i1 < i2 or j1 < j2), seed
+                rebuilt += lines1[i:i1]
+                assert len(rebuilt) == j1, seed
+                rebuilt += lines2[j1:j2]
+                i = i2
+            assert rebuilt+lines1[i:] == lines2, seed
+
+def test_alignLargeFilesShowsAnExcerpt(tmp_path):
+    lines1, lines2, large1, large2 = largeFilePair(tmp_path, 1)
+    aligned = gitar.alignLargeFiles(large1, large2)
+    assert len(aligned) < len(lines2)
+    for side, large in ((0, large1), (1, large2)):
+        # the shown lines and the line ranges of the gaps add up to the file
+        indices, shown = aligned.column(side)
+        rebuilt = []
+        for row, (index, flag) in enumerate(zip(indices, aligned.flags)):
+            if index >= 0:
+                rebuilt.append(shown[index])
+            elif flag == gitar.GAP:
+                i1, i2 = aligned.gaps[row][2*side:2*side+2]
+                rebuilt += large[i1:i2]
+        assert rebuilt == list(large), side
+    for row, flag in enumerate(aligned.flags):
+        if flag == UNCHANGED:
+            assert aligned.text(0, row) == aligned.text(1, row)
+    assert gitar.alignLargeFiles(large1, large1).changes() == 0
+
+def test_exportRecordAndHtml():
+    aligned = gitar.alignLines(["a\n", "b <x>\n", "c\n"], ["a\n", "b <y>\n", "c\n", "d & e\n"])
+    record = gitar.exportRecord("p.txt", (2, 1), aligned)
+    assert record == {"path": "p.txt", "added": 2, "deleted": 1, "status": "aligned", "rows": [
+        {"changed": False, "left": "a", "right": "a"},
+        {"changed": True, "left": "b <x>", "leftMarks": [[3, 4]], "right": "b <y>", "rightMarks": [[3, 4]]},
+        {"changed": False, "left": "c", "right": "c"},
+        {"changed": True, "left": None, "right": "d & e", "rightMarks": [[0, 5]]}]}
+    report = gitar.htmlRecord(record)
+    assert report.startswith("<h2>p.txt (+2 -1)</h2>\n<table>\n")
+    assert '<tr class="c"><td class="n">2</td><td>b &lt;<span class="m">x</span>&gt;</td>' in report
+    assert '<td class="n"></td><td class="pad"></td><td class="n">4</td><td><span class="m">d &amp; e</span></td>' in report
+    binary = gitar.exportRecord("image.png", None, None, "binary")
+    assert binary == {"path": "image.png", "status": "binary"}
+    assert gitar.htmlRecord(binary) == "<h2>image.png</h2>\n<p>binary file</p>\n"
+
+def test_htmlRecordNumbersLinesAfterExcerptGaps():
+    lines1 = ["line %i\n"%i for i in range(100)]
+    lines2 = list(lines1)
+    lines2[50] = "changed\n"
+    record = gitar.exportRecord("huge.txt", (1, 1), gitar.alignLargeFiles(lines1, lines2), "excerpt")
+    assert [row["changed"] for row in record["rows"]] == [None]+[False]*5+[True]+[False]*5+[None]
+    assert record["rows"][0]["left"] == (gitar.EXCERPT_GAP%(1, 45)).rstrip("\n")
+    report = gitar.htmlRecord(record)
+    assert '<td class="n">46</td><td>line 45</td>' in report
+    assert '<tr class="c"><td class="n">51</td>' in report
+
+def checkMerge(base, left, right):
+    """Returns the AlignedMerge of left and right with base and the list of its problems."""
+    merged = gitar.mergeAlignments(gitar.alignLines(base, left), gitar.alignLines(base, right))
+    problems = []
+    for side, lines in ((0, left), (1, right), (2, base)):
+        if [i for i in merged.column(side)[0] if i >= 0] != list(range(len(lines))):
+            problems.append("side %i does not reproduce its file"%side)
+    if not len(merged.left) == len(merged.right) == len(merged.base) == len(merged.sides) == len(merged.flags):
+        problems.append("columns have different lengths")
+    for row, (i, j, k, flag, sides) in enumerate(zip(merged.left, merged.right, merged.base, merged.flags, merged.sides)):
+        if flag == UNCHANGED and not (sides == 0 and min(i, j, k) >= 0 and left[i] == right[j] == base[k]):
+            problems.append("unchanged row %i differs"%row)
+        # a side that did not change a row has the line of the base there
+        if flag != UNCHANGED and not sides & 1 and not ((i >= 0 and k >= 0 and left[i] == base[k]) or i == k == -1):
+            problems.append("row %i is marked unchanged on the left"%row)
+        if flag != UNCHANGED and not sides & 2 and not ((j >= 0 and k >= 0 and right[j] == base[k]) or j == k == -1):
+            problems.append("row %i is marked unchanged on the right"%row)
+    return merged, problems
+
+def test_mergeAlignmentsIsConsistent():
+    rng = random.Random(5)
+    for n in range(500):
+        vocabulary = ["line %i\n"%i for i in range(rng.randint(3, 30))]
+        base = [rng.choice(vocabulary) for i in range(rng.randint(0, 40))]
+        merged, problems = checkMerge(base, mutate(rng, base), mutate(rng, base))
+        assert problems == [], n
+
+def test_mergeAlignmentsConflicts():
+    base = ["line %i\n"%i for i in range(20)]
+    left, right, same = list(base), list(base), list(base)
+    left[10] = "left\n"
+    right[10] = "right\n"
+    same[10] = "left\n"
+    right[2] = "right only\n"
+    merged, problems = checkMerge(base, left, right)
+    assert problems == []
+    assert merged.conflicts() == 1
+    assert [merged.sides[r] for r, flag in enumerate(merged.flags) if flag == CONFLICT] == [3]
+    merged, problems = checkMerge(base, left, same)
+    assert problems == []
+    assert merged.conflicts() == 0 and merged.changes() == 1
+
+def test_parseBlameIncremental():
+    first, second = "1"*40, "2"*40
+    porcelain = ("%s 1 1 2\n"%first+
+                 "author Jürgen Groß\nauthor-mail <jg@example.com>\nauthor-time 1700000000\nauthor-tz +0100\n"
+                 "committer Jürgen Groß\ncommitter-time 1700000000\ncommitter-tz +0100\nsummary Grüße\nboundary\n"
+                 "filename a.c\n"+
+                 "%s 3 3 1\n"%second+
+                 "author 山田太郎\nauthor-time 1700000000\nauthor-tz -0530\nsummary second\n"
+                 "previous %s a.c\nfilename a.c\n"%first+
+                 # the headers of a commit are only sent the first time
+                 "%s 5 4 2\nfilename a.c\n"%first)
+    ranges = list(gitar.parseBlameIncremental(line.encode()+b"\n" for line in porcelain.splitlines()))
+    assert [[(a.line, a.commit, a.author, a.date, a.time) for a in annotations] for annotations in ranges] == [
+        [(0, first, "Jürgen Groß", "2023-11-14", "23:13:20"), (1, first, "Jürgen Groß", "2023-11-14", "23:13:20")],
+        [(2, second, "山田太郎", "2023-11-14", "16:43:20")],
+        [(3, first, "Jürgen Groß", "2023-11-14", "23:13:20"), (4, first, "Jürgen Groß", "2023-11-14", "23:13:20")]]
+
+def git(path, *args):
+    return subprocess.check_output(["git", "-c", "user.name=gitar", "-c", "user.email=gitar@example.com"]+list(args), cwd=path)
+
+@pytest.fixture(scope="module")
+def packedRepository(tmp_path_factory):
+    """A repository with packed objects (with delta chains), loose objects and an annotated tag."""
+    if shutil.which("git") is None:
+        pytest.skip("git is not installed")
+    path = str(tmp_path_factory.mktemp("packed"))
+    git(path, "init", "-q")
+    rng = random.Random(3)
+    lines = ["line %i of a file that changes a little in every commit\n"%i for i in range(300)]
+    for n in range(30):
+        lines = mutate(rng, lines)
+        os.makedirs(os.path.join(path, "src", "sub"), exist_ok=True)
+        with open(os.path.join(path, "src", "file.txt"), "w") as f:
+            f.writelines(lines)
+        with open(os.path.join(path, "src", "sub", "%i.bin"%(n%3)), "wb") as f:
+            f.write(bytes(rng.randrange(256) for i in range(2000)))
+        git(path, "add", "-A")
+        git(path, "commit", "-q", "-m", "commit %i"%n)
+    git(path, "tag", "-a", "-m", "a tag", "v1")
+    git(path, "repack", "-a", "-d", "-f", "-q", "--depth=50", "--window=50")
+    # objects written after the repack stay loose
+    with open(os.path.join(path, "loose.txt"), "w") as f:
+        f.write("not packed\n")
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "loose")
+    return path
+
+def test_objectStoreReadsLikeGit(packedRepository):
+    store = gitar.PackedObjectStore([os.path.join(packedRepository, ".git", "objects")])
+    counts = git(packedRepository, "count-objects", "-v").decode()
+    assert "in-pack: 0\n" not in counts and "count: 0\n" not in counts
+    for line in git(packedRepository, "cat-file", "--batch-all-objects", "--batch-check").decode().splitlines():
+        sha, objtype, size = line.split()
+        assert store.readObject(sha) == (objtype, git(packedRepository, "cat-file", objtype, sha)), sha
+
+def test_objectStoreListsTreesLikeGit(packedRepository):
+    store = gitar.PackedObjectStore([os.path.join(packedRepository, ".git", "objects")])
+    for rev in ("HEAD", "HEAD~5", "v1"):
+        commit = git(packedRepository, "rev-parse", rev+"^{commit}").decode().strip()
+        tree = git(packedRepository, "rev-parse", rev+"^{tree}").decode().strip()
+        assert store.peel(git(packedRepository, "rev-parse", rev).decode().strip(), "commit") == commit
+        assert store.peel(commit, "tree") == tree
+        listed = {}
+        for entry in git(packedRepository, "ls-tree", "-r", "-z", tree).split(b"\0"):
+            if entry:
+                info, path = entry.split(b"\t", 1)
+                listed[path.decode()] = info.split()[2].decode()
+        assert dict(store.listTree(tree)) == listed
+        for path, sha in listed.items():
+            assert store.lookupPath(commit, path) == sha
+        assert store.lookupPath(commit, "src/missing.txt") is None
+
+@pytest.fixture
+def renamedRepository(tmp_path):
+    """A repository where b.txt is renamed to c.txt and changed in the last commit."""
+    if shutil.which("git") is None:
+        pytest.skip("git is not installed")
+    path = str(tmp_path)
+    git(path, "init", "-q")
+    for name in ("a.txt", "b.txt"):
+        with open(os.path.join(path, name), "w") as f:
+            f.writelines("line %i of %s\n"%(i, name) for i in range(20))
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "first")
+    git(path, "mv", "b.txt", "c.txt")
+    with open(os.path.join(path, "c.txt"), "a") as f:
+        f.write("one more line\n")
+    git(path, "commit", "-q", "-a", "-m", "rename")
+    return path
+
+def test_renamedFilesKeepTheirOldPath(renamedRepository):
+    path = renamedRepository
+    assert gitar.getChangedFilesFromGit(path, "HEAD~1", "HEAD") == [("b.txt", "c.txt")]
+    assert gitar.getDiffNumstat(path, "HEAD~1", "HEAD") == {"c.txt": (1, 0)}
+    [record] = gitar.exportDiffs(path, "HEAD~1", "HEAD", dict)
+    assert record["path"] == "c.txt" and (record["added"], record["deleted"]) == (1, 0)
+    assert [row["changed"] for row in record["rows"]] == [False]*20+[True]
+    assert record["rows"][-1]["left"] is None
+    # renamed in the working copy, which is the left side
+    git(path, "mv", "c.txt", "d.txt")
+    with open(os.path.join(path, "d.txt"), "a") as f:
+        f.write("and another\n")
+    assert gitar.getChangedFilesFromGit(path, "", "HEAD") == [("d.txt", "c.txt")]
+    assert gitar.getDiffNumstat(path, "", "HEAD") == {"c.txt": (1, 0)}
+
+def test_localChangesAreCountedFromTheMergeBase(renamedRepository):
+    path = renamedRepository
+    git(path, "checkout", "-q", "-b", "other", "HEAD~1")
+    with open(os.path.join(path, "a.txt"), "a") as f:
+        f.write("changed on the other branch\n")
+    git(path, "commit", "-q", "-a", "-m", "other")
+    git(path, "checkout", "-q", "-")
+    assert gitar.getChangedFilesFromGit(path, "HEAD", "other", True) == [("c.txt", "b.txt")]
+    assert gitar.getDiffNumstat(path, "HEAD", "other", True) == {"b.txt": (1, 0)}
+    assert set(gitar.getDiffNumstat(path, "HEAD", "other")) == {"a.txt", "b.txt"}
+    [record] = gitar.exportDiffs(path, "HEAD", "other", dict, locallyChangedOnly=True)
+    assert record["path"] == "b.txt" and (record["added"], record["deleted"]) == (1, 0)